@@ -0,0 +1,167 @@
+"""
+Admission control for the translator's datapath.
+
+A flood of (possibly spoofed) unicast sources would otherwise get every source a multicast group and a Multicast Menu
+entry, exhausting the address space and the publisher. The AdmissionController limits the rate at which new flows are
+admitted, and polices every admitted flow's packets and bytes per second. All limits are enforced with token buckets
+that are refilled lazily (i.e., when a packet arrives), so checking a packet takes a few arithmetic operations and no
+system calls or timers.
+"""
+import math
+import time
+
+import constants
+
+# The largest UDP payload. The byte bucket of a flow always holds at least this many bytes, so that every packet can
+# get through a bucket that is full.
+_MAX_PAYLOAD_SIZE = 65535
+
+
+class TokenBucket:
+    """
+    A token bucket that holds at most burst tokens and is refilled at rate tokens per second.
+    """
+    __slots__ = ('_rate', '_burst', '_tokens', '_last')
+
+    def __init__(self, rate, burst, now):
+        """
+        Create a new (full) TokenBucket.
+
+        :param rate: Tokens added per second.
+        :param burst: Maximum number of tokens.
+        :param now: Current time.monotonic() timestamp.
+        """
+        self._rate = rate
+        self._burst = burst
+        self._tokens = burst
+        self._last = now
+
+    def take(self, n, now):
+        """
+        Take n tokens, if there are that many.
+
+        :param n: Number of tokens.
+        :param now: Current time.monotonic() timestamp.
+
+        :return: True if the tokens were taken, False if there were not enough tokens (none are taken then).
+        """
+        tokens = min(self._burst, self._tokens + (now - self._last) * self._rate)
+        self._last = now
+        if tokens < n:
+            self._tokens = tokens
+            return False
+        self._tokens = tokens - n
+        return True
+
+
+class FlowPolicer:
+    """
+    Polices the packets and bytes per second of a flow, with a bucket of packets and a bucket of bytes. A packet is only
+    admitted (and only takes tokens) if both buckets have enough tokens.
+    """
+    __slots__ = ('_pkt_rate', '_pkt_burst', '_byte_rate', '_byte_burst', '_pkts', '_bytes', '_last', 'num_dropped')
+
+    def __init__(self, pkt_rate, pkt_burst, byte_rate, byte_burst, now):
+        """
+        Create a new FlowPolicer with full buckets. A limit that is not enforced has a rate of 0 and an infinite burst
+        (the bucket then always holds infinitely many tokens), which saves a branch per packet.
+
+        :param pkt_rate: Packets per second.
+        :param pkt_burst: Maximum number of packets in a burst.
+        :param byte_rate: Bytes per second.
+        :param byte_burst: Maximum number of bytes in a burst.
+        :param now: Current time.monotonic() timestamp.
+        """
+        self._pkt_rate = pkt_rate
+        self._pkt_burst = pkt_burst
+        self._byte_rate = byte_rate
+        self._byte_burst = byte_burst
+        self._pkts = pkt_burst
+        self._bytes = byte_burst
+        self._last = now
+        # Number of packets of the flow that have been dropped for exceeding its limits.
+        self.num_dropped = 0
+
+    def admit(self, nbytes, now):
+        """
+        Check whether a packet is within the flow's limits.
+
+        :param nbytes: Payload size of the packet.
+        :param now: Current time.monotonic() timestamp.
+
+        :return: True if the packet is admitted, False if it is to be dropped.
+        """
+        elapsed = now - self._last
+        self._last = now
+        # Comparisons rather than min(), which costs a function call.
+        pkts = self._pkts + elapsed * self._pkt_rate
+        if pkts > self._pkt_burst:
+            pkts = self._pkt_burst
+        nbytes_avail = self._bytes + elapsed * self._byte_rate
+        if nbytes_avail > self._byte_burst:
+            nbytes_avail = self._byte_burst
+        if pkts < 1 or nbytes_avail < nbytes:
+            self._pkts = pkts
+            self._bytes = nbytes_avail
+            self.num_dropped += 1
+            return False
+        self._pkts = pkts - 1
+        self._bytes = nbytes_avail - nbytes
+        return True
+
+
+class AdmissionController:
+    """
+    Decides which new flows are admitted, and provides each admitted flow with a FlowPolicer.
+    """
+
+    def __init__(self, max_new_flows_per_s=None, max_flow_pps=None, max_flow_bytes_per_s=None,
+                 burst_s=constants.ADMISSION_BURST_S):
+        """
+        Create a new AdmissionController. Limits that are None are not enforced.
+
+        :param max_new_flows_per_s: Maximum rate at which new flows are admitted.
+        :param max_flow_pps: Maximum packets per second of a flow.
+        :param max_flow_bytes_per_s: Maximum payload bytes per second of a flow.
+        :param burst_s: Each limit may be exceeded for bursts of up to this many seconds' worth of flows, packets or
+        bytes (but bursts of at least one flow, one packet and one maximum-size packet are always allowed).
+        """
+        for name, limit in (('max_new_flows_per_s', max_new_flows_per_s), ('max_flow_pps', max_flow_pps),
+                            ('max_flow_bytes_per_s', max_flow_bytes_per_s)):
+            if limit is not None and limit <= 0:
+                raise ValueError(f'{name} must be positive, but was {limit}')
+        # The bucket of new flows (None if their rate is not limited).
+        self._new_flows = None
+        if max_new_flows_per_s is not None:
+            burst = max(1.0, max_new_flows_per_s * burst_s)
+            self._new_flows = TokenBucket(max_new_flows_per_s, burst, time.monotonic())
+        self._policed = max_flow_pps is not None or max_flow_bytes_per_s is not None
+        self._pkt_rate, self._pkt_burst = 0.0, math.inf
+        if max_flow_pps is not None:
+            self._pkt_rate, self._pkt_burst = max_flow_pps, max(1.0, max_flow_pps * burst_s)
+        self._byte_rate, self._byte_burst = 0.0, math.inf
+        if max_flow_bytes_per_s is not None:
+            self._byte_rate = max_flow_bytes_per_s
+            self._byte_burst = max(float(_MAX_PAYLOAD_SIZE), max_flow_bytes_per_s * burst_s)
+
+    def admit_new_flow(self, now):
+        """
+        Check whether a new flow is admitted (i.e., may be allocated a multicast address).
+
+        :param now: Current time.monotonic() timestamp.
+
+        :return: True if the flow is admitted, False if it is denied.
+        """
+        return self._new_flows is None or self._new_flows.take(1, now)
+
+    def policer(self, now):
+        """
+        Create a FlowPolicer for a newly admitted flow.
+
+        :param now: Current time.monotonic() timestamp.
+
+        :return: The FlowPolicer, or None if flows are not policed.
+        """
+        if not self._policed:
+            return None
+        return FlowPolicer(self._pkt_rate, self._pkt_burst, self._byte_rate, self._byte_burst, now)
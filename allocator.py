@@ -0,0 +1,638 @@
+import hashlib
+import random
+import sys
+import threading
+from array import array
+from multiprocessing.managers import BaseManager
+
+import constants
+import snapshot
+
+# A 64-bit word with all bits set.
+_FULL = (1 << 64) - 1
+# Multiplier of the linear congruential generator of the jump consistent hash (see _jump_hash()).
+_JUMP_LCG_MULT = 2862933555777941757
+
+
+def _lowest_zero_bit(word):
+    """
+    :return: The position of the lowest zero bit in word (64 if there is none among the 64 lowest bits).
+    """
+    return (~word & (word + 1)).bit_length() - 1
+
+
+class AddrBitmap:
+    """
+    A compact bitmap that records which indexes (of an address space) are allocated, with O(1) test, set and clear and
+    O(log n) search for the next free index.
+
+    Bit i of the bitmap is stored in 64-bit word i // 64 of the bottom level. Each level above summarizes the level
+    below it: bit j of a summary word is set iff the corresponding word of the level below is full (all bits set). The
+    search for a free index thus skips 64 full words per bit at the first summary level, 4096 at the second, and so on.
+    For a /8 address space, the bitmap takes up about 2 MiB and has 4 levels.
+    """
+
+    def __init__(self, size):
+        """
+        Create a new AddrBitmap with all indexes free.
+
+        :param size: Number of indexes.
+        """
+        if size < 1:
+            raise ValueError(f'size must be at least 1, but was {size}')
+        self.size = size
+        # Number of allocated indexes.
+        self.count = 0
+        self._levels = []
+        n = size
+        while True:
+            num_words = (n + 63) // 64
+            level = array('Q', [0]) * num_words
+            # Bits beyond the end of a level (padding) are set s.t. they're never considered free.
+            if n % 64:
+                level[-1] = _FULL ^ ((1 << (n % 64)) - 1)
+            self._levels.append(level)
+            if num_words == 1:
+                break
+            n = num_words
+
+    @classmethod
+    def from_bytes(cls, size, data):
+        """
+        Create a new AddrBitmap from the output of to_bytes().
+
+        :param size: Number of indexes.
+        :param data: The bytes returned by to_bytes() (bit i of the bitmap is bit i % 8 of byte i // 8).
+
+        :return: The AddrBitmap.
+        """
+        bitmap = cls(size)
+        words = array('Q')
+        words.frombytes(bytes(data).ljust(len(bitmap._levels[0]) * 8, b'\x00'))
+        if sys.byteorder == 'big':
+            words.byteswap()
+        if size % 64:
+            words[-1] |= _FULL ^ ((1 << (size % 64)) - 1)
+        bitmap._levels[0] = words
+        bitmap.count = sum(bin(word).count('1') for word in words) - (len(words) * 64 - size)
+        # Rebuild the summary levels bottom-up.
+        for lower, upper in zip(bitmap._levels, bitmap._levels[1:]):
+            for j, word in enumerate(lower):
+                if word == _FULL:
+                    upper[j >> 6] |= 1 << (j & 63)
+        return bitmap
+
+    def to_bytes(self):
+        """
+        :return: The bitmap as bytes (bit i of the bitmap is bit i % 8 of byte i // 8).
+        """
+        words = array('Q', self._levels[0])
+        if sys.byteorder == 'big':
+            words.byteswap()
+        return words.tobytes()[:(self.size + 7) // 8]
+
+    def is_set(self, i):
+        """
+        :return: True if index i is allocated, False otherwise.
+        """
+        return (self._levels[0][i >> 6] >> (i & 63)) & 1 == 1
+
+    def set(self, i):
+        """
+        Mark index i as allocated.
+
+        :param i: The index. Must currently be free.
+
+        :return: None.
+        """
+        self.count += 1
+        for level in self._levels:
+            w = i >> 6
+            word = level[w] | (1 << (i & 63))
+            level[w] = word
+            if word != _FULL:
+                break
+            # The word just became full, so mark it as such in the level above.
+            i = w
+
+    def clear(self, i):
+        """
+        Mark index i as free.
+
+        :param i: The index. Must currently be allocated.
+
+        :return: None.
+        """
+        self.count -= 1
+        for level in self._levels:
+            w = i >> 6
+            word = level[w]
+            level[w] = word & ~(1 << (i & 63))
+            if word != _FULL:
+                break
+            # The word is no longer full, so unmark it in the level above.
+            i = w
+
+    def find_free(self, start=0):
+        """
+        Find the first free index at or after start, wrapping around to index 0 if necessary.
+
+        :param start: Index to start the search at.
+
+        :return: The free index, or None if all indexes are allocated.
+        """
+        i = self._find_free_from(start)
+        if i is None and start > 0:
+            i = self._find_free_from(0)
+        return i
+
+    def _find_free_from(self, start):
+        levels = self._levels
+        depth = 0
+        pos = start
+        while depth < len(levels):
+            level = levels[depth]
+            w = pos >> 6
+            if w >= len(level):
+                return None
+            # Treat the bits below pos as allocated.
+            word = level[w] | ((1 << (pos & 63)) - 1)
+            if word != _FULL:
+                pos = (w << 6) | _lowest_zero_bit(word)
+                # Descend to the bottom level, following the lowest non-full word at each level.
+                while depth > 0:
+                    depth -= 1
+                    pos = (pos << 6) | _lowest_zero_bit(levels[depth][pos])
+                return pos
+            # No free bit at or after pos in this word: continue with the next word, which is found through the level
+            # above (bit w + 1 of the level above represents word w + 1 of this level).
+            pos = w + 1
+            depth += 1
+        return None
+
+
+class SparseAddrSet:
+    """
+    Records which indexes (of an address space) are allocated in a set, with the same interface as AddrBitmap. Meant for
+    address spaces that are too large for an AddrBitmap (e.g., the 2^32 group IDs of an IPv6 SSM range such as
+    ff3e::/96), which are only ever sparsely populated: it takes memory per allocated index rather than per index, and
+    the search for a free index takes time proportional to the run of allocated indexes it starts in.
+    """
+
+    def __init__(self, size):
+        """
+        Create a new SparseAddrSet with all indexes free.
+
+        :param size: Number of indexes.
+        """
+        if size < 1:
+            raise ValueError(f'size must be at least 1, but was {size}')
+        self.size = size
+        # Number of allocated indexes.
+        self.count = 0
+        self._allocated = set()
+
+    def is_set(self, i):
+        """
+        :return: True if index i is allocated, False otherwise.
+        """
+        return i in self._allocated
+
+    def set(self, i):
+        """
+        Mark index i as allocated.
+
+        :param i: The index. Must currently be free.
+
+        :return: None.
+        """
+        self._allocated.add(i)
+        self.count += 1
+
+    def clear(self, i):
+        """
+        Mark index i as free.
+
+        :param i: The index. Must currently be allocated.
+
+        :return: None.
+        """
+        self._allocated.remove(i)
+        self.count -= 1
+
+    def find_free(self, start=0):
+        """
+        Find the first free index at or after start, wrapping around to index 0 if necessary.
+
+        :param start: Index to start the search at.
+
+        :return: The free index, or None if all indexes are allocated.
+        """
+        if self.count >= self.size:
+            return None
+        i = start % self.size
+        while i in self._allocated:
+            i = (i + 1) % self.size
+        return i
+
+
+def _new_addr_set(size):
+    """
+    :return: An AddrBitmap with size indexes, or a SparseAddrSet if the address space is too large for a bitmap.
+    """
+    if size > constants.ALLOC_BITMAP_MAX_SIZE:
+        return SparseAddrSet(size)
+    return AddrBitmap(size)
+
+
+def _check_addr_space(mcast_addr_space):
+    """
+    Check that multicast addresses can be allocated from an address space.
+
+    :param mcast_addr_space: The address space (an ipaddress.IPv4Network or ipaddress.IPv6Network).
+
+    :return: None.
+    """
+    if mcast_addr_space.num_addresses <= 2:
+        errmsg = f'The address space {str(mcast_addr_space)} only contains a network address and a broadcast ' \
+                 f'address, but no host addresses.'
+        raise ValueError(errmsg)
+    if mcast_addr_space.version == 6 and mcast_addr_space.prefixlen < 96:
+        # Allocations are indexed by 32-bit integers (which matches the 32-bit group IDs of IPv6 SSM).
+        raise ValueError(f'The address space {str(mcast_addr_space)} is too large, IPv6 address spaces must be at '
+                         f'most a /96 (e.g., ff3e::/96).')
+
+
+class RandomAllocPolicy:
+    """
+    Picks multicast addresses at random.
+    """
+    name = 'random'
+
+    def __init__(self, max_attempts=10):
+        """
+        :param max_attempts: Number of attempts at picking a free index at random before falling back to the first free
+        index after the last random pick.
+        """
+        self._max_attempts = max_attempts
+
+    def select(self, bitmap, client_addr):
+        """
+        Select a free index.
+
+        :param bitmap: The AddrBitmap of the address space. Must have at least one free index.
+        :param client_addr: The (ip, port) tuple identifying the unicast client to select an index for.
+
+        :return: The selected index.
+        """
+        # Testing an index is O(1), so a few random picks are cheap. If all of them hit an address that is already in
+        # use, we take the first free index after the last pick instead. As a result, the address selection is not
+        # truly (pseudo) random as any address that is an immediate neighbor of any (continuous block of) address(es)
+        # that is (are) already in use has a greater chance of being selected. However, this "imbalance" is acceptable
+        # for our purposes, and it bounds the selection to O(log n) time even if the address space is nearly full.
+        for _ in range(self._max_attempts):
+            idx = random.randrange(bitmap.size)
+            if not bitmap.is_set(idx):
+                return idx
+        return bitmap.find_free(idx)
+
+
+class SequentialAllocPolicy:
+    """
+    Picks multicast addresses in ascending order, continuing after the most recently picked address and wrapping around
+    at the end of the address space (i.e., freed addresses are only reused after a full round).
+    """
+    name = 'sequential'
+
+    def __init__(self):
+        self._next_idx = 0
+
+    def select(self, bitmap, client_addr):
+        """
+        Select a free index.
+
+        :param bitmap: The AddrBitmap of the address space. Must have at least one free index.
+        :param client_addr: The (ip, port) tuple identifying the unicast client to select an index for.
+
+        :return: The selected index.
+        """
+        idx = bitmap.find_free(self._next_idx)
+        self._next_idx = (idx + 1) % bitmap.size
+        return idx
+
+
+def _mix64(x):
+    """
+    :return: x (a 64-bit integer) scrambled with the SplitMix64 finalizer.
+    """
+    x = (x + 0x9e3779b97f4a7c15) & _FULL
+    x = ((x ^ (x >> 30)) * 0xbf58476d1ce4e5b9) & _FULL
+    x = ((x ^ (x >> 27)) * 0x94d049bb133111eb) & _FULL
+    return x ^ (x >> 31)
+
+
+def _jump_hash(key, num_buckets):
+    """
+    Jump consistent hash (Lamping and Veach, 2014): maps a 64-bit key to one of num_buckets buckets s.t. changing the
+    number of buckets from n to m only moves about |m - n| / max(m, n) of the keys. Takes O(log num_buckets) time.
+
+    :return: The bucket of key, in [0, num_buckets).
+    """
+    bucket, j = -1, 0
+    while j < num_buckets:
+        bucket = j
+        key = (key * _JUMP_LCG_MULT + 1) & _FULL
+        j = int((bucket + 1) * ((1 << 31) / ((key >> 33) + 1)))
+    return bucket
+
+
+class HashAllocPolicy:
+    """
+    Picks the multicast address of a unicast client by hashing its IP address and port into the address space, s.t. a
+    client gets the same address whenever it is free, e.g., after its flow has been evicted, after a (cold) restart, or
+    from another translator that does not share the allocator. The hash depends on nothing but the client and the size
+    of the address space (no shared state), and it is consistent: growing or shrinking the address space only moves as
+    few clients as necessary.
+
+    If the client's address is in use, up to max_probes - 1 further addresses are tried (by double hashing, i.e., at a
+    stride that is also derived from the client), before falling back to the first free index after the last of them.
+    """
+    name = 'hash'
+
+    def __init__(self, max_probes=10):
+        """
+        :param max_probes: Number of hashed addresses to try before falling back to the first free index after the last
+        of them.
+        """
+        self._max_probes = max_probes
+
+    @staticmethod
+    def client_key(client_addr):
+        """
+        :param client_addr: The (ip, port) tuple (or (ip, port, flowinfo, scope_id) tuple) identifying a unicast client.
+
+        :return: The 64-bit hash of the client's IP address and port. Unlike hash(), it is the same in every process.
+        """
+        digest = hashlib.blake2b(f'{client_addr[0]}|{client_addr[1]}'.encode(), digest_size=8).digest()
+        return int.from_bytes(digest, 'big')
+
+    def select(self, bitmap, client_addr):
+        """
+        Select a free index.
+
+        :param bitmap: The AddrBitmap of the address space. Must have at least one free index.
+        :param client_addr: The (ip, port) tuple identifying the unicast client to select an index for.
+
+        :return: The selected index.
+        """
+        key = self.client_key(client_addr)
+        size = bitmap.size
+        idx = _jump_hash(key, size)
+        if not bitmap.is_set(idx):
+            return idx
+        # Only the first pick needs to be consistent, the probes are cheaper.
+        stride = _mix64(key) % (size - 1) + 1
+        for _ in range(self._max_probes - 1):
+            idx = (idx + stride) % size
+            if not bitmap.is_set(idx):
+                return idx
+        return bitmap.find_free(idx)
+
+
+# Maps the name of each allocation policy to its class.
+ALLOC_POLICIES = {policy.name: policy for policy in (RandomAllocPolicy, SequentialAllocPolicy, HashAllocPolicy)}
+
+
+class McastAddrAllocator:
+    """
+    Allocates multicast addresses (groups) from an address space to unicast clients.
+
+    The allocator is the authoritative record of which multicast address has been allocated to which unicast client. A
+    single allocator can be shared by several Translators (e.g., Translators running in different worker processes, see
+    AllocatorManager) to guarantee that no multicast address is ever handed out to two clients at once.
+
+    Internally, addresses are represented by their index in the address space. The allocated indexes are recorded in an
+    AddrBitmap, so both allocating and freeing an address take at most O(log n) time, regardless of how full the address
+    space is. Address spaces with more than constants.ALLOC_BITMAP_MAX_SIZE addresses (i.e., IPv6 address spaces of up
+    to 2^32 groups) are recorded in a SparseAddrSet instead.
+    """
+
+    def __init__(self, mcast_addr_space, policy='random'):
+        """
+        Create a new McastAddrAllocator.
+
+        :param mcast_addr_space: Address space to pick multicast addresses from (an ipaddress.IPv4Network or, for IPv6
+        SSM, an ipaddress.IPv6Network of at most 2^32 addresses).
+        :param policy: Name of the allocation policy (a key of ALLOC_POLICIES) that determines which of the free
+        addresses is picked.
+        """
+        _check_addr_space(mcast_addr_space)
+        if policy not in ALLOC_POLICIES:
+            raise ValueError(f'Unknown allocation policy {policy}, must be one of {", ".join(ALLOC_POLICIES)}')
+        self._addr_space = mcast_addr_space
+        self._base_addr = int(mcast_addr_space.network_address)
+        # ipaddress.IPv4Address or ipaddress.IPv6Address.
+        self._addr_cls = type(mcast_addr_space.network_address)
+        self._policy = ALLOC_POLICIES[policy]()
+        # Allocated indexes. The network address (index 0) and the broadcast address (last index) are permanently marked
+        # as allocated s.t. they're never picked (for IPv6, the first and the last group ID are never picked).
+        self._bitmap = _new_addr_set(mcast_addr_space.num_addresses)
+        self._bitmap.set(0)
+        self._bitmap.set(mcast_addr_space.num_addresses - 1)
+        # Maps a src ip and src port to the index of its respective multicast group.
+        self._fib = dict()
+        # Maps indexes of multicast groups to the Multicast Menu access codes of their streams, s.t. they survive a warm
+        # restart (see snapshot()).
+        self._access_codes = dict()
+        # Clients whose allocations have been restored from a snapshot but that have not been seen since.
+        self._unclaimed = set()
+        # For synchronizing access to properties that are used by multiple threads.
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        """
+        :return: The number of multicast addresses currently allocated.
+        """
+        return len(self._fib)
+
+    def occupancy(self):
+        """
+        :return: An (allocated, capacity) tuple of the number of multicast addresses currently allocated and the number
+        of multicast addresses that can be allocated in total.
+        """
+        with self._lock:
+            # The network address and the broadcast address are never handed out.
+            return len(self._fib), self._bitmap.size - 2
+
+    def alloc(self, client_addr):
+        """
+        Allocate a multicast address for a unicast client.
+
+        :param client_addr: The (ip, port) tuple identifying the unicast client.
+
+        :return: A (multicast address, newly allocated) tuple. The multicast address is the one already allocated for
+        client_addr (and newly allocated is False) if there is one. The multicast address is None if we've run out of
+        addresses.
+        """
+        with self._lock:
+            idx = self._fib.get(client_addr, None)
+            if idx is not None:
+                self._unclaimed.discard(client_addr)
+                return self._addr_cls(self._base_addr + idx), False
+            if self._bitmap.count == self._bitmap.size:
+                # All addresses in the address space are currently in use by other clients.
+                return None, False
+            idx = self._policy.select(self._bitmap, client_addr)
+            assert not self._bitmap.is_set(idx), f'picked a multicast address index ({idx}) that was already allocated'
+            self._bitmap.set(idx)
+            self._fib[client_addr] = idx
+            return self._addr_cls(self._base_addr + idx), True
+
+    def free(self, client_addr):
+        """
+        Free the multicast address allocated for a unicast client, if any, making it available to other clients.
+
+        :param client_addr: The (ip, port) tuple identifying the unicast client.
+
+        :return: The freed multicast address, or None if no multicast address was allocated for client_addr.
+        """
+        with self._lock:
+            idx = self._fib.pop(client_addr, None)
+            if idx is None:
+                return None
+            self._bitmap.clear(idx)
+            self._access_codes.pop(idx, None)
+            self._unclaimed.discard(client_addr)
+            return self._addr_cls(self._base_addr + idx)
+
+    def set_access_code(self, mcast_addr, access_code):
+        """
+        Record the Multicast Menu access code of the stream sent to a multicast address, s.t. it's included in
+        snapshots. Ignored if the multicast address has been freed in the meantime.
+
+        :param mcast_addr: The multicast address.
+        :param access_code: The access code.
+
+        :return: None.
+        """
+        idx = int(mcast_addr) - self._base_addr
+        with self._lock:
+            if 0 <= idx < self._bitmap.size and self._bitmap.is_set(idx):
+                self._access_codes[idx] = access_code
+
+    def access_codes(self):
+        """
+        :return: A dict that maps multicast addresses to the Multicast Menu access codes of their streams.
+        """
+        with self._lock:
+            return {self._addr_cls(self._base_addr + idx): code for idx, code in self._access_codes.items()}
+
+    def snapshot(self):
+        """
+        :return: A snapshot of the allocations and access codes (see the snapshot module).
+        """
+        with self._lock:
+            return snapshot.encode(self._addr_space, self._fib.items(), self._access_codes)
+
+    def restore(self, data):
+        """
+        Restore the allocations and access codes from a snapshot. The allocator must not have allocated any addresses
+        yet. The restored allocations are unclaimed until their clients are seen again (see expire_unclaimed()).
+
+        :param data: The snapshot (as returned by snapshot()).
+
+        :return: The number of restored allocations.
+        """
+        addr_space, flows, access_codes = snapshot.decode(data)
+        if addr_space != self._addr_space:
+            raise snapshot.SnapshotError(f'the snapshot is of address space {addr_space}, not {self._addr_space}.')
+        with self._lock:
+            if self._fib:
+                raise RuntimeError('Cannot restore a snapshot into an allocator that has already allocated addresses.')
+            # Build the new state aside s.t. the allocator is left untouched if the snapshot turns out to be invalid.
+            fib = dict(flows)
+            indexes = set(fib.values())
+            last_idx = self._bitmap.size - 1
+            if len(fib) != len(flows) or len(indexes) != len(fib) or \
+                    (indexes and (min(indexes) <= 0 or max(indexes) >= last_idx)):
+                raise snapshot.SnapshotError('the snapshot contains invalid or conflicting allocations.')
+            bitmap = _new_addr_set(self._bitmap.size)
+            bitmap.set(0)
+            bitmap.set(last_idx)
+            for idx in indexes:
+                bitmap.set(idx)
+            self._bitmap = bitmap
+            self._fib = fib
+            self._access_codes = {idx: code for idx, code in access_codes.items() if idx in indexes}
+            self._unclaimed = set(self._fib)
+            return len(self._fib)
+
+    def set_addr_space(self, mcast_addr_space):
+        """
+        Switch to another address space (e.g., a narrower or a wider one). Allocations whose multicast addresses are
+        host addresses of the new address space are kept (along with their access codes). All other allocations are
+        dropped, so their clients are allocated a new multicast address from the new address space when they next call
+        alloc().
+
+        :param mcast_addr_space: The new address space (of the same IP version as the current one).
+
+        :return: A list of (client address, multicast address) tuples of the dropped allocations.
+        """
+        _check_addr_space(mcast_addr_space)
+        if mcast_addr_space.version != self._addr_space.version:
+            raise ValueError(f'Cannot switch from the IPv{self._addr_space.version} address space {self._addr_space} '
+                             f'to the IPv{mcast_addr_space.version} address space {mcast_addr_space}.')
+        base_addr = int(mcast_addr_space.network_address)
+        last_idx = mcast_addr_space.num_addresses - 1
+        with self._lock:
+            bitmap = _new_addr_set(mcast_addr_space.num_addresses)
+            bitmap.set(0)
+            bitmap.set(last_idx)
+            fib = dict()
+            access_codes = dict()
+            dropped = []
+            for client_addr, idx in self._fib.items():
+                addr = self._base_addr + idx
+                new_idx = addr - base_addr
+                if 0 < new_idx < last_idx:
+                    bitmap.set(new_idx)
+                    fib[client_addr] = new_idx
+                    access_code = self._access_codes.get(idx, None)
+                    if access_code is not None:
+                        access_codes[new_idx] = access_code
+                else:
+                    dropped.append((client_addr, self._addr_cls(addr)))
+                    self._unclaimed.discard(client_addr)
+            self._addr_space = mcast_addr_space
+            self._base_addr = base_addr
+            self._bitmap = bitmap
+            self._fib = fib
+            self._access_codes = access_codes
+            return dropped
+
+    def expire_unclaimed(self):
+        """
+        Free the restored allocations whose clients have not been seen since the snapshot was restored.
+
+        :return: A list of (client address, multicast address) tuples of the freed allocations.
+        """
+        expired = []
+        with self._lock:
+            for client_addr in self._unclaimed:
+                idx = self._fib.pop(client_addr)
+                expired.append((client_addr, self._addr_cls(self._base_addr + idx)))
+                self._bitmap.clear(idx)
+                self._access_codes.pop(idx, None)
+            self._unclaimed = set()
+        return expired
+
+
+class AllocatorManager(BaseManager):
+    """
+    Serves a McastAddrAllocator from a dedicated coordinator process such that Translators in other processes can share
+    it (through a proxy).
+    """
+    pass
+
+
+AllocatorManager.register('McastAddrAllocator', McastAddrAllocator)
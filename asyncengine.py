@@ -0,0 +1,288 @@
+"""
+An asyncio-based translation engine.
+
+AsyncTranslator translates unicast UDP to multicast UDP just like Translator, but all of its work (receiving and
+forwarding packets and evicting idle flows) happens on an asyncio event loop rather than on a dedicated thread. It can
+thus be embedded in other asyncio services (e.g., a metrics server or a control API) that share the loop, and it stops
+instantly rather than after the read timeout. Streams are published on the Multicast Menu by the same
+MulticastMenuPublisher as Translator's, whose publish() and withdraw() only queue a request and thus never block the
+loop. New settings (see Translator.reconfigure()) are applied by a task that yields to the loop after each step.
+
+The event loop can be provided by uvloop, which is optional: without uvloop, the default asyncio event loop is used.
+"""
+import asyncio
+import logging
+import math
+import signal
+import time
+
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
+import config
+import constants
+from eviction import IdleTimerWheel
+from translator import Translator
+
+logger = logging.getLogger(__name__)
+
+
+class _TranslationProtocol(asyncio.DatagramProtocol):
+    """
+    Hands the datagrams received on the unicast socket to a translation callback.
+    """
+
+    def __init__(self, translate):
+        """
+        :param translate: Callable that takes the payload and the (ip, port) source address of a received datagram.
+        """
+        # Bind the callback directly to save a function call per packet.
+        self.datagram_received = translate
+
+    def error_received(self, exc):
+        logger.error(f'Error on the unicast socket: {exc}')
+
+
+class AsyncTranslator(Translator):
+    """
+    Translates unicast UDP to multicast UDP on an asyncio event loop.
+
+    Use ``await start()`` and ``await stop()`` (or ``async with``) from within a running event loop instead of start()
+    and terminate(). The constructor takes the same arguments as Translator's, except that read_timeout_s has no effect
+    and batch_size must be 1 (the event loop hands over one datagram at a time). reconfigure() must be called from the
+    event loop's thread.
+    """
+
+    def __init__(self, *args, **kwargs):
+        """
+        Create a new AsyncTranslator instance (see Translator.__init__()).
+        """
+        batch_size = kwargs.get('batch_size', 1)
+        if batch_size > 1:
+            logger.warning(f'The asyncio engine receives one packet at a time, ignoring batch size {batch_size}')
+            kwargs['batch_size'] = 1
+        super().__init__(*args, **kwargs)
+        # The event loop the AsyncTranslator runs on (set in start()).
+        self._loop = None
+        self._transport = None
+        self._eviction_task = None
+        # Applies the new configurations queued by reconfigure() (None if there are none).
+        self._reconfig_task = None
+        # The timer that releases the packets held back for pacing, and the time.monotonic() timestamp it fires at
+        # (None if no timer is scheduled).
+        self._pacing_timer = None
+        self._pacing_timer_at = None
+        # Only every so many packets' processing time is recorded (see _loop_latency).
+        self._latency_countdown = constants.METRICS_LOOP_LATENCY_SAMPLE_INTERVAL
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.stop()
+
+    async def start(self):
+        """
+        Start this AsyncTranslator on the running event loop.
+
+        This method should only be called once. An AsyncTranslator is use-once-then-throw-away, i.e., it cannot be
+        restarted.
+
+        :return: None.
+        """
+        with self._lock:
+            if self._started.is_set():
+                raise RuntimeError('Translator already started.')
+            self._started.set()
+        loop = asyncio.get_running_loop()
+        self._loop = loop
+        if self._idle_timeout_s is not None:
+            self._idle_timers = IdleTimerWheel(self._idle_timeout_s, constants.IDLE_EVICTION_TICK_S, time.monotonic())
+        self._init_srv_sckt()
+        self._init_mcast_sckt()
+        # Packets are sent straight from the receive callback, which must never block the loop.
+        self._mcast_sckt.setblocking(False)
+        self._restore_state()
+        self._start_metrics_server()
+        self._mcastmenu.start()
+        self._transport, _ = await loop.create_datagram_endpoint(lambda: _TranslationProtocol(self._translate),
+                                                                 sock=self._srv_sckt)
+        if self._idle_timers is not None:
+            self._eviction_task = loop.create_task(self._eviction_loop())
+
+    async def stop(self):
+        """
+        Stop this AsyncTranslator. Packets that have not been received yet are not translated anymore, and pending
+        Multicast Menu requests are dropped (requests that are in flight are completed in the background).
+
+        :return: None.
+        """
+        if not self._started.is_set() or self._termination_initiated.is_set():
+            return
+        logger.info('Termination initiated...')
+        self._termination_initiated.set()
+        # Closing the transport closes the unicast socket.
+        self._transport.close()
+        if self._pacing_timer is not None:
+            self._pacing_timer.cancel()
+        tasks = [task for task in (self._eviction_task, self._reconfig_task) if task is not None]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        if self._truncated_count:
+            logger.warning(f'{self._truncated_count} unicast packets were dropped as they exceeded the read buffer '
+                           f'size ({self._buffer_size} bytes).')
+        if self._metrics_server is not None:
+            self._metrics_server.stop()
+        self._mcast_sckt.close()
+        if self._flow_sckts is not None:
+            self._flow_sckts.close()
+        if self._snapshotter is not None:
+            self._snapshotter.stop()
+        if self._lease_keeper is not None:
+            self._lease_keeper.stop()
+        self._mcastmenu.stop(blocking=False)
+        self._terminated.set()
+
+    def _translate(self, payload, src_addr):
+        """
+        Forward a unicast packet to the multicast address allocated for its source.
+
+        :param payload: The payload of the unicast packet.
+        :param src_addr: The (ip, port) tuple identifying the unicast source.
+
+        :return: None.
+        """
+        if len(payload) > self._buffer_size:
+            # Drop the packet, as the other engine would (the event loop receives datagrams of up to 256 KiB).
+            self._drop_truncated(src_addr)
+            return
+        now = time.monotonic()
+        flow = self._fib.get(src_addr, None)
+        if flow is None:
+            flow = self._handle_new_flow(src_addr, now)
+            if flow is None:
+                return
+        flow.last_seen = now
+        if flow.policer is not None and not flow.policer.admit(len(payload), now):
+            self._drop_rate_limited(flow)
+            return
+        flow.num_pkts += 1
+        flow.num_bytes += len(payload)
+        if flow.pacing is not None and not self._pacer.pace(flow, payload, len(payload), now):
+            self._schedule_pacing_timer()
+            return
+        try:
+            if flow.sckt is not None:
+                flow.sckt.send(payload)
+            else:
+                self._mcast_sckt.sendto(payload, flow.dst_addr)
+        except OSError:
+            # E.g., the send buffer is full, or the payload exceeds the path MTU. Drop the packet (as a router with a
+            # full queue would) rather than stall the loop.
+            self._send_error_count += 1
+        self._latency_countdown -= 1
+        if self._latency_countdown == 0:
+            self._loop_latency.observe(time.monotonic() - now)
+            self._latency_countdown = constants.METRICS_LOOP_LATENCY_SAMPLE_INTERVAL
+
+    def _schedule_pacing_timer(self):
+        """
+        Make sure the packets held back for pacing are released when the next of them is due.
+
+        :return: None.
+        """
+        next_departure = self._pacer.next_departure
+        if self._pacing_timer is not None:
+            if self._pacing_timer_at <= next_departure:
+                return
+            self._pacing_timer.cancel()
+        self._pacing_timer_at = next_departure
+        self._pacing_timer = asyncio.get_running_loop().call_later(max(0.0, next_departure - time.monotonic()),
+                                                                   self._on_pacing_timer)
+
+    def _on_pacing_timer(self):
+        self._pacing_timer = None
+        self._release_paced(time.monotonic())
+        if self._pacer.next_departure < math.inf:
+            self._schedule_pacing_timer()
+
+    def _alloc_mcast_addr(self, client_addr, now):
+        flow, new = super()._alloc_mcast_addr(client_addr, now)
+        if flow is not None and flow.sckt is not None:
+            flow.sckt.setblocking(False)
+        return flow, new
+
+    def _queue_reconfig(self, mcast_addr_space, sockopts, dropped, lost=()):
+        self._reconfigs.append((mcast_addr_space, sockopts, dropped, lost))
+        if self._reconfig_task is None or self._reconfig_task.done():
+            self._reconfig_task = asyncio.get_running_loop().create_task(self._reconfig_loop())
+
+    def _on_allocations_lost(self, lost):
+        # Called from the LeaseKeeper's thread, but the reconfiguration task must be created on the event loop.
+        self._loop.call_soon_threadsafe(self._queue_reconfig, None, dict(), [], lost)
+
+    async def _reconfig_loop(self):
+        """
+        Apply the queued new configurations, yielding to the event loop (i.e., translating packets) after each step.
+
+        :return: None.
+        """
+        while self._reconfigs:
+            try:
+                for _ in self._apply_config(*self._reconfigs.popleft()):
+                    await asyncio.sleep(0)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f'Failed to apply the new configuration: {e}', extra={'event': 'reload'})
+
+    async def _eviction_loop(self):
+        """
+        Evict idle flows whenever the idle timer wheel ticks.
+
+        :return: None.
+        """
+        while True:
+            await asyncio.sleep(max(0.0, self._idle_timers.next_tick_time - time.monotonic()))
+            self._evict_idle_flows(time.monotonic())
+
+
+async def _serve(translator_kwargs, config_path):
+    """
+    Run an AsyncTranslator until an interrupt or termination signal is received, reloading the config file on SIGHUP.
+
+    :param translator_kwargs: Keyword arguments for the AsyncTranslator.
+    :param config_path: Path of the config file (see the config module), or None.
+
+    :return: None.
+    """
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, stop.set)
+    async with AsyncTranslator(**translator_kwargs) as t:
+        loop.add_signal_handler(signal.SIGHUP, config.reload, t, config_path)
+        logger.info('Press CTRL+C to stop the translator.')
+        await stop.wait()
+
+
+def run(translator_kwargs, use_uvloop=False, config_path=None):
+    """
+    Run an AsyncTranslator on a new event loop until an interrupt or termination signal is received.
+
+    :param translator_kwargs: Keyword arguments for the AsyncTranslator (see Translator.__init__()).
+    :param use_uvloop: If True, run the event loop on uvloop (if it is installed).
+    :param config_path: Path of the config file to reload on SIGHUP (see the config module), or None.
+
+    :return: None.
+    """
+    if use_uvloop:
+        if uvloop is None:
+            logger.warning('uvloop is not installed, using the default asyncio event loop')
+        else:
+            asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    asyncio.run(_serve(translator_kwargs, config_path))
@@ -0,0 +1,1238 @@
+#!/usr/bin/python3
+"""
+Benchmarks for the unicast-to-multicast translator.
+
+Every benchmark runs the translator on this machine, so no network equipment is involved. Translated streams are not
+published on the Multicast Menu while benchmarking.
+"""
+import argparse
+import collections
+import hashlib
+import ipaddress
+import json
+import logging
+import math
+import multiprocessing as mp
+import os
+import random
+import socket
+import struct
+import tempfile
+import threading
+import time
+from array import array
+
+import cluster
+import logsetup
+import mmsg
+import pcapfile
+import snapshot
+from admission import AdmissionController
+from allocator import ALLOC_POLICIES, AddrBitmap, McastAddrAllocator
+from cluster import ClusterAllocator
+from translator import Flow, Translator
+
+# Multicast address spaces of the datapath benchmark, for translating to IPv4 and to IPv6 (SSM) multicast.
+DEFAULT_MCAST_ADDR_SPACE = ipaddress.IPv4Network('232.255.255.0/28')
+DEFAULT_IPV6_MCAST_ADDR_SPACE = ipaddress.IPv6Network('ff3e::ffff:ff00/124')
+# Header of the packets of the load benchmark: source number, sequence number (per source) and send time
+# (time.monotonic_ns(), which is system-wide, so the receiver can take the forwarding latency).
+_LOAD_HEADER = struct.Struct('!IQq')
+# Time (in seconds) the receiver of the load benchmark waits for packets after the measurement window, s.t. packets
+# that are still in flight are not counted as lost.
+_LOAD_DRAIN_S = 0.5
+# Packet capture that the replay benchmark replays by default.
+DEFAULT_REPLAY_PCAP = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'multicast-menu', 'amt_traffic.pcap')
+# AMT (RFC 7450) port, and type of the Multicast Data message, whose header is the type and a reserved byte.
+_AMT_PORT = 2268
+_AMT_MULTICAST_DATA = 6
+# Inner IPv4 header (version and header length, TOS, total length, ID, flags and fragment offset, TTL, protocol,
+# checksum, source and destination) and UDP header (ports, length and checksum) of AMT Multicast Data messages.
+_INNER_IPV4_HEADER = struct.Struct('!BBHHHBBH4s4s')
+_INNER_UDP_HEADER = struct.Struct('!HHHH')
+# Inner addresses of AMT Multicast Data messages that encapsulate captured IPv6 datagrams.
+_INNER_DEFAULT_SRC = '192.0.2.1'
+_INNER_DEFAULT_GROUP = '232.255.255.1'
+
+
+class BenchmarkTranslator(Translator):
+    """
+    A Translator that does not publish translated streams on the Multicast Menu.
+    """
+
+    def _publish_stream(self, flow):
+        pass
+
+
+def _send_loop(dst_addr, num_sources, payload_size, stop):
+    """
+    Send unicast UDP to dst_addr from num_sources distinct source ports, as fast as possible, until stop is set.
+
+    :param dst_addr: Destination (ip, port) tuple, i.e., the translator's unicast server socket (IPv4 or IPv6).
+    :param num_sources: Number of unicast sources (sockets) to emulate.
+    :param payload_size: UDP payload size of each packet.
+    :param stop: A multiprocessing.Event that signals that sending should stop.
+
+    :return: None.
+    """
+    family = socket.AF_INET6 if ':' in dst_addr[0] else socket.AF_INET
+    sckts = [socket.socket(family, socket.SOCK_DGRAM) for _ in range(num_sources)]
+    payload = bytes(payload_size)
+    try:
+        while not stop.is_set():
+            for _ in range(100):
+                for sckt in sckts:
+                    try:
+                        sckt.sendto(payload, dst_addr)
+                    except OSError:
+                        # The send buffer is full, move on to the next source.
+                        pass
+    finally:
+        for sckt in sckts:
+            sckt.close()
+
+
+def _mcast_recv_sckt(mcast_addr_space, mcast_port):
+    """
+    Create a socket that receives the translated packets of all groups in mcast_addr_space.
+
+    :param mcast_addr_space: The translator's multicast address space (IPv4 or IPv6). All groups in this space are
+    joined (IPv6 groups on the interface that the routing table picks for them, like the translator's sockets do).
+    :param mcast_port: Multicast destination port used by the translator.
+
+    :return: A (socket, address family) tuple. The socket has a timeout of 100 ms.
+    """
+    family = socket.AF_INET6 if mcast_addr_space.version == 6 else socket.AF_INET
+    sckt = socket.socket(family, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+    sckt.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sckt.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 8 * 1024 * 1024)
+    sckt.bind(('', mcast_port))
+    for group in mcast_addr_space.hosts():
+        if family == socket.AF_INET6:
+            mreq = socket.inet_pton(socket.AF_INET6, str(group)) + struct.pack('@I', 0)
+            sckt.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_JOIN_GROUP, mreq)
+        else:
+            mreq = struct.pack('=4sl', socket.inet_aton(str(group)), socket.INADDR_ANY)
+            sckt.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, mreq)
+    sckt.settimeout(0.1)
+    return sckt, family
+
+
+def _recv_loop(mcast_addr_space, mcast_port, start, stop, result):
+    """
+    Count the multicast packets (and bytes) received on mcast_port for all groups in mcast_addr_space between the
+    moment start is set and the moment stop is set.
+
+    :param mcast_addr_space: The translator's multicast address space (IPv4 or IPv6). All groups in this space are
+    joined (IPv6 groups on the interface that the routing table picks for them, like the translator's sockets do).
+    :param mcast_port: Multicast destination port used by the translator.
+    :param start: A multiprocessing.Event that signals that counting should start.
+    :param stop: A multiprocessing.Event that signals that counting should stop.
+    :param result: A multiprocessing.Queue on which the (packets, bytes, elapsed seconds) tuple is put.
+
+    :return: None.
+    """
+    sckt, family = _mcast_recv_sckt(mcast_addr_space, mcast_port)
+    receiver = mmsg.BatchReceiver(64, 2048, family) if mmsg.is_available() else None
+    pkts = 0
+    nbytes = 0
+    try:
+        start.wait()
+        t_start = time.monotonic()
+        while not stop.is_set():
+            try:
+                if receiver is not None:
+                    # Block (up to the socket timeout) until there is something to receive.
+                    sckt.recv(0, socket.MSG_PEEK)
+                    n = receiver.recv(sckt.fileno())
+                    pkts += n
+                    nbytes += sum(receiver.lengths[:n])
+                else:
+                    nbytes += len(sckt.recv(2048))
+                    pkts += 1
+            except socket.timeout:
+                pass
+        elapsed = time.monotonic() - t_start
+    finally:
+        sckt.close()
+    result.put((pkts, nbytes, elapsed))
+
+
+def bench_datapath(srv_port, mcast_addr_space, mcast_port, batch_size, num_sources, num_senders, payload_size,
+                   duration_s, warmup_s=1.0, srv_ip='127.0.0.1'):
+    """
+    Measure the forwarding rate of a Translator on the loopback interface.
+
+    :param srv_port: Port for the translator's unicast server socket.
+    :param mcast_addr_space: Multicast address space for the translator (IPv4, or IPv6 to translate to IPv6
+    multicast). Must be large enough to host num_sources groups.
+    :param mcast_port: Multicast destination port for the translator.
+    :param batch_size: The Translator's batch_size.
+    :param num_sources: Total number of unicast sources.
+    :param num_senders: Number of sender processes that the sources are spread across.
+    :param payload_size: UDP payload size.
+    :param duration_s: Length of the measurement window.
+    :param warmup_s: Time to let the translator run before the measurement window starts.
+    :param srv_ip: Loopback address for the translator's unicast server socket (127.0.0.1, or ::1 to receive the
+    unicast packets over IPv6).
+
+    :return: A (packets per second, Mbit per second) tuple.
+    """
+    t = BenchmarkTranslator(ucast_srv_ip=srv_ip, ucast_srv_port=srv_port, mcast_addr_space=mcast_addr_space,
+                            mcast_port=mcast_port, read_buffer_size=max(payload_size, 1514), read_timeout_s=0.5,
+                            batch_size=batch_size)
+    start = mp.Event()
+    stop = mp.Event()
+    result = mp.Queue()
+    receiver = mp.Process(target=_recv_loop, args=(mcast_addr_space, mcast_port, start, stop, result))
+    receiver.start()
+    # Give the receiver a moment to join the groups.
+    time.sleep(0.5)
+    t.start()
+    senders = []
+    for i in range(num_senders):
+        n = num_sources // num_senders + (1 if i < num_sources % num_senders else 0)
+        p = mp.Process(target=_send_loop, args=((srv_ip, srv_port), n, payload_size, stop))
+        p.start()
+        senders.append(p)
+    time.sleep(warmup_s)
+    start.set()
+    time.sleep(duration_s)
+    stop.set()
+    pkts, nbytes, elapsed = result.get()
+    for p in senders + [receiver]:
+        p.join()
+    t.terminate(blocking=True)
+    return pkts / elapsed, nbytes * 8 / elapsed / 1e6
+
+
+def _load_send_loop(dst_addr, first_source, num_sources, payload_size, pps, window_ns, result):
+    """
+    Send unicast UDP to dst_addr from num_sources distinct source ports (in turn) at a given packet rate, until the end
+    of the measurement window. Each packet carries a _LOAD_HEADER.
+
+    :param dst_addr: Destination (ip, port) tuple, i.e., the translator's unicast server socket (IPv4 or IPv6).
+    :param first_source: Number of the first source (the sources of all senders are numbered consecutively).
+    :param num_sources: Number of unicast sources (sockets) to emulate.
+    :param payload_size: UDP payload size of each packet (at least _LOAD_HEADER.size).
+    :param pps: Packets per second to send (across all sources), or 0 to send as fast as possible.
+    :param window_ns: The (start, end) time.monotonic_ns() timestamps of the measurement window.
+    :param result: A multiprocessing.Queue on which the number of packets sent within the window is put.
+
+    :return: None.
+    """
+    family = socket.AF_INET6 if ':' in dst_addr[0] else socket.AF_INET
+    sckts = [socket.socket(family, socket.SOCK_DGRAM) for _ in range(num_sources)]
+    payload = bytearray(payload_size)
+    seqs = [0] * num_sources
+    start_ns, end_ns = window_ns
+    interval_ns = 1e9 / pps if pps else 0
+    next_ns = time.monotonic_ns()
+    pack_into = _LOAD_HEADER.pack_into
+    monotonic_ns = time.monotonic_ns
+    src = 0
+    num_sent = 0
+    try:
+        while True:
+            now = monotonic_ns()
+            if now >= end_ns:
+                break
+            num_due = 100
+            if interval_ns:
+                if now < next_ns:
+                    time.sleep(min(next_ns - now, 1000000) / 1e9)
+                    continue
+                num_due = int((now - next_ns) // interval_ns) + 1
+                if num_due > 1000:
+                    # Can't keep up, don't try to make up for it later.
+                    num_due = 1000
+                    next_ns = now
+                next_ns += num_due * interval_ns
+            for _ in range(num_due):
+                sent_ns = monotonic_ns()
+                pack_into(payload, 0, first_source + src, seqs[src], sent_ns)
+                try:
+                    sckts[src].sendto(payload, dst_addr)
+                except OSError:
+                    # The send buffer is full, the packet was not sent (and doesn't count as lost).
+                    continue
+                seqs[src] += 1
+                if start_ns <= sent_ns < end_ns:
+                    num_sent += 1
+                src = src + 1 if src + 1 < num_sources else 0
+    finally:
+        for sckt in sckts:
+            sckt.close()
+    result.put(num_sent)
+
+
+def _load_recv_loop(mcast_addr_space, mcast_port, window_ns, ready, result):
+    """
+    Receive the translated packets of the load benchmark, and measure the throughput, the reordering and the forwarding
+    latency of the packets sent within the measurement window.
+
+    :param mcast_addr_space: The translator's multicast address space (all groups are joined).
+    :param mcast_port: Multicast destination port used by the translator.
+    :param window_ns: The (start, end) time.monotonic_ns() timestamps of the measurement window.
+    :param ready: A multiprocessing.Event that is set once the groups have been joined.
+    :param result: A multiprocessing.Queue on which a (packets, bytes, reordered packets, sorted latencies in
+    nanoseconds) tuple is put.
+
+    :return: None.
+    """
+    sckt, family = _mcast_recv_sckt(mcast_addr_space, mcast_port)
+    ready.set()
+    receiver = mmsg.BatchReceiver(64, 65536, family) if mmsg.is_available() else None
+    start_ns, end_ns = window_ns
+    drain_end_ns = end_ns + _LOAD_DRAIN_S * 1e9
+    unpack_from = _LOAD_HEADER.unpack_from
+    # The highest sequence number received per source.
+    max_seqs = dict()
+    latencies = array('q')
+    pkts = 0
+    nbytes = 0
+    reordered = 0
+    try:
+        while time.monotonic_ns() < drain_end_ns:
+            try:
+                if receiver is not None:
+                    # Block (up to the socket timeout) until there is something to receive.
+                    sckt.recv(0, socket.MSG_PEEK)
+                    payloads = [receiver.payload(i) for i in range(receiver.recv(sckt.fileno()))]
+                else:
+                    payloads = [sckt.recv(65536)]
+            except socket.timeout:
+                continue
+            now = time.monotonic_ns()
+            for payload in payloads:
+                if len(payload) < _LOAD_HEADER.size:
+                    continue
+                src, seq, sent_ns = unpack_from(payload)
+                if not start_ns <= sent_ns < end_ns:
+                    continue
+                pkts += 1
+                nbytes += len(payload)
+                if seq < max_seqs.get(src, -1):
+                    reordered += 1
+                else:
+                    max_seqs[src] = seq
+                latencies.append(now - sent_ns)
+    finally:
+        sckt.close()
+    result.put((pkts, nbytes, reordered, sorted(latencies)))
+
+
+def bench_load(srv_port, mcast_addr_space, mcast_port, batch_size, num_sources, num_senders, payload_size, pps,
+               duration_s, warmup_s=1.0, srv_ip='127.0.0.1'):
+    """
+    Drive a Translator on the loopback interface with synthetic unicast sources at a given packet rate, and measure
+    what comes out of it.
+
+    :param srv_port: Port for the translator's unicast server socket.
+    :param mcast_addr_space: Multicast address space for the translator (IPv4 or IPv6). Must be large enough to host
+    num_sources groups.
+    :param mcast_port: Multicast destination port for the translator.
+    :param batch_size: The Translator's batch_size.
+    :param num_sources: Total number of unicast sources.
+    :param num_senders: Number of sender processes that the sources (and the packet rate) are spread across.
+    :param payload_size: UDP payload size (at least _LOAD_HEADER.size).
+    :param pps: Total packet rate of the sources, or 0 to send as fast as possible.
+    :param duration_s: Length of the measurement window.
+    :param warmup_s: Time to let the translator run (and allocate the sources' groups) before the window starts.
+    :param srv_ip: Loopback address for the translator's unicast server socket.
+
+    :return: A dict with the offered and the forwarded packets per second (offered_pps, pps), the forwarded Mbit per
+    second (mbps), the fraction of packets lost (loss) and received out of order (reordered), and the median, 99th
+    percentile and maximum forwarding latency in microseconds (p50_us, p99_us, max_us).
+    """
+    if payload_size < _LOAD_HEADER.size:
+        raise ValueError(f'The payload size must be at least {_LOAD_HEADER.size} bytes.')
+    t = BenchmarkTranslator(ucast_srv_ip=srv_ip, ucast_srv_port=srv_port, mcast_addr_space=mcast_addr_space,
+                            mcast_port=mcast_port, read_buffer_size=max(payload_size, 1514), read_timeout_s=0.5,
+                            batch_size=batch_size)
+    # The window starts once the receiver has joined the groups (which takes a moment) and the translator has warmed up.
+    start_ns = time.monotonic_ns() + int((0.5 + warmup_s) * 1e9)
+    window_ns = (start_ns, start_ns + int(duration_s * 1e9))
+    ready = mp.Event()
+    recv_result = mp.Queue()
+    receiver = mp.Process(target=_load_recv_loop, args=(mcast_addr_space, mcast_port, window_ns, ready, recv_result))
+    receiver.start()
+    ready.wait()
+    t.start()
+    send_result = mp.Queue()
+    senders = []
+    first_source = 0
+    for i in range(num_senders):
+        n = num_sources // num_senders + (1 if i < num_sources % num_senders else 0)
+        p = mp.Process(target=_load_send_loop, args=((srv_ip, srv_port), first_source, n, payload_size,
+                                                     pps / num_senders, window_ns, send_result))
+        p.start()
+        senders.append(p)
+        first_source += n
+    num_sent = sum(send_result.get() for _ in senders)
+    pkts, nbytes, reordered, latencies = recv_result.get()
+    for p in senders + [receiver]:
+        p.join()
+    t.terminate(blocking=True)
+
+    def percentile(q):
+        return latencies[min(len(latencies) - 1, int(len(latencies) * q))] / 1e3 if latencies else math.nan
+
+    return {'offered_pps': num_sent / duration_s, 'pps': pkts / duration_s, 'mbps': nbytes * 8 / duration_s / 1e6,
+            'loss': 1 - pkts / num_sent if num_sent else math.nan, 'reordered': reordered / pkts if pkts else math.nan,
+            'p50_us': percentile(0.5), 'p99_us': percentile(0.99), 'max_us': percentile(1.0)}
+
+
+def _check_baseline(result, baseline, tolerance):
+    """
+    Compare a result of the load benchmark with its baseline.
+
+    :param result: The result (see bench_load()).
+    :param baseline: The baseline (a previous result).
+    :param tolerance: Fraction by which the throughput may fall short of the baseline's, and by which the 99th
+    percentile latency may exceed the baseline's.
+
+    :return: A list of the regressions (descriptions), empty if there are none.
+    """
+    regressions = []
+    if result['pps'] < baseline['pps'] * (1 - tolerance):
+        regressions.append(f'{result["pps"]:.0f} pps, down from {baseline["pps"]:.0f} pps')
+    if result['p99_us'] > baseline['p99_us'] * (1 + tolerance):
+        regressions.append(f'p99 latency {result["p99_us"]:.0f} us, up from {baseline["p99_us"]:.0f} us')
+    return regressions
+
+
+def _cmd_load(args):
+    mcast_addr_space = args.multicast_addr_space
+    if mcast_addr_space is None:
+        mcast_addr_space = DEFAULT_IPV6_MCAST_ADDR_SPACE if args.ipv6 else DEFAULT_MCAST_ADDR_SPACE
+    if mcast_addr_space.num_addresses - 2 < args.sources:
+        raise SystemExit(f'{mcast_addr_space} cannot host {args.sources} sources.')
+    srv_ip = '::1' if args.ipv6 else '127.0.0.1'
+    baselines = dict()
+    if args.baseline is not None and not args.save_baseline:
+        with open(args.baseline) as f:
+            baselines = json.load(f)
+    results = dict()
+    regressed = False
+    for batch_size in args.batch_sizes:
+        # Results are compared with the baseline of the same scenario.
+        scenario = f'ipv{6 if args.ipv6 else 4} batch={batch_size} sources={args.sources} ' \
+                   f'payload={args.payload_size} rate={args.rate:g}'
+        result = bench_load(args.unicast_port, mcast_addr_space, args.multicast_port, batch_size, args.sources,
+                            args.senders, args.payload_size, args.rate, args.duration, srv_ip=srv_ip)
+        results[scenario] = result
+        print(f'batch size {batch_size:4d}: offered {result["offered_pps"]:10.0f} pps, forwarded {result["pps"]:10.0f} '
+              f'pps {result["mbps"]:8.1f} Mbit/s, loss {result["loss"] * 100:6.2f}%, reordered '
+              f'{result["reordered"] * 100:5.2f}%, latency p50 {result["p50_us"]:7.1f} us p99 {result["p99_us"]:8.1f} '
+              f'us max {result["max_us"]:8.1f} us')
+        if scenario in baselines:
+            for regression in _check_baseline(result, baselines[scenario], args.tolerance):
+                regressed = True
+                print(f'  REGRESSION ({scenario}): {regression}')
+        elif args.baseline is not None and not args.save_baseline:
+            print(f'  no baseline for {scenario}')
+    if args.save_baseline:
+        try:
+            with open(args.baseline) as f:
+                baselines = json.load(f)
+        except FileNotFoundError:
+            pass
+        baselines.update(results)
+        with open(args.baseline, 'w') as f:
+            json.dump(baselines, f, indent=2, sort_keys=True)
+        print(f'Saved the baselines to {args.baseline}.')
+    if regressed:
+        raise SystemExit(1)
+
+
+def _ipv4_checksum(header):
+    total = sum(struct.unpack(f'!{len(header) // 2}H', header))
+    while total > 0xffff:
+        total = (total & 0xffff) + (total >> 16)
+    return ~total & 0xffff
+
+
+def _amt_multicast_data(src, dst, payload):
+    """
+    Encapsulate a captured UDP datagram in an AMT Multicast Data message, as an AMT relay would send it to a gateway.
+    Datagrams that already are AMT messages (from or to the AMT port) are left as they are.
+
+    :param src: The datagram's source (ip, port) tuple.
+    :param dst: The datagram's destination (ip, port) tuple.
+    :param payload: The datagram's UDP payload.
+
+    :return: An (AMT message, payload expected at the gateway's output) tuple. The expected payload is None if the
+    datagram is an AMT message that does not carry a UDP datagram (e.g., a control message).
+    """
+    if _AMT_PORT in (src[1], dst[1]):
+        inner = payload[2:]
+        if payload[:1] != bytes([_AMT_MULTICAST_DATA]) or len(inner) < 20 or inner[0] >> 4 != 4 or \
+                inner[9] != socket.IPPROTO_UDP:
+            return payload, None
+        off = (inner[0] & 0x0f) * 4
+        return payload, inner[off + _INNER_UDP_HEADER.size:off + int.from_bytes(inner[off + 4:off + 6], 'big')]
+    if ':' in src[0] or ':' in dst[0]:
+        inner_src, inner_dst = _INNER_DEFAULT_SRC, _INNER_DEFAULT_GROUP
+    else:
+        inner_src, inner_dst = src[0], dst[0]
+    udp_len = _INNER_UDP_HEADER.size + len(payload)
+    fields = [0x45, 0, _INNER_IPV4_HEADER.size + udp_len, 0, 0, 64, socket.IPPROTO_UDP, 0,
+              socket.inet_aton(inner_src), socket.inet_aton(inner_dst)]
+    fields[7] = _ipv4_checksum(_INNER_IPV4_HEADER.pack(*fields))
+    # UDP checksums are optional over IPv4.
+    return (bytes([_AMT_MULTICAST_DATA, 0]) + _INNER_IPV4_HEADER.pack(*fields) +
+            _INNER_UDP_HEADER.pack(src[1], dst[1], udp_len, 0) + payload), payload
+
+
+def _digest(payload):
+    return hashlib.blake2b(payload, digest_size=16).digest()
+
+
+def _replay_send_loop(packets, dst_addr, speed, result):
+    """
+    Send captured packets to dst_addr, each captured source from its own socket (s.t. the sources stay distinct flows).
+
+    :param packets: A list of (send time offset in seconds, source, payload) tuples, in the order they are to be sent.
+    :param dst_addr: Destination (ip, port) tuple.
+    :param speed: Factor by which to speed up the replay (the offsets are divided by it), or 0 to send as fast as
+    possible.
+    :param result: A multiprocessing.Queue on which a (packets sent, bytes sent, elapsed seconds, mean and maximum
+    lateness in seconds) tuple is put.
+
+    :return: None.
+    """
+    family = socket.AF_INET6 if ':' in dst_addr[0] else socket.AF_INET
+    sckts = dict()
+    num_sent = 0
+    nbytes = 0
+    total_lateness = 0.0
+    max_lateness = 0.0
+    start = time.perf_counter()
+    try:
+        for offset, src, payload in packets:
+            sckt = sckts.get(src)
+            if sckt is None:
+                sckt = sckts[src] = socket.socket(family, socket.SOCK_DGRAM)
+            if speed:
+                due = start + offset / speed
+                delay = due - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+                lateness = time.perf_counter() - due
+                if lateness > 0:
+                    total_lateness += lateness
+                    max_lateness = max(max_lateness, lateness)
+            try:
+                sckt.sendto(payload, dst_addr)
+            except OSError:
+                # The send buffer is full, the packet was not sent (and doesn't count as missing).
+                continue
+            num_sent += 1
+            nbytes += len(payload)
+        elapsed = time.perf_counter() - start
+    finally:
+        for sckt in sckts.values():
+            sckt.close()
+    result.put((num_sent, nbytes, elapsed, total_lateness / num_sent if num_sent else 0.0, max_lateness))
+
+
+def _replay_recv_loop(mcast_addr_space, port, ready, stop, result):
+    """
+    Receive the output of a replay, and take a digest of each payload (for the integrity check).
+
+    :param mcast_addr_space: The translator's multicast address space (all groups are joined), or None to receive the
+    output of an AMT gateway, i.e., unicast on the loopback interface.
+    :param port: The port to receive on.
+    :param ready: A multiprocessing.Event that is set once the socket is bound (and the groups have been joined).
+    :param stop: A multiprocessing.Event that signals that the replay is over. Packets are received until there have
+    been none for _LOAD_DRAIN_S seconds after that.
+    :param result: A multiprocessing.Queue on which a (collections.Counter of the payloads' digests, packets, bytes,
+    seconds from the first to the last packet) tuple is put.
+
+    :return: None.
+    """
+    if mcast_addr_space is None:
+        sckt = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sckt.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 8 * 1024 * 1024)
+        sckt.bind(('127.0.0.1', port))
+        sckt.settimeout(0.1)
+    else:
+        sckt, _ = _mcast_recv_sckt(mcast_addr_space, port)
+    ready.set()
+    digests = collections.Counter()
+    pkts = 0
+    nbytes = 0
+    first = last = None
+    idle_since = None
+    try:
+        while True:
+            try:
+                payload = sckt.recv(65536)
+            except socket.timeout:
+                if stop.is_set():
+                    idle_since = idle_since or time.perf_counter()
+                    if time.perf_counter() - idle_since >= _LOAD_DRAIN_S:
+                        break
+                continue
+            idle_since = None
+            last = time.perf_counter()
+            first = first or last
+            digests[_digest(payload)] += 1
+            pkts += 1
+            nbytes += len(payload)
+    finally:
+        sckt.close()
+    result.put((digests, pkts, nbytes, last - first if pkts else 0.0))
+
+
+def bench_replay(datagrams, target, speed, loops=1, mcast_addr_space=DEFAULT_MCAST_ADDR_SPACE, srv_port=19001,
+                 mcast_port=19002, batch_size=32, gateway_addr=('127.0.0.1', _AMT_PORT), output_port=19003):
+    """
+    Replay the UDP datagrams of a packet capture to a translator (started on the loopback interface), or to the data
+    path of an AMT gateway, and check the integrity of the payloads that come out of it.
+
+    :param datagrams: The datagrams, as (timestamp, source, destination, payload) tuples (see pcapfile.PcapReader).
+    :param target: 'translator' to send the payloads to a translator's unicast server socket (one flow per captured
+    source), or 'amt' to send them to an AMT gateway, encapsulated in AMT Multicast Data messages (unless they are
+    captured AMT Multicast Data messages). The gateway is expected to forward the payloads to output_port on the
+    loopback interface.
+    :param speed: Factor by which to speed up the replay (1 to replay at the original timing), or 0 to replay as fast as
+    possible.
+    :param loops: Number of times to replay the capture (back to back, at the capture's mean packet interval).
+    :param mcast_addr_space: Multicast address space for the translator. Must be large enough to host the captured
+    sources.
+    :param srv_port: Port for the translator's unicast server socket.
+    :param mcast_port: Multicast destination port for the translator.
+    :param batch_size: The translator's batch_size.
+    :param gateway_addr: (ip, port) tuple of the AMT gateway's data path (i.e., the gateway's AMT socket).
+    :param output_port: Port on the loopback interface to which the AMT gateway forwards the payloads.
+
+    :return: A dict with the packets, bytes and packets per second sent (sent, sent_bytes, sent_pps), the mean and
+    maximum lateness of the sends in microseconds (lateness_us, max_lateness_us), the packets and bytes received (recvd,
+    recvd_bytes), the received packets per second and Mbit per second (pps, mbps, from the first to the last packet
+    received), and the integrity check: the number of payloads received intact, missing (not received, or altered),
+    corrupted (received, but not sent) and duplicated (received more often than sent).
+    """
+    if not datagrams:
+        raise ValueError('The capture has no UDP datagrams.')
+    first_ts = datagrams[0][0]
+    span = datagrams[-1][0] - first_ts
+    loop_span = span + span / (len(datagrams) - 1) if len(datagrams) > 1 else 0.0
+    packets = []
+    expected = collections.Counter()
+    for loop in range(loops):
+        for timestamp, src, dst, payload in datagrams:
+            offset = loop * loop_span + max(0.0, timestamp - first_ts)
+            if target == 'amt':
+                message, output = _amt_multicast_data(src, dst, payload)
+                packets.append((offset, src, message))
+            else:
+                output = payload
+                packets.append((offset, src, payload))
+            if output is not None:
+                expected[_digest(output)] += 1
+    t = None
+    if target == 'amt':
+        dst_addr = gateway_addr
+        recv_args = (None, output_port)
+    else:
+        t = BenchmarkTranslator(ucast_srv_ip='127.0.0.1', ucast_srv_port=srv_port, mcast_addr_space=mcast_addr_space,
+                                mcast_port=mcast_port, read_timeout_s=0.5, batch_size=batch_size,
+                                read_buffer_size=max(1514, max(len(d[3]) for d in datagrams)))
+        t.start()
+        dst_addr = ('127.0.0.1', srv_port)
+        recv_args = (mcast_addr_space, mcast_port)
+    ready = mp.Event()
+    stop = mp.Event()
+    recv_result = mp.Queue()
+    receiver = mp.Process(target=_replay_recv_loop, args=recv_args + (ready, stop, recv_result))
+    receiver.start()
+    ready.wait()
+    send_result = mp.Queue()
+    sender = mp.Process(target=_replay_send_loop, args=(packets, dst_addr, speed, send_result))
+    sender.start()
+    num_sent, sent_bytes, send_elapsed, lateness, max_lateness = send_result.get()
+    sender.join()
+    stop.set()
+    digests, pkts, nbytes, recv_elapsed = recv_result.get()
+    receiver.join()
+    if t is not None:
+        t.terminate(blocking=True)
+    intact = sum((digests & expected).values())
+    corrupted = sum(n for digest, n in digests.items() if digest not in expected)
+    return {'sent': num_sent, 'sent_bytes': sent_bytes,
+            'sent_pps': num_sent / send_elapsed if send_elapsed else math.inf, 'lateness_us': lateness * 1e6,
+            'max_lateness_us': max_lateness * 1e6, 'recvd': pkts, 'recvd_bytes': nbytes,
+            'pps': pkts / recv_elapsed if recv_elapsed else math.nan,
+            'mbps': nbytes * 8 / recv_elapsed / 1e6 if recv_elapsed else math.nan,
+            'intact': intact, 'missing': sum(expected.values()) - intact, 'corrupted': corrupted,
+            'duplicated': pkts - intact - corrupted}
+
+
+def _cmd_replay(args):
+    try:
+        reader = pcapfile.PcapReader(args.pcap)
+        datagrams = list(reader)
+    except (OSError, pcapfile.PcapError) as e:
+        raise SystemExit(f'Failed to read {args.pcap}: {e}')
+    sources = {src for _, src, _, _ in datagrams}
+    print(f'{args.pcap}: {len(datagrams)} UDP datagrams from {len(sources)} sources ({reader.skipped} other packets '
+          f'skipped)')
+    mcast_addr_space = args.multicast_addr_space or DEFAULT_MCAST_ADDR_SPACE
+    if args.target == 'translator' and mcast_addr_space.num_addresses - 2 < len(sources):
+        raise SystemExit(f'{mcast_addr_space} cannot host {len(sources)} sources.')
+    try:
+        result = bench_replay(datagrams, args.target, args.speed, args.loops, mcast_addr_space, args.unicast_port,
+                              args.multicast_port, args.batch_size, (args.gateway_ip, args.gateway_port),
+                              args.output_port)
+    except ValueError as e:
+        raise SystemExit(str(e))
+    print(f'sent     {result["sent"]:10d} packets {result["sent_bytes"]:12d} bytes {result["sent_pps"]:10.0f} pps, '
+          f'lateness mean {result["lateness_us"]:.0f} us max {result["max_lateness_us"]:.0f} us')
+    print(f'received {result["recvd"]:10d} packets {result["recvd_bytes"]:12d} bytes {result["pps"]:10.0f} pps '
+          f'{result["mbps"]:8.1f} Mbit/s')
+    print(f'integrity: {result["intact"]} intact, {result["missing"]} missing, {result["corrupted"]} corrupted, '
+          f'{result["duplicated"]} duplicated')
+    if result['corrupted'] or result['duplicated']:
+        raise SystemExit(1)
+
+
+def _fill_bitmap(size, occupancy):
+    """
+    Create an AddrBitmap with the given fraction of its indexes allocated at random.
+
+    :param size: Number of indexes.
+    :param occupancy: Fraction of indexes to allocate.
+
+    :return: The AddrBitmap.
+    """
+    num_allocated = round(size * occupancy)
+    # Either set the allocated bits in an empty bitmap or clear the free bits in a full one, whichever is fewer bits.
+    invert = num_allocated > size // 2
+    data = bytearray(b'\xff' if invert else b'\x00') * ((size + 7) // 8)
+    for i in random.sample(range(size), size - num_allocated if invert else num_allocated):
+        data[i >> 3] ^= 1 << (i & 7)
+    return AddrBitmap.from_bytes(size, data)
+
+
+def _clients(num_clients):
+    """
+    :return: A list of num_clients distinct (ip, port) client addresses.
+    """
+    return [(f'10.{i >> 16 & 255}.{i >> 8 & 255}.{i & 255}', 5000 + (i >> 24)) for i in range(num_clients)]
+
+
+def bench_allocator(mcast_addr_space, policy, occupancy, num_ops):
+    """
+    Measure the time it takes to allocate and to release a multicast address at a given occupancy of the address space.
+    Each allocation is preceded by the release of a random allocated address s.t. the occupancy stays constant.
+
+    :param mcast_addr_space: The multicast address space.
+    :param policy: Name of the allocation policy.
+    :param occupancy: Fraction of the address space that is allocated.
+    :param num_ops: Number of allocations (and releases) to time.
+
+    :return: A (mean allocation time, max allocation time, mean release time) tuple, in microseconds.
+    """
+    bitmap = _fill_bitmap(mcast_addr_space.num_addresses, occupancy)
+    alloc_policy = ALLOC_POLICIES[policy]()
+    allocated = []
+    while len(allocated) < num_ops:
+        idx = random.randrange(bitmap.size)
+        if bitmap.is_set(idx):
+            allocated.append(idx)
+    clients = _clients(num_ops)
+    alloc_total = alloc_max = release_total = 0.0
+    for idx, client in zip(allocated, clients):
+        t0 = time.perf_counter()
+        bitmap.clear(idx)
+        t1 = time.perf_counter()
+        bitmap.set(alloc_policy.select(bitmap, client))
+        t2 = time.perf_counter()
+        release_total += t1 - t0
+        alloc_total += t2 - t1
+        alloc_max = max(alloc_max, t2 - t1)
+    return alloc_total / num_ops * 1e6, alloc_max * 1e6, release_total / num_ops * 1e6
+
+
+def bench_assignment(mcast_addr_space, policy, occupancy, evict_fraction=0.1):
+    """
+    Measure how stable a policy's assignments of multicast addresses to clients are: the fraction of clients that are
+    assigned the same address by two allocators that see the clients in a different order (e.g., two translators that
+    do not share an allocator, or a translator before and after a cold restart), and the fraction of evicted clients
+    that get their previous address back when they return (in random order).
+
+    :param mcast_addr_space: The multicast address space.
+    :param policy: Name of the allocation policy.
+    :param occupancy: Fraction of the address space that is allocated to the clients.
+    :param evict_fraction: Fraction of the clients that are evicted and return.
+
+    :return: A (same address on both allocators, same address after returning, mean allocation time in microseconds)
+    tuple.
+    """
+    clients = _clients(round((mcast_addr_space.num_addresses - 2) * occupancy))
+    first = McastAddrAllocator(mcast_addr_space, policy)
+    t0 = time.perf_counter()
+    addrs = [first.alloc(client)[0] for client in clients]
+    alloc_us = (time.perf_counter() - t0) / len(clients) * 1e6
+    second = McastAddrAllocator(mcast_addr_space, policy)
+    shuffled = random.sample(range(len(clients)), len(clients))
+    same = sum(second.alloc(clients[i])[0] == addrs[i] for i in shuffled)
+    evicted = random.sample(range(len(clients)), round(len(clients) * evict_fraction))
+    for i in evicted:
+        first.free(clients[i])
+    random.shuffle(evicted)
+    returned = sum(first.alloc(clients[i])[0] == addrs[i] for i in evicted)
+    return same / len(clients), returned / max(1, len(evicted)), alloc_us
+
+
+def _cmd_assignment(args):
+    for occupancy in args.occupancies:
+        for policy in args.policies:
+            same, returned, alloc_us = bench_assignment(args.addr_space, policy, occupancy)
+            print(f'{occupancy * 100:6.2f}% occupancy of {args.addr_space}, {policy:>10} policy: '
+                  f'{same * 100:6.2f}% same address on two translators, {returned * 100:6.2f}% same address after '
+                  f'eviction, {alloc_us:6.2f} us per allocation')
+
+
+def _cmd_allocator(args):
+    for occupancy in args.occupancies:
+        for policy in args.policies:
+            alloc_mean, alloc_max, release_mean = bench_allocator(args.addr_space, policy, occupancy, args.ops)
+            print(f'{occupancy * 100:8.4f}% occupancy of {args.addr_space}, {policy:>10} policy: alloc '
+                  f'{alloc_mean:7.2f} us (max {alloc_max:8.2f} us), release {release_mean:5.2f} us')
+
+
+def bench_per_packet(num_flows, num_packets, mcast_port=9002):
+    """
+    Measure the Python overhead of looking up the destination of a packet, excluding the system calls: once with the
+    destination formatted for every packet (from the multicast address in the FIB), and once with the destination
+    precomputed in the FIB (as the Translator does).
+
+    :param num_flows: Number of flows in the FIB.
+    :param num_packets: Number of packets to look up (spread across the flows at random).
+    :param mcast_port: Multicast destination port.
+
+    :return: A (per packet time with formatting, per packet time with precomputed destination) tuple, in nanoseconds.
+    """
+    mcast_addr_space = ipaddress.IPv4Network('232.0.0.0/8')
+    clients = [(f'10.{i >> 16 & 255}.{i >> 8 & 255}.{i & 255}', 5000 + i % 1000) for i in range(num_flows)]
+    fib = dict()
+    for i, client in enumerate(clients):
+        mcast_addr = mcast_addr_space[i + 1]
+        fib[client] = Flow(client, mcast_addr, (str(mcast_addr), mcast_port), None, 0.0)
+    packets = [random.choice(clients) for _ in range(num_packets)]
+
+    def formatted(now):
+        for src_addr in packets:
+            flow = fib.get(src_addr, None)
+            flow.last_seen = now
+            dst_addr = (str(flow.mcast_addr), mcast_port)
+
+    def precomputed(now):
+        for src_addr in packets:
+            flow = fib.get(src_addr, None)
+            flow.last_seen = now
+            dst_addr = flow.dst_addr
+
+    results = []
+    for loop in (formatted, precomputed):
+        t0 = time.perf_counter()
+        loop(time.monotonic())
+        results.append((time.perf_counter() - t0) / num_packets * 1e9)
+    return tuple(results)
+
+
+def _cmd_per_packet(args):
+    formatted, precomputed = bench_per_packet(args.flows, args.packets)
+    print(f'destination formatted per packet: {formatted:6.0f} ns/packet')
+    print(f'destination precomputed in FIB:   {precomputed:6.0f} ns/packet ({formatted / precomputed:.2f}x faster)')
+
+
+class _SlowStream:
+    """
+    A stream that blocks for a given time per write, like a console or the journal under load.
+    """
+
+    def __init__(self, write_latency_s):
+        self._write_latency_s = write_latency_s
+
+    def write(self, s):
+        time.sleep(self._write_latency_s)
+
+    def flush(self):
+        pass
+
+
+def bench_new_flow_logging(mode, num_flows, write_latency_us):
+    """
+    Measure how long the translation thread is held up per new flow (i.e., allocating a multicast address for it and
+    logging the allocation) during a burst of new flows, with a log destination that takes a given time per message.
+
+    :param mode: 'off' to not log at all (the baseline), 'sync' to write log messages on the translation thread (as a
+    plain StreamHandler or print() would), or 'async' to queue them for a background thread with rate limiting (see
+    logsetup).
+    :param num_flows: Number of new flows in the burst.
+    :param write_latency_us: Time the log destination takes per message, in microseconds.
+
+    :return: A (mean, 99th percentile, max) tuple of the time per new flow in microseconds, and the number of messages
+    that were written.
+    """
+    written = []
+
+    class _CountingStream(_SlowStream):
+        def write(self, s):
+            written.append(None)
+            super().write(s)
+
+    stream = _CountingStream(write_latency_us / 1e6)
+    if mode == 'async':
+        logsetup.setup(stream=stream)
+    elif mode == 'off':
+        logging.getLogger().handlers = []
+        logging.getLogger().setLevel(logging.WARNING)
+    else:
+        handler = logging.StreamHandler(stream)
+        handler.setFormatter(logsetup.TextFormatter())
+        logging.getLogger().handlers = [handler]
+        logging.getLogger().setLevel(logging.INFO)
+    t = BenchmarkTranslator('127.0.0.1', 0, ipaddress.IPv4Network('232.0.0.0/8'), 9002)
+    clients = [(f'10.{i >> 16 & 255}.{i >> 8 & 255}.{i & 255}', 5000) for i in range(num_flows)]
+    durations = []
+    now = time.monotonic()
+    for client in clients:
+        t0 = time.perf_counter()
+        t._alloc_mcast_addr(client, now)
+        durations.append(time.perf_counter() - t0)
+    if mode == 'async':
+        logsetup.shutdown()
+    logging.getLogger().handlers = []
+    durations.sort()
+    return (sum(durations) / num_flows * 1e6, durations[int(num_flows * 0.99)] * 1e6, durations[-1] * 1e6,
+            len(written))
+
+
+def _cmd_logging(args):
+    for mode in ('off', 'sync', 'async'):
+        mean, p99, worst, written = bench_new_flow_logging(mode, args.flows, args.write_latency)
+        print(f'{mode:>5} logging: {mean:7.2f} us per new flow (p99 {p99:7.2f} us, max {worst:8.2f} us), '
+              f'{written} log messages written')
+
+
+def bench_flood(max_new_flows_per_s, num_packets, pps):
+    """
+    Measure how long the translation thread takes per packet during a flood of packets from distinct (spoofed) sources,
+    each of which is a new flow, with or without a limit on the admission rate of new flows. The packets are handed to
+    the translator directly (at timestamps spaced as if they arrived at pps packets per second), so the time excludes
+    the system calls.
+
+    :param max_new_flows_per_s: The Translator's max_new_flows_per_s (None for no admission control).
+    :param num_packets: Number of packets in the flood.
+    :param pps: Packet rate of the flood.
+
+    :return: The mean time per packet in microseconds, and the number of flows that were allocated a multicast
+    address.
+    """
+    logsetup.setup(stream=_SlowStream(0.0))
+    t = BenchmarkTranslator('127.0.0.1', 0, ipaddress.IPv4Network('232.0.0.0/8'), 9002,
+                            max_new_flows_per_s=max_new_flows_per_s)
+    clients = [(f'10.{i >> 16 & 255}.{i >> 8 & 255}.{i & 255}', 5000) for i in range(num_packets)]
+    now = time.monotonic()
+    t0 = time.perf_counter()
+    for i, client in enumerate(clients):
+        t._handle_new_flow(client, now + i / pps)
+    elapsed = time.perf_counter() - t0
+    logsetup.shutdown()
+    logging.getLogger().handlers = []
+    return elapsed / num_packets * 1e6, len(t._fib)
+
+
+def bench_policer(num_packets, payload_size=1316):
+    """
+    Measure the Python overhead per packet of enforcing a flow's packet and byte rate limits.
+
+    :param num_packets: Number of packets to police.
+    :param payload_size: Payload size of the packets.
+
+    :return: The time per packet in nanoseconds.
+    """
+    policer = AdmissionController(max_flow_pps=1e9, max_flow_bytes_per_s=1e12).policer(time.monotonic())
+    now = time.monotonic()
+    t0 = time.perf_counter()
+    for i in range(num_packets):
+        policer.admit(payload_size, now + i * 1e-6)
+    return (time.perf_counter() - t0) / num_packets * 1e9
+
+
+def _cmd_flood(args):
+    for max_new_flows_per_s in (None, args.max_new_flow_rate):
+        per_pkt, allocated = bench_flood(max_new_flows_per_s, args.packets, args.pps)
+        limit = 'no admission limit' if max_new_flows_per_s is None else f'{max_new_flows_per_s:g} new flows/s'
+        print(f'{limit:>22}: {per_pkt:7.2f} us per flood packet, {allocated:8d} multicast addresses allocated')
+    print(f'policing a flow: {bench_policer(args.packets):6.0f} ns/packet')
+
+
+def bench_snapshot(num_flows, mcast_addr_space):
+    """
+    Measure the time it takes to snapshot the allocator's state to a file and to restore it (i.e., the recovery time
+    of a warm restart), with every flow's stream published (i.e., with an access code on record).
+
+    :param num_flows: Number of flows (allocations).
+    :param mcast_addr_space: The multicast address space.
+
+    :return: A (snapshot time, restore time) tuple in milliseconds, and the size of the snapshot in bytes.
+    """
+    allocator = McastAddrAllocator(mcast_addr_space)
+    for i in range(num_flows):
+        mcast_addr, _ = allocator.alloc((f'10.{i >> 16 & 255}.{i >> 8 & 255}.{i & 255}', 5000 + (i & 1023)))
+        allocator.set_access_code(mcast_addr, f'{i:040d}')
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = f'{tmp_dir}/snapshot'
+        t0 = time.perf_counter()
+        snapshot.write(path, allocator.snapshot())
+        t1 = time.perf_counter()
+        restored = McastAddrAllocator(mcast_addr_space)
+        with open(path, 'rb') as f:
+            num_restored = restored.restore(f.read())
+        t2 = time.perf_counter()
+        size = len(open(path, 'rb').read())
+    assert num_restored == num_flows
+    return (t1 - t0) * 1e3, (t2 - t1) * 1e3, size
+
+
+def _cmd_snapshot(args):
+    for num_flows in args.flows:
+        take, restore, size = bench_snapshot(num_flows, args.addr_space)
+        print(f'{num_flows:8d} flows: snapshot {take:8.1f} ms, restore {restore:8.1f} ms, {size / 2 ** 20:6.1f} MiB')
+
+
+def bench_cluster(backend_url, num_nodes, num_flows, mcast_addr_space, policy):
+    """
+    Measure the time it takes the nodes of a cluster to allocate (and claim) and to free (and release) multicast
+    addresses through a cluster backend, with all nodes allocating concurrently (from a thread each), and check that no
+    address is allocated by two nodes.
+
+    :param backend_url: URL of the cluster backend.
+    :param num_nodes: Number of nodes.
+    :param num_flows: Number of flows each node allocates an address for.
+    :param mcast_addr_space: The multicast address space.
+    :param policy: Name of the allocation policy.
+
+    :return: A (mean allocation time, mean free time) tuple in microseconds, and the number of addresses that have been
+    allocated by more than one node.
+    """
+    nodes = [ClusterAllocator(mcast_addr_space, policy, backend_url, f'bench-{i}') for i in range(num_nodes)]
+    for node in nodes:
+        node.join()
+    clients = _clients(num_flows)
+    addrs = [None] * num_nodes
+    times = [None] * num_nodes
+    # The nodes free their addresses once all of them have allocated theirs.
+    allocated = threading.Barrier(num_nodes)
+
+    def run(i):
+        t0 = time.perf_counter()
+        addrs[i] = [nodes[i].alloc(client)[0] for client in clients]
+        alloc_s = time.perf_counter() - t0
+        allocated.wait()
+        t0 = time.perf_counter()
+        for client in clients:
+            nodes[i].free(client)
+        times[i] = (alloc_s, time.perf_counter() - t0)
+
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(num_nodes)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    for node in nodes:
+        node.leave()
+    addrs = [addr for node_addrs in addrs for addr in node_addrs if addr is not None]
+    num_ops = num_nodes * num_flows
+    return (sum(t[0] for t in times) / num_ops * 1e6, sum(t[1] for t in times) / num_ops * 1e6,
+            len(addrs) - len(set(addrs)))
+
+
+def _cmd_cluster(args):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        backend_urls = ['memory://bench', f'sqlite://{tmp_dir}/cluster.db']
+        if cluster.fakeredis is not None:
+            backend_urls.append('fakeredis://bench')
+        for backend_url in args.backends or backend_urls:
+            alloc_us, free_us, conflicts = bench_cluster(backend_url, args.nodes, args.flows, args.addr_space,
+                                                         args.policy)
+            print(f'{backend_url.partition("://")[0]:>8} backend, {args.nodes} nodes: alloc {alloc_us:8.1f} us, free '
+                  f'{free_us:8.1f} us, {conflicts} conflicts')
+
+
+def _cmd_datapath(args):
+    mcast_addr_space = args.multicast_addr_space
+    if mcast_addr_space is None:
+        mcast_addr_space = DEFAULT_IPV6_MCAST_ADDR_SPACE if args.ipv6 else DEFAULT_MCAST_ADDR_SPACE
+    if mcast_addr_space.num_addresses - 2 < args.sources:
+        raise SystemExit(f'{mcast_addr_space} cannot host {args.sources} sources.')
+    srv_ip = '::1' if args.ipv6 else '127.0.0.1'
+    baseline = None
+    for batch_size in args.batch_sizes:
+        pps, mbps = bench_datapath(args.unicast_port, mcast_addr_space, args.multicast_port, batch_size, args.sources,
+                                   args.senders, args.payload_size, args.duration, srv_ip=srv_ip)
+        baseline = pps if baseline is None else baseline
+        print(f'batch size {batch_size:4d}: {pps:12.0f} pps {mbps:10.1f} Mbit/s ({pps / baseline:.2f}x)')
+
+
+if __name__ == '__main__':
+    desc = 'Benchmark the unicast-to-multicast translator on this machine.'
+    ap = argparse.ArgumentParser(description=desc)
+    ap.add_argument('--unicast-port', type=int, default=19001,
+                    help='Port number for the translator to listen for unicast on. Default: %(default)d')
+    ap.add_argument('--multicast-addr-space', type=ipaddress.ip_network,
+                    help=f'Multicast address space for the translator (IPv4 or IPv6). Default: '
+                         f'{DEFAULT_MCAST_ADDR_SPACE} ({DEFAULT_IPV6_MCAST_ADDR_SPACE} with --ipv6)')
+    ap.add_argument('--multicast-port', type=int, default=19002,
+                    help='Multicast destination port for the translator. Default: %(default)d')
+    subparsers = ap.add_subparsers(dest='benchmark', required=True)
+
+    h = 'Packets per second forwarded by the per-packet datapath and the batched (recvmmsg/sendmmsg) datapath.'
+    sp = subparsers.add_parser('datapath', help=h, description=h)
+    sp.add_argument('--batch-sizes', type=int, nargs='+', default=[1, 8, 32, 64],
+                    help='Batch sizes to benchmark (1 is the per-packet datapath). Default: %(default)s')
+    sp.add_argument('--sources', type=int, default=8, help='Number of unicast sources. Default: %(default)d')
+    sp.add_argument('--senders', type=int, default=2,
+                    help='Number of processes to spread the unicast sources across. Default: %(default)d')
+    sp.add_argument('--payload-size', type=int, default=1316,
+                    help='UDP payload size (1316 bytes is 7 MPEG-TS packets). Default: %(default)d')
+    sp.add_argument('--duration', type=float, default=5.0,
+                    help='Measurement window in seconds (per batch size). Default: %(default)s')
+    sp.add_argument('--ipv6', action='store_true',
+                    help='Send the unicast packets to the translator over IPv6 (::1) and, unless another multicast '
+                         'address space is given, translate them to IPv6 SSM.')
+    sp.set_defaults(func=_cmd_datapath)
+
+    h = 'Throughput, loss, reordering and forwarding latency of the translator, driven by synthetic unicast sources ' \
+        'at a given packet rate, optionally compared with stored baselines (regression mode).'
+    sp = subparsers.add_parser('load', help=h, description=h)
+    sp.add_argument('--batch-sizes', type=int, nargs='+', default=[1, 32],
+                    help='Batch sizes to benchmark (1 is the per-packet datapath). Default: %(default)s')
+    sp.add_argument('--sources', type=int, default=8, help='Number of unicast sources. Default: %(default)d')
+    sp.add_argument('--senders', type=int, default=2,
+                    help='Number of processes to spread the unicast sources across. Default: %(default)d')
+    sp.add_argument('--payload-size', type=int, default=1316,
+                    help='UDP payload size (1316 bytes is 7 MPEG-TS packets). Default: %(default)d')
+    sp.add_argument('--rate', type=float, default=20000,
+                    help='Total packets per second of the sources (0 to send as fast as possible). '
+                         'Default: %(default)g')
+    sp.add_argument('--duration', type=float, default=5.0,
+                    help='Measurement window in seconds (per batch size). Default: %(default)s')
+    sp.add_argument('--ipv6', action='store_true',
+                    help='Send the unicast packets to the translator over IPv6 (::1) and, unless another multicast '
+                         'address space is given, translate them to IPv6 SSM.')
+    sp.add_argument('--baseline', default=None,
+                    help='JSON file of baselines to compare the results with (per scenario). The benchmark exits with '
+                         'status 1 if a result falls short of its baseline. Default: %(default)s')
+    sp.add_argument('--save-baseline', action='store_true',
+                    help='Store the results as the baselines in the --baseline file instead of comparing with them.')
+    sp.add_argument('--tolerance', type=float, default=0.1,
+                    help='Fraction by which the throughput may fall short of the baseline (and the 99th percentile '
+                         'latency may exceed it). Default: %(default)s')
+    sp.set_defaults(func=_cmd_load)
+
+    h = 'Replay the UDP datagrams of a packet capture (pcap or pcapng) to the translator, or to the data path of an ' \
+        'AMT gateway, and check the integrity of the payloads that come out of it. The integrity check fails (exit ' \
+        'status 1) if payloads are corrupted or duplicated.'
+    sp = subparsers.add_parser('replay', help=h, description=h)
+    sp.add_argument('--pcap', default=DEFAULT_REPLAY_PCAP, help='Packet capture to replay. Default: %(default)s')
+    sp.add_argument('--speed', type=float, default=1.0,
+                    help='Factor by which to speed up the replay (1 replays at the original timing, 0 as fast as '
+                         'possible). Default: %(default)g')
+    sp.add_argument('--loops', type=int, default=1,
+                    help='Number of times to replay the capture. Default: %(default)d')
+    sp.add_argument('--target', choices=['translator', 'amt'], default='translator',
+                    help='Replay to a translator on the loopback interface (one flow per captured source), or to the '
+                         'data path of an AMT gateway (encapsulated in AMT Multicast Data messages). Default: '
+                         '%(default)s')
+    sp.add_argument('--batch-size', type=int, default=32,
+                    help='Batch size of the translator. Default: %(default)d')
+    sp.add_argument('--gateway-ip', default='127.0.0.1',
+                    help='IP address of the AMT gateway (with --target amt). Default: %(default)s')
+    sp.add_argument('--gateway-port', type=int, default=_AMT_PORT,
+                    help='Port of the AMT gateway\'s AMT socket (with --target amt). Default: %(default)d')
+    sp.add_argument('--output-port', type=int, default=19003,
+                    help='Port on the loopback interface to which the AMT gateway forwards the payloads (with '
+                         '--target amt). Default: %(default)d')
+    sp.set_defaults(func=_cmd_replay)
+
+    h = 'Fraction of clients that are assigned the same multicast address by two translators that do not share an ' \
+        'allocator (i.e., do not collide) and after eviction, per allocation policy.'
+    sp = subparsers.add_parser('assignment', help=h, description=h)
+    sp.add_argument('--addr-space', type=ipaddress.ip_network, default=ipaddress.IPv4Network('232.0.0.0/16'),
+                    help='Multicast address space to allocate from. Default: %(default)s')
+    sp.add_argument('--occupancies', type=float, nargs='+', default=[0.01, 0.1, 0.5, 0.9],
+                    help='Fractions of the address space that are allocated. Default: %(default)s')
+    sp.add_argument('--policies', choices=list(ALLOC_POLICIES), nargs='+', default=list(ALLOC_POLICIES),
+                    help='Allocation policies to benchmark. Default: %(default)s')
+    sp.set_defaults(func=_cmd_assignment)
+
+    h = 'Python overhead per packet of looking up its destination in the FIB (excluding system calls).'
+    sp = subparsers.add_parser('per-packet', help=h, description=h)
+    sp.add_argument('--flows', type=int, default=1000, help='Number of flows in the FIB. Default: %(default)d')
+    sp.add_argument('--packets', type=int, default=1000000,
+                    help='Number of packets to look up. Default: %(default)d')
+    sp.set_defaults(func=_cmd_per_packet)
+
+    h = 'Time to allocate and release a multicast address at different occupancies of the address space.'
+    sp = subparsers.add_parser('allocator', help=h, description=h)
+    sp.add_argument('--addr-space', type=ipaddress.IPv4Network, default=ipaddress.IPv4Network('232.0.0.0/8'),
+                    help='Multicast address space to allocate from. Default: %(default)s')
+    sp.add_argument('--occupancies', type=float, nargs='+', default=[0.01, 0.5, 0.9999],
+                    help='Fractions of the address space that are allocated. Default: %(default)s')
+    sp.add_argument('--policies', choices=list(ALLOC_POLICIES), nargs='+', default=list(ALLOC_POLICIES),
+                    help='Allocation policies to benchmark. Default: %(default)s')
+    sp.add_argument('--ops', type=int, default=10000,
+                    help='Number of allocations (and releases) per occupancy and policy. Default: %(default)d')
+    sp.set_defaults(func=_cmd_allocator)
+
+    h = 'Time the translation thread is held up per new flow during a burst of new flows, with log messages written ' \
+        'synchronously or queued for a background thread (with rate limiting).'
+    sp = subparsers.add_parser('logging', help=h, description=h)
+    sp.add_argument('--flows', type=int, default=100000, help='Number of new flows in the burst. Default: %(default)d')
+    sp.add_argument('--write-latency', type=float, default=20.0,
+                    help='Time the log destination takes per message, in microseconds. Default: %(default)s')
+    sp.set_defaults(func=_cmd_logging)
+
+    h = 'Time the translation thread takes per packet during a flood of packets from distinct (spoofed) sources, ' \
+        'with and without admission control, and the overhead of enforcing per-flow rate limits.'
+    sp = subparsers.add_parser('flood', help=h, description=h)
+    sp.add_argument('--packets', type=int, default=200000, help='Number of packets in the flood. Default: %(default)d')
+    sp.add_argument('--pps', type=float, default=1e6, help='Packet rate of the flood. Default: %(default)g')
+    sp.add_argument('--max-new-flow-rate', type=float, default=1000.0,
+                    help='Admission rate of new flows to compare against no admission control. Default: %(default)g')
+    sp.set_defaults(func=_cmd_flood)
+
+    h = 'Time to snapshot the multicast address allocations to a file and to restore them (warm restart).'
+    sp = subparsers.add_parser('snapshot', help=h, description=h)
+    sp.add_argument('--flows', type=int, nargs='+', default=[1000, 100000],
+                    help='Numbers of flows (allocations) to snapshot. Default: %(default)s')
+    sp.add_argument('--addr-space', type=ipaddress.ip_network, default=ipaddress.IPv4Network('232.0.0.0/8'),
+                    help='Multicast address space to allocate from (IPv4 or IPv6). Default: %(default)s')
+    sp.set_defaults(func=_cmd_snapshot)
+
+    h = 'Time the nodes of a cluster take to allocate and free multicast addresses through each cluster backend ' \
+        '(allocating concurrently), and the number of conflicting allocations (which must be 0).'
+    sp = subparsers.add_parser('cluster', help=h, description=h)
+    sp.add_argument('--backends', nargs='+', default=None,
+                    help='URLs of the cluster backends, e.g., redis://localhost:6379/0. Default: memory://, an '
+                         'SQLite database in a temporary directory and, if the fakeredis package is installed, '
+                         'fakeredis:// (the Redis backend\'s Lua scripts on an in-process stand-in for Redis)')
+    sp.add_argument('--nodes', type=int, default=3, help='Number of nodes. Default: %(default)d')
+    sp.add_argument('--flows', type=int, default=2000, help='Number of flows per node. Default: %(default)d')
+    sp.add_argument('--addr-space', type=ipaddress.ip_network, default=ipaddress.IPv4Network('232.0.0.0/20'),
+                    help='Multicast address space to allocate from. Default: %(default)s')
+    sp.add_argument('--policy', choices=list(ALLOC_POLICIES), default='random',
+                    help='Allocation policy. Default: %(default)s')
+    sp.set_defaults(func=_cmd_cluster)
+
+    args = ap.parse_args()
+    if getattr(args, 'save_baseline', False) and args.baseline is None:
+        ap.error('--save-baseline requires --baseline.')
+    args.func(args)
@@ -0,0 +1,709 @@
+"""
+Active-active clustering: several translators (nodes) that allocate from the same multicast address space.
+
+The nodes record their allocations (claims) in a shared backend, which hands out each multicast address to one node at a
+time. Every node holds a lease on its claims, which it renews in the background (see LeaseKeeper). If a node dies, its
+lease expires after the lease TTL and the other nodes may claim its addresses. A node that fails to renew its lease
+gives up its claims (and stops forwarding their flows) after half the TTL, i.e., before the backend lets other nodes
+claim them. Claims are keyed by multicast address, so the nodes may use different (e.g., overlapping) address spaces.
+
+The backend is only consulted when a new flow is allocated an address and when a flow is evicted, never per packet. The
+backends are (see open_backend()):
+
+- memory://[name]: in-process, i.e., for the Translators of a single process (and for testing);
+- sqlite:///path/to/file.db: an SQLite database, which serializes claims with file locks, i.e., for the nodes on one
+  host (the database is in write-ahead logging mode, which does not work on network file systems);
+- redis://host:port/db: a Redis server, on which claims are made by Lua scripts. Requires the redis package;
+- fakeredis://[name]: an in-process stand-in for a Redis server, which runs the same Lua scripts (for testing). Requires
+  the fakeredis and lupa packages.
+"""
+import ipaddress
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+try:
+    import fakeredis
+except ImportError:
+    fakeredis = None
+
+import constants
+from allocator import AllocatorManager, McastAddrAllocator
+
+logger = logging.getLogger(__name__)
+
+# Outcomes of registering a node's lease: the node's lease was newly acquired (the claims of its previous lease, if any,
+# have been dropped), its lease was renewed, or the node ID is leased by another translator.
+LEASE_ACQUIRED = 'acquired'
+LEASE_RENEWED = 'renewed'
+LEASE_TAKEN = 'taken'
+
+
+class ClusterError(Exception):
+    """
+    The cluster backend failed (e.g., it is unreachable), or the node ID is in use by another translator.
+    """
+    pass
+
+
+class MemoryBackend:
+    """
+    Keeps the claims in memory, for the nodes (ClusterAllocators) of a single process. The other backends have the
+    same methods.
+    """
+
+    def __init__(self):
+        # Maps node IDs to (token, expiry) tuples of their leases.
+        self._leases = dict()
+        # Maps multicast addresses to (node ID, client) tuples.
+        self._claims = dict()
+        self._lock = threading.Lock()
+
+    def _live(self, node_id, now):
+        lease = self._leases.get(node_id, None)
+        return lease is not None and lease[1] > now
+
+    def register(self, node_id, token, ttl_s):
+        """
+        Acquire or renew a node's lease. Acquiring a lease drops the claims of the node's previous lease (if any).
+
+        :param node_id: The node's ID.
+        :param token: Token of the node's incarnation (only the incarnation holding the lease may renew it).
+        :param ttl_s: Time after which the lease expires unless it is renewed.
+
+        :return: LEASE_ACQUIRED, LEASE_RENEWED, or LEASE_TAKEN if the node ID is leased by another incarnation.
+        """
+        now = time.monotonic()
+        with self._lock:
+            lease = self._leases.get(node_id, None)
+            if lease is not None and lease[1] > now:
+                if lease[0] != token:
+                    return LEASE_TAKEN
+                self._leases[node_id] = (token, now + ttl_s)
+                return LEASE_RENEWED
+            self._claims = {addr: claim for addr, claim in self._claims.items() if claim[0] != node_id}
+            self._leases[node_id] = (token, now + ttl_s)
+            return LEASE_ACQUIRED
+
+    def claim(self, node_id, token, addr, client):
+        """
+        Claim a multicast address for a node, unless it is claimed by another node whose lease has not expired.
+
+        :param node_id: The node's ID.
+        :param token: Token of the node's incarnation, which must hold the node's lease.
+        :param addr: The multicast address (str).
+        :param client: The unicast client the address is allocated to (str, for the record).
+
+        :return: True if the address has been claimed.
+        """
+        now = time.monotonic()
+        with self._lock:
+            lease = self._leases.get(node_id, None)
+            if lease is None or lease[0] != token or lease[1] <= now:
+                return False
+            claim = self._claims.get(addr, None)
+            if claim is not None and claim[0] != node_id and self._live(claim[0], now):
+                return False
+            self._claims[addr] = (node_id, client)
+            return True
+
+    def release(self, node_id, addr):
+        """
+        Release a node's claim of a multicast address (if it holds the claim).
+
+        :param node_id: The node's ID.
+        :param addr: The multicast address (str).
+
+        :return: None.
+        """
+        with self._lock:
+            claim = self._claims.get(addr, None)
+            if claim is not None and claim[0] == node_id:
+                del self._claims[addr]
+
+    def claimed(self):
+        """
+        :return: A set of the multicast addresses (str) claimed by nodes whose leases have not expired.
+        """
+        now = time.monotonic()
+        with self._lock:
+            return {addr for addr, claim in self._claims.items() if self._live(claim[0], now)}
+
+    def deregister(self, node_id, token):
+        """
+        Release a node's lease and all of its claims.
+
+        :param node_id: The node's ID.
+        :param token: Token of the node's incarnation (which must hold the lease, otherwise nothing is released).
+
+        :return: None.
+        """
+        with self._lock:
+            if self._leases.get(node_id, (None, 0.0))[0] != token:
+                return
+            del self._leases[node_id]
+            self._claims = {addr: claim for addr, claim in self._claims.items() if claim[0] != node_id}
+
+    def close(self):
+        """
+        Close the connection to the backend (if any).
+
+        :return: None.
+        """
+        pass
+
+
+class SQLiteBackend:
+    """
+    Keeps the claims in an SQLite database. Every operation is a transaction that takes the database's write lock up
+    front (BEGIN IMMEDIATE), so claims are serialized across processes (on the same host). Lease expiry is based on the
+    wall clock.
+    """
+
+    def __init__(self, path, timeout_s):
+        """
+        :param path: Path of the database file (created if it does not exist).
+        :param timeout_s: Maximum time to wait for the database's lock.
+        """
+        try:
+            # The connection is used by the translation thread and by the LeaseKeeper's thread (one at a time).
+            self._db = sqlite3.connect(path, timeout=timeout_s, isolation_level=None, check_same_thread=False)
+            # With write-ahead logging, a transaction only holds the lock for as long as it takes to append to the log
+            # (rather than for syncing the database to disk), which keeps the nodes from starving each other.
+            self._db.execute('PRAGMA journal_mode=WAL')
+            self._db.execute('PRAGMA synchronous=NORMAL')
+            self._db.execute('CREATE TABLE IF NOT EXISTS leases (node_id TEXT PRIMARY KEY, token TEXT NOT NULL, '
+                             'expires REAL NOT NULL)')
+            self._db.execute('CREATE TABLE IF NOT EXISTS claims (addr TEXT PRIMARY KEY, node_id TEXT NOT NULL, '
+                             'client TEXT NOT NULL)')
+            self._db.execute('CREATE INDEX IF NOT EXISTS claims_node_id ON claims (node_id)')
+        except sqlite3.Error as e:
+            raise ClusterError(f'cannot open the SQLite database {path}: {e}')
+        self._lock = threading.Lock()
+
+    def _transaction(self, ops):
+        """
+        Run ops (a callable that takes the connection and the current time) in a write transaction.
+
+        :return: Whatever ops returns.
+        """
+        with self._lock:
+            try:
+                self._db.execute('BEGIN IMMEDIATE')
+                try:
+                    result = ops(self._db, time.time())
+                except BaseException:
+                    self._db.execute('ROLLBACK')
+                    raise
+                self._db.execute('COMMIT')
+                return result
+            except sqlite3.Error as e:
+                raise ClusterError(f'SQLite backend failed: {e}')
+
+    def register(self, node_id, token, ttl_s):
+        def ops(db, now):
+            lease = db.execute('SELECT token, expires FROM leases WHERE node_id = ?', (node_id,)).fetchone()
+            if lease is not None and lease[1] > now:
+                if lease[0] != token:
+                    return LEASE_TAKEN
+                db.execute('UPDATE leases SET expires = ? WHERE node_id = ?', (now + ttl_s, node_id))
+                return LEASE_RENEWED
+            db.execute('DELETE FROM claims WHERE node_id = ?', (node_id,))
+            db.execute('INSERT OR REPLACE INTO leases VALUES (?, ?, ?)', (node_id, token, now + ttl_s))
+            return LEASE_ACQUIRED
+        return self._transaction(ops)
+
+    def claim(self, node_id, token, addr, client):
+        def ops(db, now):
+            if db.execute('SELECT 1 FROM leases WHERE node_id = ? AND token = ? AND expires > ?',
+                          (node_id, token, now)).fetchone() is None:
+                return False
+            owner = db.execute('SELECT claims.node_id, leases.expires FROM claims LEFT JOIN leases USING (node_id) '
+                               'WHERE addr = ?', (addr,)).fetchone()
+            if owner is not None and owner[0] != node_id and owner[1] is not None and owner[1] > now:
+                return False
+            db.execute('INSERT OR REPLACE INTO claims VALUES (?, ?, ?)', (addr, node_id, client))
+            return True
+        return self._transaction(ops)
+
+    def release(self, node_id, addr):
+        self._transaction(lambda db, now: db.execute('DELETE FROM claims WHERE addr = ? AND node_id = ?',
+                                                     (addr, node_id)))
+
+    def claimed(self):
+        def ops(db, now):
+            return {addr for addr, in db.execute('SELECT addr FROM claims JOIN leases USING (node_id) '
+                                                 'WHERE expires > ?', (now,))}
+        return self._transaction(ops)
+
+    def deregister(self, node_id, token):
+        def ops(db, now):
+            if db.execute('DELETE FROM leases WHERE node_id = ? AND token = ?', (node_id, token)).rowcount:
+                db.execute('DELETE FROM claims WHERE node_id = ?', (node_id,))
+        self._transaction(ops)
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+# Lua scripts of the Redis backend, which make each operation atomic. A node's lease is a key (holding the node's token)
+# that expires after the TTL, the claims are a hash that maps multicast addresses to node IDs, and the claims of each
+# node are also recorded in a hash of its own (mapping its multicast addresses to its clients).
+# KEYS: lease, the node's claims, claims. ARGV: token, TTL (ms), node ID. Returns 0 (acquired), 1 (renewed) or 2
+# (taken).
+_REDIS_REGISTER = """
+local lease = redis.call('GET', KEYS[1])
+if lease == ARGV[1] then
+    redis.call('PEXPIRE', KEYS[1], ARGV[2])
+    return 1
+end
+if lease then
+    return 2
+end
+for _, addr in ipairs(redis.call('HKEYS', KEYS[2])) do
+    if redis.call('HGET', KEYS[3], addr) == ARGV[3] then
+        redis.call('HDEL', KEYS[3], addr)
+    end
+end
+redis.call('DEL', KEYS[2])
+redis.call('SET', KEYS[1], ARGV[1], 'PX', ARGV[2])
+return 0
+"""
+# KEYS: lease, the node's claims, claims. ARGV: token, node ID, multicast address, client, key prefix. Returns 1 if the
+# address has been claimed.
+_REDIS_CLAIM = """
+if redis.call('GET', KEYS[1]) ~= ARGV[1] then
+    return 0
+end
+local owner = redis.call('HGET', KEYS[3], ARGV[3])
+if owner and owner ~= ARGV[2] then
+    if redis.call('EXISTS', ARGV[5] .. 'lease:' .. owner) == 1 then
+        return 0
+    end
+    redis.call('HDEL', ARGV[5] .. 'node:' .. owner, ARGV[3])
+end
+redis.call('HSET', KEYS[3], ARGV[3], ARGV[2])
+redis.call('HSET', KEYS[2], ARGV[3], ARGV[4])
+return 1
+"""
+# KEYS: the node's claims, claims. ARGV: node ID, multicast address.
+_REDIS_RELEASE = """
+if redis.call('HGET', KEYS[2], ARGV[2]) == ARGV[1] then
+    redis.call('HDEL', KEYS[2], ARGV[2])
+end
+redis.call('HDEL', KEYS[1], ARGV[2])
+"""
+# KEYS: lease, the node's claims, claims. ARGV: token, node ID.
+_REDIS_DEREGISTER = """
+if redis.call('GET', KEYS[1]) ~= ARGV[1] then
+    return
+end
+for _, addr in ipairs(redis.call('HKEYS', KEYS[2])) do
+    if redis.call('HGET', KEYS[3], addr) == ARGV[2] then
+        redis.call('HDEL', KEYS[3], addr)
+    end
+end
+redis.call('DEL', KEYS[1], KEYS[2])
+"""
+
+
+class RedisBackend:
+    """
+    Keeps the claims on a Redis server. Lease expiry is left to the server, so the clocks of the nodes need not be in
+    sync.
+    """
+
+    def __init__(self, url, timeout_s, client=None, prefix='u2mt:'):
+        """
+        :param url: URL of the Redis server (redis://host:port/db).
+        :param timeout_s: Timeout of the requests to the server.
+        :param client: A client to use instead of connecting to url, e.g., a fakeredis.FakeRedis as a local stand-in
+        for a Redis server.
+        :param prefix: Prefix of the keys.
+        """
+        if client is None:
+            if redis is None:
+                raise ClusterError('the Redis backend requires the redis package (pip install redis).')
+            client = redis.Redis.from_url(url, socket_timeout=timeout_s, socket_connect_timeout=timeout_s)
+        self._redis = client
+        self._prefix = prefix
+        self._claims_key = f'{prefix}claims'
+        self._register = client.register_script(_REDIS_REGISTER)
+        self._claim = client.register_script(_REDIS_CLAIM)
+        self._release = client.register_script(_REDIS_RELEASE)
+        self._deregister = client.register_script(_REDIS_DEREGISTER)
+
+    def _keys(self, node_id):
+        return [f'{self._prefix}lease:{node_id}', f'{self._prefix}node:{node_id}', self._claims_key]
+
+    def _call(self, script, keys, args):
+        try:
+            return script(keys=keys, args=args)
+        except Exception as e:
+            # redis.RedisError, or the errors of a stand-in client.
+            raise ClusterError(f'Redis backend failed: {e}')
+
+    def register(self, node_id, token, ttl_s):
+        outcome = self._call(self._register, self._keys(node_id), [token, int(ttl_s * 1000), node_id])
+        return (LEASE_ACQUIRED, LEASE_RENEWED, LEASE_TAKEN)[outcome]
+
+    def claim(self, node_id, token, addr, client):
+        return self._call(self._claim, self._keys(node_id), [token, node_id, addr, client, self._prefix]) == 1
+
+    def release(self, node_id, addr):
+        self._call(self._release, self._keys(node_id)[1:], [node_id, addr])
+
+    def claimed(self):
+        try:
+            claims = self._redis.hgetall(self._claims_key)
+            owners = list({node_id for node_id in claims.values()})
+            live = self._redis.mget([f'{self._prefix}lease:{node_id.decode()}' for node_id in owners]) if owners else []
+        except Exception as e:
+            raise ClusterError(f'Redis backend failed: {e}')
+        live_owners = {node_id for node_id, lease in zip(owners, live) if lease is not None}
+        return {addr.decode() for addr, node_id in claims.items() if node_id in live_owners}
+
+    def deregister(self, node_id, token):
+        self._call(self._deregister, self._keys(node_id), [token, node_id])
+
+    def close(self):
+        self._redis.close()
+
+
+# The memory:// backends and the fakeredis:// servers of this process, by name.
+_memory_backends = dict()
+_fakeredis_servers = dict()
+_memory_backends_lock = threading.Lock()
+
+
+def open_backend(url, timeout_s):
+    """
+    Open a cluster backend.
+
+    :param url: URL of the backend: memory://[name] (the nodes of a process that use the same name share the backend),
+    sqlite:///path/to/file.db (or sqlite://relative/path.db), redis://host:port/db (or rediss:// for TLS) or
+    fakeredis://[name] (the nodes of a process that use the same name share the stand-in Redis server).
+    :param timeout_s: Timeout of the requests to the backend.
+
+    :return: The backend.
+    """
+    scheme, sep, rest = url.partition('://')
+    if not sep:
+        raise ValueError(f'Invalid cluster backend URL {url}.')
+    if scheme == 'memory':
+        with _memory_backends_lock:
+            return _memory_backends.setdefault(rest, MemoryBackend())
+    if scheme == 'sqlite':
+        return SQLiteBackend(rest, timeout_s)
+    if scheme in ('redis', 'rediss'):
+        return RedisBackend(url, timeout_s)
+    if scheme == 'fakeredis':
+        if fakeredis is None:
+            raise ClusterError('the fakeredis backend requires the fakeredis and lupa packages '
+                               '(pip install fakeredis lupa).')
+        with _memory_backends_lock:
+            server = _fakeredis_servers.setdefault(rest, fakeredis.FakeServer())
+        return RedisBackend(url, timeout_s, client=fakeredis.FakeRedis(server=server))
+    raise ValueError(f'Unknown cluster backend {scheme}, must be one of memory, sqlite, redis or fakeredis.')
+
+
+class ClusterAllocator(McastAddrAllocator):
+    """
+    A McastAddrAllocator that claims each multicast address it allocates in a cluster backend, s.t. the address is not
+    allocated by any other node of the cluster at the same time.
+
+    The allocator's bitmap holds both its own allocations and the addresses it knows to be claimed by other nodes (as
+    of the last sync with the backend, see renew_lease()), so the allocation policy picks among the addresses that are
+    free cluster-wide, and only if another node claimed the picked address since the last sync, another one is picked.
+    The node's lease must be acquired (see join()) before allocating, and renewed regularly (see LeaseKeeper).
+    Snapshots are not supported: the backend holds the cluster's state.
+    """
+
+    def __init__(self, mcast_addr_space, policy='random', backend_url='memory://', node_id=None,
+                 lease_ttl_s=constants.DEFAULT_CLUSTER_LEASE_TTL_S):
+        """
+        Create a new ClusterAllocator.
+
+        :param mcast_addr_space: Address space to pick multicast addresses from (see McastAddrAllocator).
+        :param policy: Name of the allocation policy (see McastAddrAllocator).
+        :param backend_url: URL of the cluster backend (see open_backend()).
+        :param node_id: ID of the node, unique within the cluster (defaults to the host name).
+        :param lease_ttl_s: Time after which the node's claims expire if it fails to renew its lease.
+        """
+        super().__init__(mcast_addr_space, policy)
+        # Reentrant, s.t. claims are released in the same critical section in which McastAddrAllocator's methods free
+        # the allocations.
+        self._lock = threading.RLock()
+        self._node_id = node_id if node_id is not None else socket.gethostname()
+        # Distinguishes this incarnation of the node from previous (or duplicate) ones with the same node ID.
+        self._token = os.urandom(8).hex()
+        self._lease_ttl_s = lease_ttl_s
+        self._backend = open_backend(backend_url, lease_ttl_s * constants.CLUSTER_BACKEND_TIMEOUT)
+        # The time.monotonic() timestamp until which the node's lease is considered held (0 while not joined).
+        self._lease_valid_until = 0.0
+        # Indexes of the addresses claimed by other nodes (as of the last sync), and the time.monotonic() timestamp of
+        # the next sync.
+        self._foreign = set()
+        self._next_sync = 0.0
+
+    @staticmethod
+    def _client(client_addr):
+        return f'{client_addr[0]}|{client_addr[1]}'
+
+    def join(self):
+        """
+        Acquire the node's lease. If the node ID is still leased (e.g., by the node's previous incarnation, which has
+        crashed), wait for up to a TTL for the lease to expire.
+
+        :return: None.
+        """
+        deadline = time.monotonic() + self._lease_ttl_s
+        while True:
+            start = time.monotonic()
+            outcome = self._backend.register(self._node_id, self._token, self._lease_ttl_s)
+            if outcome != LEASE_TAKEN:
+                break
+            if start >= deadline:
+                raise ClusterError(f'the node ID {self._node_id} is in use by another translator.')
+            time.sleep(self._lease_ttl_s / constants.CLUSTER_RENEWALS_PER_TTL)
+        with self._lock:
+            self._lease_valid_until = start + self._lease_ttl_s * constants.CLUSTER_LEASE_SAFETY
+        self._sync()
+        logger.info(f'Joined the cluster as node {self._node_id}.', extra={'event': 'cluster'})
+
+    def leave(self):
+        """
+        Release the node's lease and all of its claims, e.g., when the translator terminates.
+
+        :return: None.
+        """
+        with self._lock:
+            self._lease_valid_until = 0.0
+            try:
+                self._backend.deregister(self._node_id, self._token)
+            except ClusterError as e:
+                logger.warning(f'Failed to leave the cluster (the claims of node {self._node_id} expire with its '
+                               f'lease): {e}', extra={'event': 'cluster'})
+            self._backend.close()
+
+    def renew_lease(self):
+        """
+        Renew the node's lease, and sync the addresses claimed by other nodes every constants.CLUSTER_SYNC_INTERVAL_S.
+
+        If the lease cannot be renewed before it is due to expire (i.e., within constants.CLUSTER_LEASE_SAFETY of the
+        TTL after its last renewal), or if it has expired meanwhile, all allocations are dropped: the flows must stop
+        being forwarded to their addresses, which other nodes may claim.
+
+        :return: A list of (client address, multicast address) tuples of the dropped allocations.
+        """
+        start = time.monotonic()
+        try:
+            outcome = self._backend.register(self._node_id, self._token, self._lease_ttl_s)
+        except ClusterError as e:
+            logger.warning(f'Failed to renew the lease of node {self._node_id}: {e}', extra={'event': 'cluster'})
+            outcome = None
+        with self._lock:
+            if outcome == LEASE_RENEWED or (outcome is None and start < self._lease_valid_until):
+                if outcome == LEASE_RENEWED:
+                    self._lease_valid_until = start + self._lease_ttl_s * constants.CLUSTER_LEASE_SAFETY
+                lost = []
+            else:
+                lost = self._drop_all()
+                self._lease_valid_until = 0.0
+                if outcome == LEASE_ACQUIRED:
+                    self._lease_valid_until = start + self._lease_ttl_s * constants.CLUSTER_LEASE_SAFETY
+                logger.warning(f'Node {self._node_id} has lost its lease, {len(lost)} allocations are lost.',
+                               extra={'event': 'cluster'})
+        if outcome is not None and start >= self._next_sync:
+            try:
+                self._sync()
+            except ClusterError as e:
+                logger.warning(f'Failed to sync the claims of the cluster: {e}', extra={'event': 'cluster'})
+        return lost
+
+    def _drop_all(self):
+        """
+        Drop all allocations (without releasing their claims). Must be called with the lock held.
+
+        :return: A list of (client address, multicast address) tuples of the dropped allocations.
+        """
+        lost = [(client_addr, self._addr_cls(self._base_addr + idx)) for client_addr, idx in self._fib.items()]
+        for idx in self._fib.values():
+            self._bitmap.clear(idx)
+        self._fib = dict()
+        self._access_codes = dict()
+        self._unclaimed = set()
+        return lost
+
+    def _sync(self):
+        """
+        Record the addresses currently claimed by other nodes in the bitmap (and forget about those that are no longer
+        claimed).
+
+        :return: None.
+        """
+        claimed = self._backend.claimed()
+        with self._lock:
+            own = set(self._fib.values())
+            size = self._bitmap.size
+            foreign = set()
+            for addr in claimed:
+                idx = int(ipaddress.ip_address(addr)) - self._base_addr
+                if 0 < idx < size - 1 and idx not in own:
+                    foreign.add(idx)
+            for idx in self._foreign - foreign:
+                if idx not in own:
+                    self._bitmap.clear(idx)
+            for idx in foreign - self._foreign:
+                self._bitmap.set(idx)
+            self._foreign = foreign
+            self._next_sync = time.monotonic() + constants.CLUSTER_SYNC_INTERVAL_S
+
+    def alloc(self, client_addr):
+        """
+        Allocate a multicast address for a unicast client, and claim it in the cluster backend.
+
+        :param client_addr: The (ip, port) tuple identifying the unicast client.
+
+        :return: A (multicast address, newly allocated) tuple (see McastAddrAllocator.alloc()). The multicast address
+        is None if we've run out of addresses, if constants.CLUSTER_CLAIM_ATTEMPTS addresses in a row have been claimed
+        by other nodes, or if the backend failed.
+        """
+        with self._lock:
+            idx = self._fib.get(client_addr, None)
+            if idx is not None:
+                return self._addr_cls(self._base_addr + idx), False
+            for _ in range(constants.CLUSTER_CLAIM_ATTEMPTS):
+                if self._bitmap.count == self._bitmap.size:
+                    return None, False
+                idx = self._policy.select(self._bitmap, client_addr)
+                mcast_addr = self._addr_cls(self._base_addr + idx)
+                try:
+                    claimed = self._backend.claim(self._node_id, self._token, str(mcast_addr),
+                                                  self._client(client_addr))
+                except ClusterError as e:
+                    logger.warning(f'Failed to claim {mcast_addr} for {client_addr}: {e}', extra={'event': 'cluster'})
+                    return None, False
+                self._bitmap.set(idx)
+                if claimed:
+                    self._fib[client_addr] = idx
+                    return mcast_addr, True
+                if time.monotonic() >= self._lease_valid_until:
+                    # Not another node's claim, but our lease that has expired.
+                    self._bitmap.clear(idx)
+                    return None, False
+                self._foreign.add(idx)
+            return None, False
+
+    def free(self, client_addr):
+        """
+        Free the multicast address allocated for a unicast client, if any, and release its claim.
+
+        :param client_addr: The (ip, port) tuple identifying the unicast client.
+
+        :return: The freed multicast address, or None if no multicast address was allocated for client_addr.
+        """
+        with self._lock:
+            # The claim is released while holding the lock, s.t. it is not released after the address has been
+            # allocated (and claimed) anew.
+            mcast_addr = super().free(client_addr)
+            if mcast_addr is not None:
+                self._release(mcast_addr)
+            return mcast_addr
+
+    def _release(self, mcast_addr):
+        try:
+            self._backend.release(self._node_id, str(mcast_addr))
+        except ClusterError as e:
+            logger.warning(f'Failed to release the claim of {mcast_addr} (it expires with the lease of node '
+                           f'{self._node_id}): {e}', extra={'event': 'cluster'})
+
+    def set_addr_space(self, mcast_addr_space):
+        """
+        Switch to another address space (see McastAddrAllocator.set_addr_space()), and release the claims of the
+        dropped allocations.
+
+        :param mcast_addr_space: The new address space.
+
+        :return: A list of (client address, multicast address) tuples of the dropped allocations.
+        """
+        with self._lock:
+            dropped = super().set_addr_space(mcast_addr_space)
+            for _, mcast_addr in dropped:
+                self._release(mcast_addr)
+            # The bitmap has been rebuilt from our own allocations, so the other nodes' claims are synced again.
+            self._foreign = set()
+            self._next_sync = 0.0
+        return dropped
+
+    def snapshot(self):
+        raise NotImplementedError('The allocations of a cluster are kept by the cluster backend, not in snapshots.')
+
+    def restore(self, data):
+        raise NotImplementedError('The allocations of a cluster are kept by the cluster backend, not in snapshots.')
+
+
+AllocatorManager.register('ClusterAllocator', ClusterAllocator)
+
+
+class LeaseKeeper:
+    """
+    Renews the lease of a node (a ClusterAllocator) from a background thread, and hands the allocations that are lost
+    if the lease expires to a callback.
+    """
+
+    def __init__(self, allocator, on_lost, lease_ttl_s=constants.DEFAULT_CLUSTER_LEASE_TTL_S):
+        """
+        Create a new LeaseKeeper. The lease is not acquired until you call start().
+
+        :param allocator: The ClusterAllocator, or a proxy to it.
+        :param on_lost: Callable that takes a list of (client address, multicast address) tuples of lost allocations.
+        Called from the LeaseKeeper's thread.
+        :param lease_ttl_s: The lease TTL, i.e., the lease is renewed every lease_ttl_s /
+        constants.CLUSTER_RENEWALS_PER_TTL seconds.
+        """
+        self._allocator = allocator
+        self._on_lost = on_lost
+        self._interval_s = lease_ttl_s / constants.CLUSTER_RENEWALS_PER_TTL
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='lease_keeper', daemon=True)
+
+    def start(self):
+        """
+        Acquire the node's lease (see ClusterAllocator.join()) and start renewing it.
+
+        :return: None.
+        """
+        self._allocator.join()
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stop renewing the lease and leave the cluster (releasing all claims).
+
+        :return: None.
+        """
+        if not self._thread.is_alive():
+            return
+        self._stop.set()
+        self._thread.join()
+        self._allocator.leave()
+
+    def _run(self):
+        while not self._stop.wait(self._interval_s):
+            try:
+                lost = self._allocator.renew_lease()
+            except Exception as e:
+                logger.error(f'Failed to renew the lease: {e}', extra={'event': 'cluster'})
+                continue
+            if lost:
+                self._on_lost(lost)
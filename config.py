@@ -0,0 +1,98 @@
+"""
+Settings that can be changed while the translator is running (hot reload).
+
+The config file is a JSON object whose keys are the names of command line options (without the leading dashes), e.g.:
+
+    {"multicast-ttl": 16, "multicast-addr-space": "232.1.0.0/16", "multicastmenu-url": "https://menu.example.org"}
+
+Only the options in RELOADABLE are allowed. The settings in the file take precedence over the corresponding command line
+options when the translator starts, and the file is read again (and its settings applied to the running translator)
+whenever the translator receives SIGHUP. Settings that are missing from the file are left unchanged.
+"""
+import ipaddress
+import json
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def _int_in(lo, hi):
+    def parse(value):
+        if isinstance(value, bool) or not isinstance(value, int) or not lo <= value <= hi:
+            raise ValueError(f'must be an integer between {lo} and {hi}, but was {value!r}')
+        return value
+    return parse
+
+
+def _str(value):
+    if not isinstance(value, str) or not value:
+        raise ValueError(f'must be a non-empty string, but was {value!r}')
+    return value
+
+
+def _addr_space(value):
+    addr_space = ipaddress.ip_network(_str(value))
+    if not addr_space.is_multicast:
+        raise ValueError(f'must be a multicast address space, but was {value!r}')
+    return addr_space
+
+
+# Maps the keys of the config file (i.e., the names of the reloadable command line options) to the corresponding
+# keyword argument of Translator.__init__() and Translator.reconfigure(), and to the function that validates and
+# converts their values.
+RELOADABLE = {
+    'multicast-addr-space': ('mcast_addr_space', _addr_space),
+    'multicast-ttl': ('mcast_ttl', _int_in(0, 255)),
+    'multicast-dscp': ('mcast_dscp', _int_in(0, 63)),
+    'multicast-sndbuf': ('mcast_sndbuf', _int_in(1, 2 ** 31 - 1)),
+    'multicastmenu-url': ('mcastmenu_url', _str),
+    'multicastmenu-uid': ('mcastmenu_uid', _str),
+}
+
+
+def load(path):
+    """
+    Read and validate a config file.
+
+    :param path: Path of the config file.
+
+    :return: A dict of the settings, keyed by the keyword arguments of Translator.reconfigure().
+    """
+    with open(path) as f:
+        try:
+            entries = json.load(f)
+        except json.JSONDecodeError as e:
+            raise ValueError(f'{path} is not valid JSON: {e}')
+    if not isinstance(entries, dict):
+        raise ValueError(f'{path} must contain a JSON object.')
+    settings = dict()
+    for key, value in entries.items():
+        if key not in RELOADABLE:
+            raise ValueError(f'{key} cannot be set in the config file (reloadable settings: {", ".join(RELOADABLE)}).')
+        kwarg, parse = RELOADABLE[key]
+        try:
+            settings[kwarg] = parse(value)
+        except ValueError as e:
+            raise ValueError(f'{key} {e}')
+    return settings
+
+
+def reload(translator, path):
+    """
+    Read the config file again and apply its settings to a running Translator (or WorkerPool). Failures are logged,
+    leaving the running configuration unchanged.
+
+    :param translator: The Translator, AsyncTranslator or WorkerPool.
+    :param path: Path of the config file (None if there is none).
+
+    :return: None.
+    """
+    if path is None:
+        logger.warning('Not reloading the configuration: no config file has been given.', extra={'event': 'reload'})
+        return
+    try:
+        settings = load(path)
+        logger.info(f'Reloading the configuration from {path}.', extra={'event': 'reload'})
+        translator.reconfigure(**settings)
+    except (OSError, ValueError) as e:
+        logger.error(f'Failed to reload the configuration from {path}: {e}', extra={'event': 'reload'})
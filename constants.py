@@ -5,13 +5,127 @@ import ipaddress
 DEFAULT_UNICAST_SRV_PORT = 9001
 # Default address space to pick multicast destination addresses (groups) from for the translated unicast streams.
 DEFAULT_MULTICAST_ADDR_SPACE = ipaddress.IPv4Network('232.0.0.0/8')
+# Address spaces of up to this many addresses have their allocations recorded in a bitmap (a /8 takes 2 MiB), larger
+# ones (i.e., IPv6 SSM address spaces of up to 2^32 groups) in a set (see allocator.SparseAddrSet).
+ALLOC_BITMAP_MAX_SIZE = 1 << 24
+# Default policy for picking the multicast destination address (group) for a new unicast stream (see
+# allocator.ALLOC_POLICIES).
+DEFAULT_ALLOC_POLICY = 'random'
 # Default port to use when forwarding payload received on the translator's unicast server socket as multicast.
 DEFAULT_MULTICAST_PORT = 9002
-# URL to use when submitting stream information to the Multicast Menu
-MULTICASTMENU_ADD_URL = 'https://multicastmenu.herokuapp.com/add/'
+# Default maximum number of packets to receive and forward per system call (1 disables the batched datapath).
+DEFAULT_BATCH_SIZE = 1
+# Default size (in bytes) of the buffer(s) that unicast packets are received into (larger packets are dropped).
+DEFAULT_READ_BUFFER_SIZE = 1514
+# Default number of worker processes to spread translation across.
+DEFAULT_WORKERS = 1
+# Default translation engine ('thread' or 'asyncio').
+DEFAULT_ENGINE = 'thread'
+# Default TTL of the translated multicast packets.
+DEFAULT_MULTICAST_TTL = 32
+# Default number of seconds after which an inactive unicast flow is evicted (and its multicast address freed).
+DEFAULT_IDLE_TIMEOUT_S = 300
+# Granularity (in seconds) at which inactive unicast flows are detected.
+IDLE_EVICTION_TICK_S = 1.0
+# The admission rate of new flows and the rate limits of flows may be exceeded for bursts of up to this many seconds'
+# worth of new flows, packets or bytes (e.g., the new flows of a warm restart, or the I-frames of a video stream).
+ADMISSION_BURST_S = 2.0
+# Default maximum time (in seconds) a packet is held back by the pacing stage (see pacing.py), and maximum number of
+# packets held back across all flows.
+DEFAULT_PACING_MAX_DELAY_S = 0.1
+PACING_MAX_PACKETS = 65536
+# The bitrate of a paced flow (without PCRs) is measured over windows of this many seconds, and each new measurement
+# (per window or per PCR interval) is given this weight in the flow's bitrate.
+PACING_RATE_WINDOW_S = 1.0
+PACING_RATE_SMOOTHING = 0.25
+# Paced flows are sent this much faster than their measured bitrate, s.t. the jitter buffer drains and the packets of
+# a smooth flow are sent on arrival.
+PACING_HEADROOM = 1.05
+# A paced flow that has fallen behind its schedule may catch up by up to this many seconds' worth of packets at once,
+# i.e., bursts (and jitter) of up to this duration are not smoothed out.
+PACING_SLACK_S = 0.005
+# Granularity (in seconds) at which held back packets are released when no packets arrive in the meantime.
+PACING_TICK_S = 0.001
+# Time (in seconds) between snapshots of the allocator's state (see snapshot.py).
+SNAPSHOT_INTERVAL_S = 10.0
+# Default time (in seconds) after which the multicast addresses claimed by a node of a cluster expire if the node fails
+# to renew its lease (see cluster.py).
+DEFAULT_CLUSTER_LEASE_TTL_S = 10.0
+# A node renews its lease this many times per lease TTL.
+CLUSTER_RENEWALS_PER_TTL = 3
+# A node that has not renewed its lease for this fraction of the lease TTL gives up its claims, s.t. it has stopped
+# forwarding to their addresses before other nodes may claim them.
+CLUSTER_LEASE_SAFETY = 0.5
+# Timeout of the requests to the cluster backend, as a fraction of the lease TTL.
+CLUSTER_BACKEND_TIMEOUT = 0.2
+# Time (in seconds) between syncs of the multicast addresses claimed by the other nodes of a cluster.
+CLUSTER_SYNC_INTERVAL_S = 30.0
+# Maximum number of multicast addresses a node tries to claim for a new flow (each claimed by another node since the
+# last sync) before giving up.
+CLUSTER_CLAIM_ATTEMPTS = 16
+# Number of flows (or sockets) the translation thread handles per step when applying a new configuration, between
+# translating packets (see Translator.reconfigure()).
+RECONFIG_FLOWS_PER_STEP = 256
+# Number of flows the translation thread migrates to a new address space per step (migrating a flow involves the
+# allocator, which may be shared with other processes, so this is more expensive).
+RECONFIG_MIGRATIONS_PER_STEP = 16
+# Time (in seconds) the translation thread waits for packets while a new configuration is being applied (rather than the
+# read timeout), s.t. the configuration is applied promptly even if no packets are received.
+RECONFIG_POLL_S = 0.001
+# Default maximum number of per-flow connected multicast sockets (if connected sockets are enabled).
+DEFAULT_MAX_CONNECTED_SOCKETS = 1024
+# Default format of the log messages ('text' or 'json').
+DEFAULT_LOG_FORMAT = 'text'
+# Default minimum level of the log messages.
+DEFAULT_LOG_LEVEL = 'INFO'
+# Maximum number of log messages waiting to be written (further messages are dropped).
+LOG_QUEUE_SIZE = 10000
+# Sampling and rate limits for high-volume log messages, per event: (log one in this many messages, messages per
+# second, burst). Messages beyond these limits are suppressed (and counted).
+LOG_RATE_LIMITS = {
+    'flow_allocated': (1, 50.0, 500),
+    'flow_evicted': (1, 50.0, 500),
+    'flow_migrated': (1, 50.0, 500),
+    'out_of_addresses': (1, 1.0, 10),
+    'flow_denied': (1, 1.0, 10),
+    'rate_limited': (1, 1.0, 10),
+    'packet_truncated': (1, 1.0, 10),
+    'out_of_fds': (1, 1.0, 10),
+    'mcastmenu': (1, 20.0, 200),
+    'cluster': (1, 1.0, 10),
+}
+# Default IP address to serve metrics on.
+DEFAULT_METRICS_ADDR = '127.0.0.1'
+# The per-packet datapath records the processing time of one in this many packets.
+METRICS_LOOP_LATENCY_SAMPLE_INTERVAL = 64
+# Histogram buckets (upper bounds in seconds) for the processing time of a packet or a batch of packets.
+METRICS_LOOP_LATENCY_BUCKETS_S = (5e-6, 10e-6, 25e-6, 50e-6, 100e-6, 250e-6, 500e-6, 1e-3, 2.5e-3, 5e-3, 10e-3)
+# Histogram buckets (upper bounds in seconds) for the time Multicast Menu requests take.
+METRICS_MULTICASTMENU_LATENCY_BUCKETS_S = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+# Default base URL of the Multicast Menu.
+DEFAULT_MULTICASTMENU_URL = 'https://multicastmenu.herokuapp.com'
+# Path (relative to the base URL) to use when submitting stream information to the Multicast Menu
+MULTICASTMENU_ADD_PATH = '/add/'
+# Paths to use when adding/removing streams through the Multicast Menu API (requires a Multicast Menu UID).
+MULTICASTMENU_API_ADD_PATH = '/api/add/'
+MULTICASTMENU_API_REMOVE_PATH = '/api/remove/'
+# Path to use when adding many streams at once through the Multicast Menu API (requires a Multicast Menu UID).
+MULTICASTMENU_API_ADD_BATCH_PATH = '/api/add/batch/'
 # Email address to use when submitting stream information to the Multicast Menu. Lenny has OK'ed using his email address
 # until we have a group email.
 MULTICASTMENU_EMAIL = 'lenny@juniper.net'
 # Number of worker threads dedicated to submitting stream information to the Multicast Menu.
 MULTICASTMENU_THREADS = 10
+# Maximum number of pending Multicast Menu requests (further requests are dropped).
+MULTICASTMENU_MAX_PENDING = 10000
+# Maximum number of attempts per Multicast Menu request.
+MULTICASTMENU_MAX_ATTEMPTS = 5
+# Delay (in seconds) before the first retry of a failed Multicast Menu request. Doubles with every further retry, up to
+# MULTICASTMENU_MAX_BACKOFF_S.
+MULTICASTMENU_BACKOFF_S = 1.0
+MULTICASTMENU_MAX_BACKOFF_S = 60.0
+# When publishing streams in batches: time (in seconds) to wait for further streams to join a batch, and the maximum
+# number of streams per batch (the Multicast Menu accepts at most 500).
+MULTICASTMENU_BATCH_INTERVAL_S = 0.25
+MULTICASTMENU_BATCH_MAX_SIZE = 100
 # ======================================================================================================================
@@ -0,0 +1,73 @@
+import math
+
+
+class IdleTimerWheel:
+    """
+    A hashed timer wheel that determines which flows have been idle for longer than a given timeout.
+
+    Flows are expected to have a last_seen attribute (a time.monotonic() timestamp) that is updated whenever a packet of
+    the flow is received. Updating last_seen is all the packet path has to do: rather than rescheduling a flow's timer
+    for every packet, a flow's timer is only checked (and lazily rescheduled based on last_seen) when it fires. Each
+    flow is thus touched about once per idle timeout, and both add() and expire() take O(1) amortized time per flow.
+    """
+
+    def __init__(self, idle_timeout_s, tick_s, now):
+        """
+        Create a new IdleTimerWheel.
+
+        :param idle_timeout_s: A flow that has not been seen for this many seconds is considered idle.
+        :param tick_s: Granularity of the wheel. A flow is reported as idle at most tick_s seconds (plus the time
+        between two calls to expire()) after it has gone idle.
+        :param now: Current time.monotonic() timestamp.
+        """
+        if idle_timeout_s <= 0 or tick_s <= 0:
+            raise ValueError(f'idle_timeout_s and tick_s must be positive, but were {idle_timeout_s} and {tick_s}')
+        self._idle_timeout_s = idle_timeout_s
+        self._tick_s = tick_s
+        self._slots = [[] for _ in range(math.ceil(idle_timeout_s / tick_s) + 1)]
+        # Index of the slot that holds the flows whose timers fire at next_tick_time.
+        self._cursor = 0
+        # Time at which the timers in the current slot fire. expire() need not be called before this time.
+        self.next_tick_time = now + tick_s
+
+    def __len__(self):
+        return sum(len(slot) for slot in self._slots)
+
+    def add(self, flow):
+        """
+        Start tracking a flow. The flow's last_seen attribute must be set.
+
+        :param flow: The flow.
+
+        :return: None.
+        """
+        self._schedule(flow, flow.last_seen + self._idle_timeout_s)
+
+    def _schedule(self, flow, deadline):
+        ticks_ahead = max(0, math.ceil((deadline - self.next_tick_time) / self._tick_s))
+        # Firing early is harmless as the flow will simply be rescheduled based on its last_seen.
+        ticks_ahead = min(ticks_ahead, len(self._slots) - 1)
+        self._slots[(self._cursor + ticks_ahead) % len(self._slots)].append(flow)
+
+    def expire(self, now):
+        """
+        Advance the wheel to now and stop tracking all flows that have been idle for longer than the idle timeout.
+
+        :param now: Current time.monotonic() timestamp.
+
+        :return: A list of the flows that have gone idle.
+        """
+        expired = []
+        while self.next_tick_time <= now:
+            slot = self._slots[self._cursor]
+            self._slots[self._cursor] = []
+            for flow in slot:
+                deadline = flow.last_seen + self._idle_timeout_s
+                if deadline <= now:
+                    expired.append(flow)
+                else:
+                    # The flow has seen traffic since it was scheduled.
+                    self._schedule(flow, deadline)
+            self._cursor = (self._cursor + 1) % len(self._slots)
+            self.next_tick_time += self._tick_s
+        return expired
@@ -0,0 +1,203 @@
+"""
+Logging for the translator.
+
+The translator's modules log through the standard logging module. setup() routes all log records through a bounded
+queue to a background thread that formats and writes them, so the thread that logs (e.g., the translation thread) never
+waits for the console or the journal. Records are classified by an event (passed as ``extra={'event': ...}``), and the
+events listed in constants.LOG_RATE_LIMITS are sampled and rate-limited before they are even queued, so a flood of,
+e.g., new flows cannot flood the log. Records are written either as plain text or as one JSON object per line.
+"""
+import datetime
+import json
+import logging
+import logging.handlers
+import queue
+import sys
+import threading
+import time
+
+import constants
+
+# Attributes of every LogRecord, i.e., the attributes that are not structured fields passed through extra.
+_RECORD_ATTRS = set(vars(logging.LogRecord('', logging.INFO, '', 0, '', (), None))) | {'message', 'asctime',
+                                                                                       'event', 'suppressed'}
+
+# The listener thread, the queue handler and the rate limiter set up by setup(), and the arguments setup() was called
+# with.
+_listener = None
+_queue_handler = None
+_rate_limiter = None
+_config = None
+
+logger = logging.getLogger(__name__)
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    Samples and rate-limits log records per event.
+
+    Of the records of an event, only every sample_every-th record is considered, and the considered records are passed
+    through a token bucket (refilled at rate tokens per second, holding at most burst tokens). A record that gets
+    through carries the number of records of the same event that were suppressed before it (in its suppressed
+    attribute). Records without an event, or with an event that has no limits, are never suppressed.
+    """
+
+    def __init__(self, limits):
+        """
+        Create a new RateLimitFilter.
+
+        :param limits: Maps events to (sample_every, rate, burst) tuples.
+        """
+        super().__init__()
+        self._limits = limits
+        # Maps each event to a [tokens, time of last refill, records seen, records suppressed] list.
+        self._state = dict()
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        event = getattr(record, 'event', None)
+        limits = self._limits.get(event, None)
+        if limits is None:
+            return True
+        sample_every, rate, burst = limits
+        now = time.monotonic()
+        with self._lock:
+            state = self._state.get(event, None)
+            if state is None:
+                state = self._state[event] = [burst, now, 0, 0]
+            state[2] += 1
+            if (state[2] - 1) % sample_every:
+                state[3] += 1
+                return False
+            state[0] = min(burst, state[0] + (now - state[1]) * rate)
+            state[1] = now
+            if state[0] < 1:
+                state[3] += 1
+                return False
+            state[0] -= 1
+            record.suppressed = state[3]
+            state[3] = 0
+        return True
+
+    def pop_suppressed(self):
+        """
+        :return: A dict that maps each event to the number of its records that have been suppressed since the last
+        record that got through, and reset these numbers.
+        """
+        with self._lock:
+            suppressed = {event: state[3] for event, state in self._state.items() if state[3]}
+            for state in self._state.values():
+                state[3] = 0
+        return suppressed
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    """
+    Puts log records on a bounded queue without blocking, dropping (and counting) records when the queue is full.
+    """
+
+    def __init__(self, q):
+        super().__init__(q)
+        self.dropped = 0
+
+    def prepare(self, record):
+        # Leave the formatting to the listener thread (the queue never leaves this process, so there's no need to make
+        # the record picklable).
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class TextFormatter(logging.Formatter):
+    """
+    Formats log records as plain text, noting how many similar records have been suppressed.
+    """
+
+    def __init__(self):
+        super().__init__('%(levelname)s: %(message)s')
+
+    def format(self, record):
+        msg = super().format(record)
+        suppressed = getattr(record, 'suppressed', 0)
+        if suppressed:
+            msg += f' ({suppressed} similar messages suppressed)'
+        return msg
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    Formats log records as JSON objects (one per line), including any structured fields passed through extra.
+    """
+
+    def format(self, record):
+        entry = {'time': datetime.datetime.fromtimestamp(record.created, datetime.timezone.utc).isoformat(),
+                 'level': record.levelname, 'logger': record.name, 'event': getattr(record, 'event', None),
+                 'message': record.getMessage()}
+        entry.update((k, v) for k, v in vars(record).items() if k not in _RECORD_ATTRS)
+        suppressed = getattr(record, 'suppressed', 0)
+        if suppressed:
+            entry['suppressed'] = suppressed
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+def setup(fmt='text', level=logging.INFO, stream=None, rate_limits=None, queue_size=None):
+    """
+    Route all logging through a queue to a background thread that writes to a stream. Replaces any previous setup.
+
+    :param fmt: 'text' or 'json'.
+    :param level: Minimum level of the records to log.
+    :param stream: Stream to write to (sys.stdout if None).
+    :param rate_limits: Maps events to (sample_every, rate, burst) tuples (see RateLimitFilter). Defaults to
+    constants.LOG_RATE_LIMITS.
+    :param queue_size: Maximum number of records waiting to be written. Defaults to constants.LOG_QUEUE_SIZE.
+
+    :return: None.
+    """
+    global _listener, _queue_handler, _rate_limiter, _config
+    if fmt not in ('text', 'json'):
+        raise ValueError(f'Unknown log format {fmt}, must be text or json')
+    shutdown()
+    _config = dict(fmt=fmt, level=level)
+    stream_handler = logging.StreamHandler(sys.stdout if stream is None else stream)
+    stream_handler.setFormatter(JsonFormatter() if fmt == 'json' else TextFormatter())
+    q = queue.Queue(constants.LOG_QUEUE_SIZE if queue_size is None else queue_size)
+    _rate_limiter = RateLimitFilter(constants.LOG_RATE_LIMITS if rate_limits is None else rate_limits)
+    _queue_handler = _QueueHandler(q)
+    _queue_handler.addFilter(_rate_limiter)
+    root = logging.getLogger()
+    root.handlers = [_queue_handler]
+    root.setLevel(level)
+    _listener = logging.handlers.QueueListener(q, stream_handler)
+    _listener.start()
+
+
+def config():
+    """
+    :return: The keyword arguments of the last call to setup() (e.g., to set up logging the same way in a worker
+    process), or None if setup() has not been called.
+    """
+    return _config
+
+
+def shutdown():
+    """
+    Report the records that have been suppressed or dropped, write all queued records and stop the background thread.
+
+    :return: None.
+    """
+    global _listener, _queue_handler, _rate_limiter
+    if _listener is None:
+        return
+    for event, count in _rate_limiter.pop_suppressed().items():
+        logger.info(f'{count} {event} messages were suppressed.')
+    if _queue_handler.dropped:
+        logger.warning(f'{_queue_handler.dropped} log messages were dropped as the log queue was full.')
+    _listener.stop()
+    logging.getLogger().removeHandler(_queue_handler)
+    _listener = _queue_handler = _rate_limiter = None
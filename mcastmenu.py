@@ -0,0 +1,583 @@
+"""
+Publishing translated streams on the Multicast Menu (and withdrawing them) in the background.
+"""
+import collections
+import heapq
+import itertools
+import logging
+import random
+import threading
+import time
+
+import requests
+
+import constants
+import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class _Request:
+    """
+    A pending request to add a stream to or remove a stream from the Multicast Menu.
+    """
+    __slots__ = ('kind', 'mcast_addr', 'description', 'submitted', 'attempts', 'not_before')
+
+    def __init__(self, kind, mcast_addr, description, submitted):
+        self.kind = kind
+        self.mcast_addr = mcast_addr
+        self.description = description
+        # time.monotonic() timestamp of the submission of the request.
+        self.submitted = submitted
+        # Number of attempts made so far.
+        self.attempts = 0
+        # The request must not be attempted before this time.monotonic() timestamp (set when retrying).
+        self.not_before = submitted
+
+
+class _MenuSession:
+    """
+    A keep-alive HTTP session with the Multicast Menu and the CSRF token obtained for it. Used by one worker thread.
+    """
+
+    def __init__(self):
+        self.http = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=1)
+        self.http.mount('https://', adapter)
+        self.http.mount('http://', adapter)
+        self.csrftoken = None
+        # The URL of the form the CSRF token was obtained from.
+        self.csrf_url = None
+
+
+class _RetryableError(Exception):
+    """
+    A request failed in a way that may be resolved by retrying it later (e.g., a connection error or a 5xx response).
+    """
+    pass
+
+
+class MulticastMenuPublisher:
+    """
+    Publishes streams on the Multicast Menu and withdraws them, using a pool of worker threads.
+
+    Requests are queued per multicast address, so the queue holds at most one pending request per stream: a request that
+    duplicates a pending request is dropped, and a request that undoes a pending request (e.g., withdrawing a stream
+    that has not been published yet) cancels it. Requests for the same stream are never processed concurrently. Failed
+    requests are retried with exponential backoff, and the number of pending requests is bounded.
+
+    Each worker thread keeps a keep-alive session with the Multicast Menu and reuses the CSRF token it obtained for that
+    session until the Multicast Menu rejects it, so publishing a stream takes a single round trip in the common case.
+    When publishing through the API, streams can also be published in batches (using the bulk endpoint at
+    constants.MULTICASTMENU_API_ADD_BATCH_PATH), which takes a single round trip for all streams of a burst of new
+    flows.
+
+    The Multicast Menu's URL and the translator's UID can be changed while requests are being processed (see
+    reconfigure()).
+    """
+
+    def __init__(self, mcast_src_ip, mcast_port, mcastmenu_uid=None, url=constants.DEFAULT_MULTICASTMENU_URL,
+                 num_threads=constants.MULTICASTMENU_THREADS,
+                 max_pending=constants.MULTICASTMENU_MAX_PENDING, max_attempts=constants.MULTICASTMENU_MAX_ATTEMPTS,
+                 backoff_s=constants.MULTICASTMENU_BACKOFF_S, max_backoff_s=constants.MULTICASTMENU_MAX_BACKOFF_S,
+                 batch_interval_s=None, max_batch_size=constants.MULTICASTMENU_BATCH_MAX_SIZE, on_published=None):
+        """
+        Create a new MulticastMenuPublisher. Requests are not processed until you call start().
+
+        :param mcast_src_ip: Source IP of the translated streams.
+        :param mcast_port: Destination port of the translated streams.
+        :param mcastmenu_uid: Unique identifier of the translator for the Multicast Menu API. If set, streams are
+        published through the API (which also allows for withdrawing them). Otherwise, streams are published by
+        submitting the form.
+        :param url: Base URL of the Multicast Menu.
+        :param num_threads: Number of worker threads.
+        :param max_pending: Maximum number of pending requests. Further requests are rejected.
+        :param max_attempts: Maximum number of attempts per request.
+        :param backoff_s: Delay before the first retry of a request. The delay doubles with every further retry.
+        :param max_backoff_s: Maximum delay before a retry.
+        :param batch_interval_s: If set, streams are published in batches: a worker thread waits this long for further
+        streams to publish before it publishes them all in one request. Requires mcastmenu_uid.
+        :param max_batch_size: Maximum number of streams per batch.
+        :param on_published: Callable that is called with the multicast address and the access code of each stream
+        that has been published through the API (on a worker thread), e.g., to persist the access code.
+        """
+        if batch_interval_s is not None and mcastmenu_uid is None:
+            raise ValueError('Publishing streams in batches requires a Multicast Menu UID.')
+        self._mcast_src_ip = mcast_src_ip
+        self._mcast_port = mcast_port
+        self._mcastmenu_uid = mcastmenu_uid
+        self._url = url.rstrip('/')
+        self._max_pending = max_pending
+        self._max_attempts = max_attempts
+        self._backoff_s = backoff_s
+        self._max_backoff_s = max_backoff_s
+        self._batch_interval_s = batch_interval_s
+        self._max_batch_size = max_batch_size
+        self._on_published = on_published
+        # All of the following is protected by _cond.
+        self._cond = threading.Condition()
+        # Maps multicast addresses to the request that is pending (i.e., not yet started) for them.
+        self._pending = dict()
+        # Pending requests that can be started right away, in submission order.
+        self._ready = collections.deque()
+        # Pending add requests that can be started right away, in submission order, if streams are published in batches
+        # (the remove requests are still in _ready).
+        self._ready_adds = collections.deque()
+        # True while a worker is waiting for further add requests to join its batch.
+        self._batching = False
+        # Pending requests that are waiting for their retry, as a heap of (not_before, sequence number, request).
+        self._delayed = []
+        self._seq = itertools.count()
+        # Multicast addresses that a worker is currently processing a request for.
+        self._in_flight = set()
+        # Maps multicast addresses to the access codes returned by the Multicast Menu API when publishing the streams.
+        self._access_codes = dict()
+        self._stopping = False
+        # Time from submitting a request until it's completed (or given up on), per type of request.
+        self._latency = {kind: metrics.Histogram(constants.METRICS_MULTICASTMENU_LATENCY_BUCKETS_S)
+                         for kind in ('add', 'remove')}
+        self._counts = collections.Counter()
+        self._threads = [threading.Thread(target=self._work, name=f'multicastmenu_thread_{i}', daemon=True)
+                         for i in range(num_threads)]
+
+    def start(self):
+        """
+        Start the worker threads.
+
+        :return: None.
+        """
+        for thread in self._threads:
+            thread.start()
+
+    def stop(self, blocking=True):
+        """
+        Stop the worker threads, dropping the pending requests. Requests that are being processed are completed.
+
+        :param blocking: If True, wait for the worker threads to exit.
+
+        :return: None.
+        """
+        with self._cond:
+            self._stopping = True
+            if self._pending:
+                logger.warning(f'Dropping {len(self._pending)} pending Multicast Menu requests.',
+                               extra={'event': 'mcastmenu'})
+            self._cond.notify_all()
+        if blocking:
+            for thread in self._threads:
+                if thread.is_alive():
+                    thread.join()
+
+    def publish(self, mcast_addr, description):
+        """
+        Request that a stream be published on the Multicast Menu.
+
+        :param mcast_addr: The multicast address (group) of the stream.
+        :param description: A description of the stream.
+
+        :return: False if the request was rejected because too many requests are pending, True otherwise.
+        """
+        return self._submit(_Request('add', mcast_addr, description, time.monotonic()))
+
+    def withdraw(self, mcast_addr):
+        """
+        Request that a stream be withdrawn from the Multicast Menu.
+
+        :param mcast_addr: The multicast address (group) of the stream.
+
+        :return: False if the request was rejected because too many requests are pending, True otherwise.
+        """
+        return self._submit(_Request('remove', mcast_addr, None, time.monotonic()))
+
+    def restore_access_codes(self, access_codes):
+        """
+        Take over the access codes of streams that have been published before (e.g., before a warm restart), s.t. they
+        can be withdrawn.
+
+        :param access_codes: Dict that maps multicast addresses to access codes.
+
+        :return: None.
+        """
+        with self._cond:
+            self._access_codes.update(access_codes)
+
+    def reconfigure(self, url=None, mcastmenu_uid=None):
+        """
+        Change the Multicast Menu's URL and/or the translator's UID. Takes effect with the next request (requests that
+        are in flight complete with the previous settings).
+
+        Note that streams published under a previous UID may not be withdrawable under the new one.
+
+        :param url: New base URL of the Multicast Menu (None to leave it unchanged).
+        :param mcastmenu_uid: New unique identifier of the translator for the Multicast Menu API (None to leave it
+        unchanged).
+
+        :return: None.
+        """
+        with self._cond:
+            if url is not None:
+                self._url = url.rstrip('/')
+            if mcastmenu_uid is not None:
+                self._mcastmenu_uid = mcastmenu_uid
+
+    def backlog(self):
+        """
+        :return: The number of requests that are pending or being processed.
+        """
+        with self._cond:
+            return len(self._pending) + len(self._in_flight)
+
+    def collect_metrics(self):
+        """
+        :return: The publisher's metric families (see metrics.render()).
+        """
+        with self._cond:
+            backlog = len(self._pending) + len(self._in_flight)
+            counts = dict(self._counts)
+            latency = [sample for kind, hist in self._latency.items() for sample in hist.samples({'operation': kind})]
+        outcomes = ('succeeded', 'failed', 'coalesced', 'rejected')
+        return [
+            ('u2mt_multicastmenu_pending_requests', 'gauge', 'Multicast Menu requests waiting to be completed.',
+             [('', {}, backlog)]),
+            ('u2mt_multicastmenu_requests', 'counter', 'Multicast Menu requests, by type and outcome.',
+             [('_total', {'operation': kind, 'outcome': outcome}, counts.get((kind, outcome), 0))
+              for kind in ('add', 'remove') for outcome in outcomes]),
+            ('u2mt_multicastmenu_retries', 'counter', 'Multicast Menu requests that were retried.',
+             [('_total', {}, counts.get('retry', 0))]),
+            ('u2mt_multicastmenu_request_latency_seconds', 'histogram',
+             'Time from submitting a Multicast Menu request until its completion.', latency),
+        ]
+
+    def _submit(self, request):
+        key = request.mcast_addr
+        with self._cond:
+            pending = self._pending.get(key, None)
+            if pending is not None:
+                if pending.kind == request.kind:
+                    # The pending request will do.
+                    self._counts[(request.kind, 'coalesced')] += 1
+                    return True
+                # The request undoes the pending request, so neither needs to be made.
+                del self._pending[key]
+                self._counts[(request.kind, 'coalesced')] += 1
+                self._counts[(pending.kind, 'coalesced')] += 1
+                return True
+            if len(self._pending) >= self._max_pending:
+                self._counts[(request.kind, 'rejected')] += 1
+                logger.warning('Too many pending Multicast Menu requests, dropping the request to %s %s.',
+                               request.kind, key, extra={'event': 'mcastmenu'})
+                return False
+            self._pending[key] = request
+            if key not in self._in_flight:
+                self._make_ready(request)
+                self._cond.notify()
+            # Otherwise, the request is made ready once the request that is in flight for the stream completes.
+            return True
+
+    def _make_ready(self, request):
+        if self._batch_interval_s is not None and request.kind == 'add':
+            self._ready_adds.append(request)
+        else:
+            self._ready.append(request)
+
+    def _pop_ready(self, ready):
+        """
+        Pop the first request from a deque of ready requests that is still pending, and mark it as in flight. Must be
+        called with _cond held.
+
+        :return: The request, or None if there is none.
+        """
+        while ready:
+            request = ready.popleft()
+            # Skip requests that have been coalesced in the meantime.
+            if self._pending.get(request.mcast_addr, None) is request:
+                del self._pending[request.mcast_addr]
+                self._in_flight.add(request.mcast_addr)
+                return request
+        return None
+
+    def _next_requests(self):
+        """
+        Wait for requests that can be started, and mark them as in flight. Must be called with _cond held.
+
+        :return: A list with a single request or, if streams are published in batches, up to max_batch_size add
+        requests. An empty list if the publisher is stopping.
+        """
+        while not self._stopping:
+            now = time.monotonic()
+            while self._delayed and self._delayed[0][0] <= now:
+                self._make_ready(heapq.heappop(self._delayed)[2])
+            request = self._pop_ready(self._ready)
+            if request is not None:
+                return [request]
+            if self._ready_adds and not self._batching:
+                batch = self._collect_batch()
+                if batch:
+                    return batch
+                continue
+            self._cond.wait(self._delayed[0][0] - now if self._delayed else None)
+        return []
+
+    def _collect_batch(self):
+        """
+        Wait batch_interval_s for further add requests to become ready, and mark up to max_batch_size of them as in
+        flight. Must be called with _cond held.
+
+        :return: The add requests (an empty list if they have all been coalesced or if the publisher is stopping).
+        """
+        # Other workers do not start a batch of their own in the meantime, so that a burst of new flows ends up in a
+        # single batch.
+        self._batching = True
+        deadline = time.monotonic() + self._batch_interval_s
+        while not self._stopping:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            self._cond.wait(remaining)
+            if self._ready or self._delayed:
+                # We may have consumed a notification meant for a worker that's free to take these requests.
+                self._cond.notify()
+        self._batching = False
+        batch = []
+        while not self._stopping and len(batch) < self._max_batch_size:
+            request = self._pop_ready(self._ready_adds)
+            if request is None:
+                break
+            batch.append(request)
+        if self._ready_adds:
+            # Let another worker start the next batch.
+            self._cond.notify()
+        return batch
+
+    def _work(self):
+        session = _MenuSession()
+        while True:
+            with self._cond:
+                batch = self._next_requests()
+            if not batch:
+                return
+            for request in batch:
+                request.attempts += 1
+            if self._batch_interval_s is not None and batch[0].kind == 'add':
+                outcomes = self._add_batch(session, batch)
+            else:
+                outcomes = [self._attempt(session, batch[0])]
+            for request, outcome in zip(batch, outcomes):
+                self._complete(request, outcome)
+
+    def _attempt(self, session, request):
+        """
+        Make a request.
+
+        :return: 'succeeded', 'retry' (if the request failed but may be retried) or 'failed'.
+        """
+        try:
+            if request.kind == 'add':
+                self._add(session, request)
+            else:
+                self._remove(session, request)
+            return 'succeeded'
+        except _RetryableError as e:
+            retry = request.attempts < self._max_attempts
+            self._log_failure(request, e, retry)
+            return 'retry' if retry else 'failed'
+        except Exception as e:
+            self._log_failure(request, e, False)
+            return 'failed'
+
+    def _complete(self, request, outcome):
+        key = request.mcast_addr
+        now = time.monotonic()
+        with self._cond:
+            self._in_flight.discard(key)
+            pending = self._pending.get(key, None)
+            if outcome == 'retry' and pending is not None and pending.kind != request.kind:
+                # The failed request has been undone in the meantime.
+                del self._pending[key]
+                outcome = 'coalesced'
+                self._counts[(pending.kind, 'coalesced')] += 1
+                pending = None
+            if outcome == 'retry' and pending is None:
+                self._counts['retry'] += 1
+                backoff = min(self._max_backoff_s, self._backoff_s * 2 ** (request.attempts - 1))
+                # Add jitter s.t. requests that failed together are not retried together.
+                request.not_before = now + backoff * random.uniform(0.5, 1.0)
+                self._pending[key] = request
+                heapq.heappush(self._delayed, (request.not_before, next(self._seq), request))
+            else:
+                if outcome == 'retry':
+                    # A request of the same type was submitted in the meantime, which replaces the failed one.
+                    outcome = 'coalesced'
+                self._counts[(request.kind, outcome)] += 1
+                self._latency[request.kind].observe(now - request.submitted)
+                if pending is not None:
+                    # A request for the same stream was submitted while this one was in flight.
+                    self._make_ready(pending)
+            self._cond.notify()
+
+    def _log_failure(self, request, e, retry):
+        action = 'add' if request.kind == 'add' else 'remove'
+        url = self._stream_url(request.mcast_addr)
+        errmsg = f'Attempt {request.attempts} to {action} {url} {"to" if action == "add" else "from"} the Multicast ' \
+                 f'Menu failed: {e}'
+        if retry:
+            logger.warning(errmsg + ' Retrying later.', extra={'event': 'mcastmenu'})
+        else:
+            logger.error(errmsg, extra={'event': 'mcastmenu'})
+
+    def _stream_url(self, mcast_addr):
+        if ':' in str(mcast_addr):
+            return f'amt://[{self._mcast_src_ip}]@[{mcast_addr}]:{self._mcast_port}'
+        return f'amt://{self._mcast_src_ip}@{mcast_addr}:{self._mcast_port}'
+
+    @staticmethod
+    def _post(session, url, **kwargs):
+        """
+        POST to the Multicast Menu, raising a _RetryableError for failures that may be transient.
+
+        :return: The response.
+        """
+        try:
+            resp = session.http.post(url, **kwargs)
+        except requests.RequestException as e:
+            raise _RetryableError(f'encountered a {type(e)} with message "{e}".')
+        if resp.status_code >= 500 or resp.status_code == 429:
+            raise _RetryableError(f'POST resulted in status code {resp.status_code}.')
+        return resp
+
+    def _add(self, session, request):
+        """
+        Publish a stream on the Multicast Menu, using the API if we have a Multicast Menu UID and the form otherwise.
+
+        :return: None.
+        """
+        if self._mcastmenu_uid is not None:
+            self._add_api(session, request)
+            return
+        add_url = self._url + constants.MULTICASTMENU_ADD_PATH
+        email = constants.MULTICASTMENU_EMAIL
+        form_params = {'source': self._mcast_src_ip, 'group': str(request.mcast_addr),
+                       'udp_port': str(self._mcast_port), 'email': email, 'description': str(request.description),
+                       'Add': 'Add'}
+        # The Multicast Menu uses Django's CSRF protection, so we must provide a CSRF protection token alongside the
+        # other form parameters (the form has a hidden input tag that contains the token) and as a cookie (which the
+        # session takes care of). Also note that we must set the Referer header field (to the same URL we're submitting
+        # the form to) as otherwise we'll get rejected by the server. The token remains valid for as long as the
+        # session's cookie, so we only GET the form (to obtain a token) if we don't have a token yet or if the token has
+        # been rejected.
+        header_fields = {'Referer': add_url}
+        for fresh_token in (False, True):
+            if session.csrftoken is None or session.csrf_url != add_url or fresh_token:
+                session.csrftoken = self._fetch_csrftoken(session, add_url)
+                session.csrf_url = add_url
+            form_params['csrfmiddlewaretoken'] = session.csrftoken
+            resp = self._post(session, add_url, data=form_params, headers=header_fields)
+            if resp.status_code != 403:
+                break
+            # The token has been rejected (e.g., because the session's cookie has expired).
+            session.csrftoken = None
+        if resp.status_code != 200:
+            raise RuntimeError(f'POST resulted in status code {resp.status_code}. Response body:\n{resp.text}')
+        logger.info(f'Added {self._stream_url(request.mcast_addr)} to the Multicast Menu (email={email}; '
+                    f'description={request.description}).', extra={'event': 'mcastmenu'})
+
+    @staticmethod
+    def _fetch_csrftoken(session, url):
+        """
+        GET the form at url to obtain a CSRF protection token.
+
+        :return: The token.
+        """
+        try:
+            resp = session.http.get(url)
+        except requests.RequestException as e:
+            raise _RetryableError(f'encountered a {type(e)} with message "{e}".')
+        if resp.status_code != 200:
+            raise _RetryableError(f'GET resulted in status code {resp.status_code}.')
+        csrftoken = session.http.cookies.get('csrftoken')
+        if csrftoken is None:
+            raise RuntimeError('no csrftoken found in session.')
+        return csrftoken
+
+    def _add_api(self, session, request):
+        """
+        Publish a stream on the Multicast Menu using the API, and remember the returned access code (needed to withdraw
+        the stream).
+
+        :return: None.
+        """
+        form_params = {'unique_identifier': self._mcastmenu_uid, 'source': str(self._mcast_src_ip),
+                       'group': str(request.mcast_addr)}
+        resp = self._post(session, self._url + constants.MULTICASTMENU_API_ADD_PATH, data=form_params)
+        if resp.status_code != 201:
+            raise RuntimeError(f'POST resulted in status code {resp.status_code}. Response body:\n{resp.text}')
+        # The access code is the last word of the message returned by the API.
+        access_code = resp.json()['data'].split()[-1]
+        self._record_access_code(request.mcast_addr, access_code)
+        logger.info(f'Added {self._stream_url(request.mcast_addr)} to the Multicast Menu.',
+                    extra={'event': 'mcastmenu'})
+
+    def _add_batch(self, session, batch):
+        """
+        Publish streams on the Multicast Menu using the bulk API, and remember the returned access codes.
+
+        :param batch: The add requests.
+
+        :return: The outcome of each request ('succeeded', 'retry' or 'failed').
+        """
+        streams = [{'source': str(self._mcast_src_ip), 'group': str(request.mcast_addr)} for request in batch]
+        try:
+            resp = self._post(session, self._url + constants.MULTICASTMENU_API_ADD_BATCH_PATH,
+                              json={'unique_identifier': self._mcastmenu_uid, 'streams': streams})
+            if resp.status_code != 201:
+                raise RuntimeError(f'POST resulted in status code {resp.status_code}. Response body:\n{resp.text}')
+            results = resp.json()['data']
+            if len(results) != len(batch):
+                raise RuntimeError(f'got {len(results)} results for {len(batch)} streams.')
+        except Exception as e:
+            outcomes = []
+            for request in batch:
+                retry = isinstance(e, _RetryableError) and request.attempts < self._max_attempts
+                self._log_failure(request, e, retry)
+                outcomes.append('retry' if retry else 'failed')
+            return outcomes
+        outcomes = []
+        for request, result in zip(batch, results):
+            if 'access_code' not in result:
+                self._log_failure(request, result.get('error'), False)
+                outcomes.append('failed')
+                continue
+            self._record_access_code(request.mcast_addr, result['access_code'])
+            logger.info(f'Added {self._stream_url(request.mcast_addr)} to the Multicast Menu.',
+                        extra={'event': 'mcastmenu'})
+            outcomes.append('succeeded')
+        return outcomes
+
+    def _record_access_code(self, mcast_addr, access_code):
+        with self._cond:
+            self._access_codes[mcast_addr] = access_code
+        if self._on_published is not None:
+            try:
+                self._on_published(mcast_addr, access_code)
+            except Exception as e:
+                logger.error(f'Failed to record the access code of {self._stream_url(mcast_addr)}: {e}',
+                             extra={'event': 'mcastmenu'})
+
+    def _remove(self, session, request):
+        """
+        Withdraw a stream that was published using the API from the Multicast Menu.
+
+        :return: None.
+        """
+        with self._cond:
+            access_code = self._access_codes.get(request.mcast_addr, None)
+        if access_code is None:
+            raise RuntimeError('no access code on record (the stream may not have been published).')
+        form_params = {'unique_identifier': self._mcastmenu_uid, 'access_code': access_code}
+        resp = self._post(session, self._url + constants.MULTICASTMENU_API_REMOVE_PATH, data=form_params)
+        if resp.status_code != 201:
+            raise RuntimeError(f'POST resulted in status code {resp.status_code}. Response body:\n{resp.text}')
+        with self._cond:
+            self._access_codes.pop(request.mcast_addr, None)
+        logger.info(f'Removed {self._stream_url(request.mcast_addr)} from the Multicast Menu.',
+                    extra={'event': 'mcastmenu'})
@@ -0,0 +1,145 @@
+"""
+Minimal support for exposing metrics in the Prometheus text exposition format over HTTP, without depending on a
+Prometheus client library.
+
+Metrics are not registered anywhere: a MetricsServer calls a collect function on each scrape, which returns the current
+metric families. The counters on the packet path can thus be plain attributes (e.g., of a Flow) that are only read at
+scrape time.
+"""
+import bisect
+import http.server
+import math
+import threading
+
+
+class Histogram:
+    """
+    A histogram with fixed buckets. Not thread-safe: concurrent calls to observe() must be serialized by the caller.
+    """
+
+    def __init__(self, buckets):
+        """
+        Create a new Histogram.
+
+        :param buckets: Upper bounds of the buckets, in ascending order (a +Inf bucket is added implicitly).
+        """
+        self._buckets = list(buckets)
+        # Number of observations per bucket (not cumulative). The last element is the +Inf bucket.
+        self._counts = [0] * (len(self._buckets) + 1)
+        self._sum = 0.0
+
+    def observe(self, value):
+        """
+        Record an observation.
+
+        :param value: The observed value.
+
+        :return: None.
+        """
+        self._counts[bisect.bisect_left(self._buckets, value)] += 1
+        self._sum += value
+
+    def samples(self, labels=None):
+        """
+        :param labels: Labels to add to each sample (a dict), if any.
+
+        :return: The samples of the histogram as (suffix, labels, value) tuples (see render()).
+        """
+        labels = labels or {}
+        samples = []
+        cumulative = 0
+        for bound, count in zip(self._buckets + [math.inf], self._counts):
+            cumulative += count
+            samples.append(('_bucket', dict(labels, le=_format_value(bound)), cumulative))
+        samples.append(('_sum', labels, self._sum))
+        samples.append(('_count', labels, cumulative))
+        return samples
+
+
+def _format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def _escape(label_value):
+    return str(label_value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+
+def render(families):
+    """
+    Render metric families in the Prometheus text exposition format.
+
+    :param families: Iterable of (name, type, help, samples) tuples, where type is 'counter', 'gauge' or 'histogram'
+    and samples is a list of (suffix, labels, value) tuples. The name of a sample is the family's name followed by the
+    suffix (e.g., '_total' or '_bucket'), and labels is a dict.
+
+    :return: The rendered metrics (a str).
+    """
+    lines = []
+    for name, metric_type, help_text, samples in families:
+        lines.append(f'# HELP {name} {help_text}')
+        lines.append(f'# TYPE {name} {metric_type}')
+        for suffix, labels, value in samples:
+            if labels:
+                label_str = ','.join(f'{k}="{_escape(v)}"' for k, v in labels.items())
+                lines.append(f'{name}{suffix}{{{label_str}}} {_format_value(value)}')
+            else:
+                lines.append(f'{name}{suffix} {_format_value(value)}')
+    lines.append('')
+    return '\n'.join(lines)
+
+
+class MetricsServer:
+    """
+    Serves metrics over HTTP (at any path) from a background thread.
+    """
+
+    def __init__(self, addr, port, collect):
+        """
+        Create a new MetricsServer. The server does not accept connections until you call start().
+
+        :param addr: IP address to listen on.
+        :param port: Port to listen on.
+        :param collect: Callable that returns the metric families to serve (see render()). Called on the server's
+        thread(s).
+        """
+        collect_fn = collect
+
+        class _Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                try:
+                    body = render(collect_fn()).encode()
+                except Exception as e:
+                    self.send_error(500, f'Failed to collect metrics: {e}')
+                    return
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                # Scrapes happen every few seconds, don't log them.
+                pass
+
+        self._httpd = http.server.ThreadingHTTPServer((addr, port), _Handler)
+        self._httpd.daemon_threads = True
+        self._thread = threading.Thread(target=self._httpd.serve_forever, name='metrics_server', daemon=True)
+
+    def start(self):
+        """
+        Start serving metrics.
+
+        :return: None.
+        """
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stop serving metrics and close the listening socket.
+
+        :return: None.
+        """
+        self._httpd.shutdown()
+        self._httpd.server_close()
@@ -0,0 +1,309 @@
+"""
+Batched UDP I/O using the Linux recvmmsg(2) and sendmmsg(2) system calls.
+
+The Python standard library does not expose recvmmsg(2) and sendmmsg(2), so we call them through ctypes. All message
+headers, I/O vectors, socket addresses and payload buffers are preallocated once and reused for every batch, and all
+per-packet bookkeeping is done through memoryviews and struct.pack_into (rather than through ctypes attribute access,
+which is comparatively slow).
+
+Use is_available() to check whether the batched I/O primitives can be used on this platform before instantiating a
+BatchReceiver or a BatchSender.
+"""
+import ctypes
+import ctypes.util
+import errno
+import os
+import socket
+import struct
+
+
+class _IOVec(ctypes.Structure):
+    _fields_ = [('iov_base', ctypes.c_void_p),
+                ('iov_len', ctypes.c_size_t)]
+
+
+class _MsgHdr(ctypes.Structure):
+    _fields_ = [('msg_name', ctypes.c_void_p),
+                ('msg_namelen', ctypes.c_uint32),
+                ('msg_iov', ctypes.c_void_p),
+                ('msg_iovlen', ctypes.c_size_t),
+                ('msg_control', ctypes.c_void_p),
+                ('msg_controllen', ctypes.c_size_t),
+                ('msg_flags', ctypes.c_int)]
+
+
+class _MMsgHdr(ctypes.Structure):
+    _fields_ = [('msg_hdr', _MsgHdr),
+                ('msg_len', ctypes.c_uint)]
+
+
+# Size of a struct sockaddr_in and of a struct sockaddr_in6.
+_SOCKADDR_IN_LEN = 16
+_SOCKADDR_IN6_LEN = 28
+_IOVEC_LEN = ctypes.sizeof(_IOVec)
+_MMSGHDR_LEN = ctypes.sizeof(_MMsgHdr)
+_MSG_NAME_OFFSET = _MsgHdr.msg_name.offset
+_MSG_LEN_OFFSET = _MMsgHdr.msg_len.offset
+_MSG_FLAGS_OFFSET = _MsgHdr.msg_flags.offset
+_MSG_DONTWAIT = getattr(socket, 'MSG_DONTWAIT', 0)
+# Maximum number of distinct source addresses for which BatchReceiver caches the decoded address tuple.
+_SRC_ADDR_CACHE_SIZE = 65536
+
+
+def _load_libc():
+    """
+    Look up recvmmsg(2) and sendmmsg(2) in the C library.
+
+    :return: A (recvmmsg, sendmmsg) tuple of ctypes function pointers, or (None, None) if they are not available.
+    """
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        recvmmsg = libc.recvmmsg
+        sendmmsg = libc.sendmmsg
+    except (OSError, AttributeError, TypeError):
+        return None, None
+    recvmmsg.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_uint, ctypes.c_int, ctypes.c_void_p]
+    recvmmsg.restype = ctypes.c_int
+    sendmmsg.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_uint, ctypes.c_int]
+    sendmmsg.restype = ctypes.c_int
+    return recvmmsg, sendmmsg
+
+
+_recvmmsg, _sendmmsg = _load_libc()
+
+
+def is_available():
+    """
+    Check if batched I/O is supported on this platform.
+
+    :return: True if both recvmmsg(2) and sendmmsg(2) are available, False otherwise.
+    """
+    return _recvmmsg is not None and _sendmmsg is not None
+
+
+def _address_of(buf):
+    """
+    Get the memory address of a bytearray's underlying storage.
+
+    :param buf: A bytearray. It must not be resized for as long as the returned address is in use.
+
+    :return: The address (an int).
+    """
+    return ctypes.addressof(ctypes.c_char.from_buffer(buf))
+
+
+def _raise_errno():
+    err = ctypes.get_errno()
+    raise OSError(err, os.strerror(err))
+
+
+def _sockaddr_len(family):
+    return _SOCKADDR_IN6_LEN if family == socket.AF_INET6 else _SOCKADDR_IN_LEN
+
+
+class SockAddr:
+    """
+    A struct sockaddr_in (or sockaddr_in6) for a destination, for use with BatchSender.queue(). The struct remains
+    valid for as long as the SockAddr is referenced.
+    """
+    __slots__ = ('_buf', 'address')
+
+    def __init__(self, dst_addr):
+        """
+        Create a new SockAddr.
+
+        :param dst_addr: Destination as an (ip, port) tuple, where ip is an IPv4 or an IPv6 address.
+        """
+        if ':' in dst_addr[0]:
+            # Flow info and scope ID are left zero.
+            self._buf = bytearray(struct.pack('=H', socket.AF_INET6) + struct.pack('!HI', dst_addr[1], 0) +
+                                  socket.inet_pton(socket.AF_INET6, dst_addr[0]) + bytes(4))
+        else:
+            self._buf = bytearray(struct.pack('=H', socket.AF_INET) + struct.pack('!H', dst_addr[1]) +
+                                  socket.inet_aton(dst_addr[0]) + bytes(8))
+        # Memory address of the struct sockaddr_in(6).
+        self.address = _address_of(self._buf)
+
+
+class BatchReceiver:
+    """
+    Receives up to batch_size UDP datagrams per recvmmsg(2) call into a set of preallocated buffers.
+    """
+
+    def __init__(self, batch_size, buffer_size, family=socket.AF_INET):
+        """
+        Create a new BatchReceiver.
+
+        :param batch_size: Maximum number of datagrams to receive per call to recv().
+        :param buffer_size: Size of each of the batch_size receive buffers.
+        :param family: Address family of the socket to receive from (socket.AF_INET or socket.AF_INET6).
+        """
+        if not is_available():
+            raise RuntimeError('recvmmsg is not available on this platform.')
+        self.batch_size = batch_size
+        self.buffer_size = buffer_size
+        name_len = _sockaddr_len(family)
+        if family == socket.AF_INET6:
+            # Bind the decoder directly to save a branch per packet.
+            self.src_addr = self._src_addr6
+        self._bufs = bytearray(batch_size * buffer_size)
+        self._bufs_mv = memoryview(self._bufs)
+        self._names = bytearray(batch_size * name_len)
+        self._names_mv = memoryview(self._names)
+        self._iovs = bytearray(batch_size * _IOVEC_LEN)
+        self._msgs = bytearray(batch_size * _MMSGHDR_LEN)
+        self._msgs_addr = _address_of(self._msgs)
+        bufs_addr = _address_of(self._bufs)
+        names_addr = _address_of(self._names)
+        iovs_addr = _address_of(self._iovs)
+        # Memory address of the start of each receive buffer (slot).
+        self.slot_addrs = [bufs_addr + i * buffer_size for i in range(batch_size)]
+        for i in range(batch_size):
+            struct.pack_into('PN', self._iovs, i * _IOVEC_LEN, self.slot_addrs[i], buffer_size)
+            hdr = _MsgHdr.from_buffer(self._msgs, i * _MMSGHDR_LEN)
+            hdr.msg_name = names_addr + i * name_len
+            hdr.msg_namelen = name_len
+            hdr.msg_iov = iovs_addr + i * _IOVEC_LEN
+            hdr.msg_iovlen = 1
+        # Strided view on the msg_len field of each struct mmsghdr (i.e., the number of bytes received per slot).
+        self.lengths = memoryview(self._msgs).cast('I')[_MSG_LEN_OFFSET // 4::_MMSGHDR_LEN // 4]
+        # Strided view on the msg_flags field of each struct mmsghdr (e.g., MSG_TRUNC is set for a slot if the datagram
+        # did not fit into the buffer).
+        self.flags = memoryview(self._msgs).cast('i')[_MSG_FLAGS_OFFSET // 4::_MMSGHDR_LEN // 4]
+        # Decoding a struct sockaddr_in(6) is comparatively expensive, so cache the address tuple per raw address.
+        self._src_addrs = dict()
+
+    def recv(self, fd):
+        """
+        Receive up to batch_size datagrams without blocking.
+
+        :param fd: File descriptor of the socket to receive from.
+
+        :return: The number of datagrams received (0 if no datagram was available).
+        """
+        n = _recvmmsg(fd, self._msgs_addr, self.batch_size, _MSG_DONTWAIT, None)
+        if n < 0:
+            if ctypes.get_errno() in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return 0
+            _raise_errno()
+        return n
+
+    def src_addr(self, i):
+        """
+        Get the source address of the datagram in slot i.
+
+        :param i: Slot index.
+
+        :return: The source address as an (ip, port) tuple, like the one returned by socket.recvfrom().
+        """
+        offset = i * _SOCKADDR_IN_LEN
+        # Port (2 bytes) and IPv4 address (4 bytes) follow the 2-byte address family field.
+        raw = self._names_mv[offset + 2:offset + 8].tobytes()
+        src_addr = self._src_addrs.get(raw)
+        if src_addr is None:
+            if len(self._src_addrs) >= _SRC_ADDR_CACHE_SIZE:
+                self._src_addrs.clear()
+            src_addr = (socket.inet_ntoa(raw[2:]), int.from_bytes(raw[:2], 'big'))
+            self._src_addrs[raw] = src_addr
+        return src_addr
+
+    def _src_addr6(self, i):
+        """
+        src_addr() for an AF_INET6 socket.
+
+        :return: The source address as an (ip, port, flowinfo, scope_id) tuple, like the one returned by
+        socket.recvfrom() (IPv4 sources of a dual-stack socket have IPv4-mapped IPv6 addresses).
+        """
+        offset = i * _SOCKADDR_IN6_LEN
+        # Port (2 bytes), flow info (4 bytes), IPv6 address (16 bytes) and scope ID (4 bytes) follow the 2-byte address
+        # family field.
+        raw = self._names_mv[offset + 2:offset + _SOCKADDR_IN6_LEN].tobytes()
+        src_addr = self._src_addrs.get(raw)
+        if src_addr is None:
+            if len(self._src_addrs) >= _SRC_ADDR_CACHE_SIZE:
+                self._src_addrs.clear()
+            port, flowinfo = struct.unpack_from('!HI', raw)
+            src_addr = (socket.inet_ntop(socket.AF_INET6, raw[6:22]), port, flowinfo,
+                        struct.unpack_from('=I', raw, 22)[0])
+            self._src_addrs[raw] = src_addr
+        return src_addr
+
+    def payload(self, i):
+        """
+        Get the payload of the datagram in slot i. The returned memoryview is only valid until the next call to recv().
+
+        :param i: Slot index.
+
+        :return: A memoryview on the payload.
+        """
+        offset = i * self.buffer_size
+        return self._bufs_mv[offset:offset + self.lengths[i]]
+
+
+class BatchSender:
+    """
+    Sends up to batch_size queued UDP datagrams per sendmmsg(2) call. Payloads are not copied: queue() takes the address
+    of the payload (e.g., one of the BatchReceiver's slots), which must remain valid until flush() returns.
+    """
+
+    def __init__(self, batch_size, family=socket.AF_INET):
+        """
+        Create a new BatchSender.
+
+        :param batch_size: Maximum number of datagrams that can be queued before flush() must be called.
+        :param family: Address family of the socket to send on (socket.AF_INET or socket.AF_INET6). All destinations
+        must be of this family.
+        """
+        if not is_available():
+            raise RuntimeError('sendmmsg is not available on this platform.')
+        self.batch_size = batch_size
+        self._iovs = bytearray(batch_size * _IOVEC_LEN)
+        self._msgs = bytearray(batch_size * _MMSGHDR_LEN)
+        self._msgs_addr = _address_of(self._msgs)
+        iovs_addr = _address_of(self._iovs)
+        for i in range(batch_size):
+            hdr = _MsgHdr.from_buffer(self._msgs, i * _MMSGHDR_LEN)
+            hdr.msg_namelen = _sockaddr_len(family)
+            hdr.msg_iov = iovs_addr + i * _IOVEC_LEN
+            hdr.msg_iovlen = 1
+        self._count = 0
+
+    def queue(self, payload_addr, length, sockaddr_addr):
+        """
+        Queue a datagram for sending.
+
+        :param payload_addr: Memory address of the payload.
+        :param length: Length of the payload.
+        :param sockaddr_addr: Memory address of the destination's struct sockaddr_in(6) (see SockAddr).
+
+        :return: None.
+        """
+        i = self._count
+        struct.pack_into('PN', self._iovs, i * _IOVEC_LEN, payload_addr, length)
+        struct.pack_into('P', self._msgs, i * _MMSGHDR_LEN + _MSG_NAME_OFFSET, sockaddr_addr)
+        self._count = i + 1
+
+    def flush(self, fd):
+        """
+        Send all queued datagrams.
+
+        A datagram that the kernel refuses to send (e.g., because there is no route to its destination) is skipped such
+        that it does not hold back the remaining datagrams.
+
+        :param fd: File descriptor of the socket to send on.
+
+        :return: The number of datagrams that could not be sent.
+        """
+        sent = 0
+        failed = 0
+        count = self._count
+        while sent + failed < count:
+            n = _sendmmsg(fd, self._msgs_addr + (sent + failed) * _MMSGHDR_LEN, count - sent - failed, 0)
+            if n < 0:
+                if ctypes.get_errno() == errno.EINTR:
+                    continue
+                failed += 1
+            else:
+                sent += n
+        self._count = 0
+        return failed
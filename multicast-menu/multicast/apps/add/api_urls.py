@@ -7,5 +7,6 @@ app_name = "api"
 
 urlpatterns = [
     path("add/", api_views.SubmissionAdd.as_view(), name="add_api"),
+    path("add/batch/", api_views.SubmissionAddBatch.as_view(), name="add_batch_api"),
     path("remove/", api_views.SubmissionRemove.as_view(), name="remove_api"),
 ]
@@ -1,14 +1,32 @@
+from functools import reduce
+from operator import or_
+
 from rest_framework import generics, status
 from rest_framework.response import Response
 
 from django.contrib.auth import get_user_model
 from django.core.exceptions import ValidationError
-from django.core.validators import validate_ipv4_address
+from django.core.validators import validate_ipv46_address
+from django.db import transaction
+from django.db.models import Q
+from django.utils.ipv6 import clean_ipv6_address
 
+from ...settings import API_ADD_BATCH_MAX_SIZE
 from ...utils import create_random_string
 from ..view.models import Stream
 from .models import APISubmission, Translator, UploadSubmission
-from .serializers import AddSerializer, RemoveSerializer
+from .serializers import AddBatchSerializer, AddSerializer, RemoveSerializer
+
+
+def clean_ip_address(value):
+    """
+    Validate an IPv4 or IPv6 address and return it as the Stream fields store it (IPv6 addresses compressed), so that
+    existing streams are found however the address is written.
+    """
+    if not isinstance(value, str):
+        raise ValidationError("Enter a valid IPv4 or IPv6 address.")
+    validate_ipv46_address(value)
+    return clean_ipv6_address(value) if ":" in value else value
 
 
 class SubmissionAdd(generics.CreateAPIView):
@@ -30,8 +48,8 @@ class SubmissionAdd(generics.CreateAPIView):
             else:
                 # Validate
                 try:
-                    validate_ipv4_address(source)
-                    validate_ipv4_address(group)
+                    source = clean_ip_address(source)
+                    group = clean_ip_address(group)
                 except ValidationError:
                     return Response({"error": "Invalid source or group specified."}, status=status.HTTP_400_BAD_REQUEST)
                 if Stream.objects.filter(source=source, group=group).exists():
@@ -92,6 +110,92 @@ class SubmissionAdd(generics.CreateAPIView):
                     return Response({"data": "Your access code for claiming, editing or deleting the string is {}".format(access_code)}, status=status.HTTP_201_CREATED)
 
 
+class SubmissionAddBatch(generics.CreateAPIView):
+    """
+    Adds a list of streams in one request. Takes a JSON body like
+    {"unique_identifier": "<UID>", "streams": [{"source": "<SOURCE_IP>", "group": "<GROUP_IP>"}, ...]}
+    and returns one result per stream, in the same order: either the stream's access code or the reason it was not added.
+    Inside requests are not supported.
+    """
+    serializer_class = AddBatchSerializer
+
+    def create(self, request):
+        unique_identifier = request.data.get("unique_identifier")
+        streams = request.data.get("streams")
+
+        if not unique_identifier or not isinstance(streams, list) or not streams:
+            return Response({"error": "Missing required fields"}, status=status.HTTP_400_BAD_REQUEST)
+        if len(streams) > API_ADD_BATCH_MAX_SIZE:
+            return Response({"error": "At most {} streams can be added per request.".format(API_ADD_BATCH_MAX_SIZE)}, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            translation_server = Translator.objects.get(uid=unique_identifier)
+        except Translator.DoesNotExist:
+            return Response({"error": "Invalid translation server unique identifier"}, status=status.HTTP_400_BAD_REQUEST)
+
+        # Validate all streams in one pass, so that one invalid stream does not fail the whole batch
+        results = []
+        valid = []
+        for entry in streams:
+            source = entry.get("source") if isinstance(entry, dict) else None
+            group = entry.get("group") if isinstance(entry, dict) else None
+            result = {"source": source, "group": group}
+            results.append(result)
+            if not source or not group:
+                result["error"] = "Missing required fields"
+                continue
+            try:
+                result["source"] = clean_ip_address(source)
+                result["group"] = clean_ip_address(group)
+            except ValidationError:
+                result["error"] = "Invalid source or group specified."
+                continue
+            valid.append(result)
+
+        # Detect duplicates (within the batch and with existing streams) with a single query
+        existing = set()
+        if valid:
+            existing.update(
+                Stream.objects.filter(reduce(or_, (Q(source=r["source"], group=r["group"]) for r in valid)))
+                .values_list("source", "group")
+            )
+        to_create = []
+        for result in valid:
+            key = (result["source"], result["group"])
+            if key in existing:
+                result["error"] = "This stream already exists. Contact an admin to claim it."
+                continue
+            existing.add(key)
+            to_create.append(result)
+
+        # Handle
+        if to_create:
+            api_user = get_user_model().objects.get_or_create(
+                username="API"
+            )[0]
+            with transaction.atomic():
+                created = Stream.objects.bulk_create([
+                    Stream(
+                        owner=api_user,
+                        collection_method="04",
+                        source=result["source"],
+                        group=result["group"],
+                        source_name=translation_server.name,
+                    )
+                    for result in to_create
+                ])
+                submissions = []
+                for result, stream in zip(to_create, created):
+                    result["access_code"] = create_random_string(40)
+                    submissions.append(APISubmission(
+                        stream=stream,
+                        translator=translation_server,
+                        access_code=result["access_code"],
+                    ))
+                APISubmission.objects.bulk_create(submissions)
+
+        return Response({"data": results}, status=status.HTTP_201_CREATED)
+
+
 class SubmissionRemove(generics.CreateAPIView):
     serializer_class = RemoveSerializer
 
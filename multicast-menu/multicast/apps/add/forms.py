@@ -1,6 +1,5 @@
 from django import forms
 from django.core.exceptions import ValidationError
-from django.core.validators import validate_ipv4_address
 
 from ..view.models import Stream
 
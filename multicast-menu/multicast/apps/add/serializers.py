@@ -9,6 +9,17 @@ class AddSerializer(serializers.Serializer):
     group = serializers.CharField(max_length=50)
 
 
+class BatchStreamSerializer(serializers.Serializer):
+    source = serializers.CharField(max_length=50)
+    group = serializers.CharField(max_length=50)
+
+
+class AddBatchSerializer(serializers.Serializer):
+    unique_identifier = serializers.CharField(max_length=40)
+
+    streams = BatchStreamSerializer(many=True)
+
+
 class RemoveSerializer(serializers.Serializer):
     unique_identifier = serializers.CharField(max_length=40) 
 
@@ -0,0 +1,362 @@
+"""
+Checks and benchmarks of the AMT gateway code, run from this directory:
+
+    python3 benchmark.py check
+    python3 benchmark.py codec --pcap ../../../../amt_traffic.pcap
+    python3 benchmark.py gateway --tunnels 1 10 100
+"""
+import argparse
+import multiprocessing as mp
+import os
+import random
+import secrets
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import psutil
+
+from scapy.all import IP, UDP, Packet, raw, rdpcap
+from scapy.contrib.igmpv3 import IGMPv3, IGMPv3gr, IGMPv3mr, IGMPv3mq
+
+import codec
+import control
+from constants import AMT_MEM_UPD, AMT_RELAY_DISCO, AMT_REQUEST, LOCAL_LOOPBACK
+from models import (
+    AMT_Discovery,
+    AMT_Membership_Query,
+    AMT_Membership_Update,
+    AMT_Multicast_Data,
+    AMT_Relay_Advertisement,
+    AMT_Relay_Request,
+    AMT_Teardown,
+)
+
+DEFAULT_PCAP = os.path.normpath(
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "..", "..", "amt_traffic.pcap")
+)
+
+
+def _random_ip():
+    return ".".join(str(random.randint(1, 254)) for _ in range(4))
+
+
+def _random_mac():
+    return secrets.token_bytes(6)
+
+
+def _mac_str(mac):
+    return ":".join(f"{b:02x}" for b in mac)
+
+
+def _expect(what, got, expected):
+    if got != expected:
+        raise AssertionError(f"{what}: got {got!r}, expected {expected!r}")
+
+
+def check_codec(iterations):
+    """
+    Check that the codec decodes what the scapy definitions in models.py encode, and encodes the same bytes.
+    """
+    for _ in range(iterations):
+        nonce = secrets.token_bytes(4)
+        mac = _random_mac()
+        addr = _random_ip()
+
+        data = raw(AMT_Discovery(nonce=nonce))
+        _expect("discovery", codec.decode(data), codec.Discovery(nonce))
+        _expect("discovery bytes", codec.encode_discovery(nonce), data)
+
+        data = raw(AMT_Relay_Advertisement(nonce=nonce, relay_addr=addr))
+        _expect("advertisement", codec.decode(data), codec.RelayAdvertisement(nonce, addr))
+        _expect("advertisement bytes", codec.encode_relay_advertisement(nonce, addr), data)
+
+        p_flag = random.randint(0, 1)
+        data = raw(AMT_Relay_Request(nonce=nonce, p_flag=p_flag))
+        _expect("request", codec.decode(data), codec.Request(nonce, p_flag))
+        _expect("request bytes", codec.encode_request(nonce, p_flag), data)
+
+        l_flag, g_flag = random.randint(0, 1), random.randint(0, 1)
+        query = raw(IP(src=addr, dst="224.0.0.1", ttl=1) / IGMPv3(type=0x11) / IGMPv3mq())
+        data = raw(AMT_Membership_Query(nonce=nonce, response_mac=_mac_str(mac), l_flag=l_flag, g_flag=g_flag) /
+                   IP(query))
+        decoded = codec.decode(data)
+        _expect("query", decoded._replace(encapsulated=bytes(decoded.encapsulated)),
+                codec.MembershipQuery(l_flag, g_flag, mac, nonce, query, None, None))
+        _expect("query bytes", codec.encode(decoded), data)
+        gateway = codec.encode_membership_query(mac, nonce, query, l_flag, 1, 2268, addr)
+        _expect("query with gateway", codec.decode(gateway)[5:], (2268, addr))
+
+        group, source = "232." + _random_ip().split(".", 1)[1], _random_ip()
+        # Built like tunnel.py built it with scapy, before it used codec.igmpv3_report().
+        report = (IP(src="0.0.0.0", dst="224.0.0.22", options=[Packet(b"\x00")]) / IGMPv3(type=34) /
+                  IGMPv3mr(records=[IGMPv3gr(maddr=group, srcaddrs=[source])]))
+        data = raw(AMT_Membership_Update(nonce=nonce, response_mac=_mac_str(mac)) / report)
+        decoded = codec.decode(data)
+        _expect("update", decoded._replace(encapsulated=bytes(decoded.encapsulated)),
+                codec.MembershipUpdate(mac, nonce, raw(report)))
+        _expect("update bytes", codec.encode_membership_update(mac, nonce, codec.igmpv3_report(group, source)), data)
+        data = raw(AMT_Membership_Update(nonce=nonce, response_mac=_mac_str(mac)))
+        _expect("empty update bytes", codec.encode_membership_update(mac, nonce), data)
+
+        payload = secrets.token_bytes(random.randint(0, 1400))
+        packet = raw(IP(src=source, dst=group) / UDP(sport=random.randint(1, 65535), dport=5000) / payload)
+        data = raw(AMT_Multicast_Data() / IP(packet))
+        _expect("data payload", bytes(codec.multicast_data_payload(data)), bytes(AMT_Multicast_Data(data)[UDP].payload))
+        _expect("data", bytes(codec.decode(data).encapsulated), packet)
+        _expect("data bytes", codec.encode_multicast_data(packet), data)
+
+        port = random.randint(1, 65535)
+        data = raw(AMT_Teardown(nonce=nonce, response_mac=_mac_str(mac), gw_port_num=port, gw_ip_addr=addr))
+        _expect("teardown", codec.decode(data), codec.Teardown(mac, nonce, port, addr))
+        _expect("teardown (RFC 7450)", codec.decode(codec.encode_teardown(mac, nonce, port, addr)),
+                codec.Teardown(mac, nonce, port, addr))
+
+    for data in (b"", b"\x16", raw(AMT_Discovery())[:5], b"\x06\x00" + bytes(30)):
+        try:
+            codec.multicast_data_payload(data) if data[:1] == b"\x06" else codec.decode(data)
+        except codec.AMTDecodeError:
+            continue
+        raise AssertionError(f"decoded invalid message {data!r}")
+
+
+def _cmd_check(args):
+    check_codec(args.iterations)
+    print(f"The codec matches the scapy definitions ({args.iterations} iterations).")
+
+
+def _data_messages(pcap):
+    """
+    Encapsulate the UDP payloads of a packet capture in AMT Multicast Data messages, as a relay would send them.
+    """
+    messages = []
+    for pkt in rdpcap(pcap):
+        if UDP not in pkt:
+            continue
+        ip = pkt[IP]
+        if pkt[UDP].sport == 2268 and raw(pkt[UDP].payload)[:1] == b"\x06":
+            messages.append(raw(pkt[UDP].payload))
+        else:
+            inner = IP(src=ip.src, dst="232.0.0.1") / UDP(sport=pkt[UDP].sport, dport=pkt[UDP].dport)
+            messages.append(raw(AMT_Multicast_Data() / inner / raw(pkt[UDP].payload)))
+    return messages
+
+
+def bench_codec(messages, loops):
+    """
+    :return: The time (in seconds) per message that scapy and the codec take to extract the UDP payload.
+    """
+    start = time.perf_counter()
+    for _ in range(loops):
+        for data in messages:
+            bytes(AMT_Multicast_Data(data)[UDP].payload)
+    scapy_time = (time.perf_counter() - start) / (loops * len(messages))
+    payload_of = codec.multicast_data_payload
+    start = time.perf_counter()
+    for _ in range(loops * 100):
+        for data in messages:
+            payload_of(data)
+    codec_time = (time.perf_counter() - start) / (loops * 100 * len(messages))
+    return scapy_time, codec_time
+
+
+def _cmd_codec(args):
+    messages = _data_messages(args.pcap)
+    if not messages:
+        sys.exit(f"{args.pcap} has no UDP datagrams.")
+    for data in messages:
+        _expect("payload", bytes(codec.multicast_data_payload(data)), bytes(AMT_Multicast_Data(data)[UDP].payload))
+    scapy_time, codec_time = bench_codec(messages, args.loops)
+    print(f"{len(messages)} multicast data messages from {args.pcap}")
+    print(f"scapy: {scapy_time * 1e6:8.2f} us/packet")
+    print(f"codec: {codec_time * 1e6:8.2f} us/packet ({scapy_time / codec_time:.0f}x)")
+
+
+def _fake_relay(port, pps, payload_size, ready, stop, memberships):
+    """
+    A minimal AMT relay on the loopback interface: it answers discoveries, requests and membership updates, and sends
+    each gateway that has joined a channel pps multicast data messages per second. The number of gateway addresses
+    that have joined is kept in memberships (an mp.Value).
+    """
+    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    s.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 8 * 1024 * 1024)
+    s.bind((LOCAL_LOOPBACK, port))
+    s.setblocking(False)
+    query = raw(IP(src=LOCAL_LOOPBACK, dst="224.0.0.1", ttl=1) / IGMPv3(type=0x11) / IGMPv3mq())
+    # The data message for each gateway (address) that has joined a channel.
+    joined = dict()
+    ready.set()
+    interval = 1 / pps
+    next_send = time.perf_counter()
+    while not stop.is_set():
+        while True:
+            try:
+                data, addr = s.recvfrom(2048)
+            except BlockingIOError:
+                break
+            msg = codec.decode(data)
+            if data[0] == AMT_RELAY_DISCO:
+                s.sendto(codec.encode_relay_advertisement(msg.nonce, LOCAL_LOOPBACK), addr)
+            elif data[0] == AMT_REQUEST:
+                s.sendto(codec.encode_membership_query(secrets.token_bytes(6), msg.nonce, query), addr)
+            elif data[0] == AMT_MEM_UPD and msg.encapsulated:
+                report = IP(bytes(msg.encapsulated))
+                record = report[IGMPv3mr].records[0]
+                packet = IP(src=record.srcaddrs[0], dst=record.maddr) / UDP(sport=5000, dport=5000)
+                packet /= bytes(payload_size)
+                joined[addr] = codec.encode_multicast_data(raw(packet))
+                memberships.value = len(joined)
+        now = time.perf_counter()
+        if joined and now >= next_send:
+            for addr, msg in joined.items():
+                try:
+                    s.sendto(msg, addr)
+                except BlockingIOError:
+                    pass
+            next_send = max(next_send + interval, now - 1)
+        else:
+            time.sleep(min(0.001, max(0.0, next_send - now)))
+    s.close()
+
+
+def _wait_for_gateway(socket_path, timeout=10):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            return control.list_tunnels(socket_path)
+        except control.GatewayError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.1)
+
+
+def _cpu_seconds(proc):
+    times = proc.cpu_times()
+    return times.user + times.system
+
+
+def _reference_rss():
+    """
+    :return: The RSS (in bytes) of a process that imports what every tunnel.py process imports, and the time it takes.
+    """
+    # The maximum RSS (getrusage()) would be inherited from this process, so the current RSS is measured.
+    code = "import time; t = time.perf_counter(); import psutil, codec, constants; " \
+           "print(psutil.Process().memory_info().rss, time.perf_counter() - t)"
+    out = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True,
+                         cwd=os.path.dirname(os.path.abspath(__file__))).stdout.split()
+    return int(out[0]), float(out[1])
+
+
+def _forwarded(socket_path):
+    """
+    :return: The number of packets that the gateway has forwarded to its consumers.
+    """
+    tunnels = control.list_tunnels(socket_path)["tunnels"]
+    return sum(consumer["packets"] for t in tunnels for consumer in t["consumers"])
+
+
+def bench_gateway(tunnel_counts, consumers, pps, payload_size, duration, relay_port):
+    """
+    Start the gateway and a fake relay, open tunnels (up to each of tunnel_counts) by subscribing consumers to as many
+    channels, and measure the gateway's memory and CPU usage with that many tunnels receiving pps packets per second
+    each and forwarding them to each of their consumers.
+
+    :return: A list of (tunnels, RSS in bytes, CPU seconds per second, packets forwarded per second, memberships at the
+    relay) tuples, the first one for the gateway without tunnels.
+    """
+    ready, stop = mp.Event(), mp.Event()
+    memberships = mp.Value("i", 0)
+    relay = mp.Process(target=_fake_relay, args=(relay_port, pps, payload_size, ready, stop, memberships))
+    relay.start()
+    ready.wait()
+    socket_path = os.path.join(tempfile.mkdtemp(), "gateway.sock")
+    gateway = subprocess.Popen(
+        [sys.executable, "gateway.py", "--control-socket", socket_path, "--log-level", "WARNING"],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+    )
+    results = []
+    try:
+        _wait_for_gateway(socket_path)
+        proc = psutil.Process(gateway.pid)
+        results.append((0, proc.memory_info().rss, 0.0, 0.0, 0))
+        opened = 0
+        for count in tunnel_counts:
+            for i in range(opened, count):
+                for j in range(consumers):
+                    control.subscribe(f"{i}-{j}", LOCAL_LOOPBACK, "10.0.0.1", f"232.1.{i // 250}.{i % 250 + 1}",
+                                      20000 + i * consumers + j, socket_path, relay_port)
+            opened = max(opened, count)
+            deadline = time.monotonic() + 10
+            while sum(t["state"] == "joined" for t in control.list_tunnels(socket_path)["tunnels"]) < opened:
+                if time.monotonic() > deadline:
+                    raise RuntimeError("the tunnels did not join")
+                time.sleep(0.1)
+            time.sleep(1)
+            packets = _forwarded(socket_path)
+            cpu = _cpu_seconds(proc)
+            start = time.perf_counter()
+            time.sleep(duration)
+            elapsed = time.perf_counter() - start
+            cpu = _cpu_seconds(proc) - cpu
+            packets = _forwarded(socket_path) - packets
+            results.append((opened, proc.memory_info().rss, cpu / elapsed, packets / elapsed, memberships.value))
+    finally:
+        gateway.terminate()
+        gateway.wait()
+        stop.set()
+        relay.join()
+    return results
+
+
+def _cmd_gateway(args):
+    results = bench_gateway(args.tunnels, args.consumers, args.pps, args.payload_size, args.duration, args.relay_port)
+    base_rss = results[0][1]
+    print(f"gateway without tunnels: RSS {base_rss / 2 ** 20:6.1f} MB")
+    for tunnels, rss, cpu, pps, memberships in results[1:]:
+        per_tunnel = (rss - base_rss) / tunnels / 1024
+        print(f"{tunnels:5d} tunnels: RSS {rss / 2 ** 20:6.1f} MB ({per_tunnel:6.1f} KB/tunnel), "
+              f"CPU {cpu * 100:5.1f}% ({cpu / pps * 1e6 if pps else 0:5.1f} us/packet), forwarded {pps:8.0f} pps "
+              f"of {tunnels * args.consumers * args.pps} pps, {memberships} memberships at the relay")
+    rss, import_time = _reference_rss()
+    print(f"one tunnel.py process per tunnel: RSS of the imports alone {rss / 2 ** 20:.1f} MB/tunnel "
+          f"({import_time:.2f} s to import psutil and the codec)")
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="Checks and benchmarks of the AMT gateway code.")
+    subparsers = ap.add_subparsers(dest="command", required=True)
+
+    sp = subparsers.add_parser("check", help="Check the codec against the scapy definitions in models.py.")
+    sp.add_argument("--iterations", type=int, default=200, help="Default: %(default)d")
+    sp.set_defaults(func=_cmd_check)
+
+    sp = subparsers.add_parser(
+        "codec", help="Time the extraction of the UDP payload from AMT multicast data, with scapy and with the codec."
+    )
+    sp.add_argument("--pcap", default=DEFAULT_PCAP,
+                    help="Packet capture whose UDP datagrams are encapsulated in AMT multicast data. "
+                         "Default: %(default)s")
+    sp.add_argument("--loops", type=int, default=2000, help="Default: %(default)d")
+    sp.set_defaults(func=_cmd_codec)
+
+    sp = subparsers.add_parser(
+        "gateway", help="Memory and CPU usage of the gateway (gateway.py) per tunnel, with a fake relay on the "
+                        "loopback interface."
+    )
+    sp.add_argument("--tunnels", type=int, nargs="+", default=[1, 10, 100],
+                    help="Numbers of tunnels to measure with. Default: %(default)s")
+    sp.add_argument("--consumers", type=int, default=1,
+                    help="Consumers subscribed to each tunnel's channel. Default: %(default)d")
+    sp.add_argument("--pps", type=int, default=100,
+                    help="Packets per second per tunnel (100 is about 1 Mbit/s). Default: %(default)d")
+    sp.add_argument("--payload-size", type=int, default=1316, help="Default: %(default)d")
+    sp.add_argument("--duration", type=float, default=5.0,
+                    help="Seconds to measure the CPU usage for (per number of tunnels). Default: %(default)s")
+    sp.add_argument("--relay-port", type=int, default=22680,
+                    help="Port of the fake relay on the loopback interface. Default: %(default)d")
+    sp.set_defaults(func=_cmd_gateway)
+
+    args = ap.parse_args()
+    args.func(args)
@@ -23,3 +23,18 @@ AMT_TEARDOWN = 7           # teardown (not currently supported)
 LOCAL_LOOPBACK = "127.0.0.1"
 MCAST_ANYCAST = "0.0.0.0"
 MCAST_ALLHOSTS = "224.0.0.22"
+
+################################################
+# Relays
+################################################
+AMT_PORT = 2268
+DEFAULT_RELAY = "amt-relay.m2icast.net"
+DEFAULT_RELAY_IPS = ["162.250.137.254", "162.250.136.101", "164.113.199.110"]
+
+################################################
+# Gateway (gateway.py)
+################################################
+HANDSHAKE_TIMEOUT = 5      # seconds to wait for a relay advertisement or membership query
+DATA_TIMEOUT = 30          # seconds without multicast data after which a tunnel reconnects
+RECONNECT_DELAY = 5        # seconds between attempts to connect a tunnel
+MEMBERSHIP_REFRESH = 60    # seconds between the requests that refresh a tunnel's membership
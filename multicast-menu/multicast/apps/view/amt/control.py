@@ -0,0 +1,100 @@
+"""
+Client of the control API of the AMT gateway daemon (gateway.py).
+
+The API is served on a Unix socket. Each request is one line of JSON, {"op": "subscribe" | "unsubscribe" | "list", ...},
+and is answered by one line of JSON, {"ok": true, "result": ...} or {"ok": false, "error": "..."}.
+
+The gateway has one tunnel (one AMT membership) per channel, a (relay, source, group) triple, and forwards the
+channel's payloads to each consumer subscribed to it. Consumers are identified by IDs chosen by the caller (e.g.,
+"tunnel-1" for the HLS packager of Tunnel 1).
+"""
+import json
+import os
+import socket
+
+SOCKET_PATH = os.environ.get("AMT_GATEWAY_SOCKET", "/tmp/amt_gateway.sock")
+TIMEOUT = 10.0
+
+
+class GatewayError(Exception):
+    """
+    Raised if the gateway is not reachable, or refuses a request.
+    """
+    pass
+
+
+def request(op, socket_path=None, timeout=TIMEOUT, **params):
+    """
+    Send a request to the gateway and wait for its answer.
+
+    :param op: The operation.
+    :param socket_path: Path of the gateway's control socket (SOCKET_PATH, if None).
+    :param timeout: Time (in seconds) to wait for the answer.
+    :param params: The operation's parameters (JSON serializable).
+
+    :return: The result of the operation.
+
+    :raise GatewayError: If the gateway is not reachable, or the operation failed.
+    """
+    socket_path = socket_path or SOCKET_PATH
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+            s.settimeout(timeout)
+            s.connect(socket_path)
+            s.sendall(json.dumps(dict(params, op=op)).encode() + b"\n")
+            with s.makefile("rb") as f:
+                line = f.readline()
+    except OSError as e:
+        raise GatewayError(f"the AMT gateway is not reachable at {socket_path}: {e}")
+    if not line:
+        raise GatewayError("the AMT gateway closed the connection")
+    answer = json.loads(line)
+    if not answer.get("ok"):
+        raise GatewayError(answer.get("error", "unknown error"))
+    return answer.get("result")
+
+
+def subscribe(consumer_id, relay, source, group, udp_port, socket_path=None, relay_port=None):
+    """
+    Subscribe a consumer to the (source, group) channel from the relay: the gateway forwards the channel's payloads to
+    udp_port on the loopback interface, and joins the channel only if no other consumer is subscribed to it already.
+    Subscribing a consumer that is already subscribed with the same parameters has no effect.
+
+    :param relay_port: AMT port of the relay (the gateway's default, if None).
+
+    :return: The consumer's stats (consumer_id, udp_port, packets, bytes and dropped), the stats of the channel's tunnel
+    (tunnel, see list_tunnels) and the gateway's PID (pid).
+    """
+    params = dict(consumer_id=consumer_id, relay=relay, source=source, group=group, udp_port=udp_port)
+    if relay_port is not None:
+        params["relay_port"] = relay_port
+    return request("subscribe", socket_path, **params)
+
+
+def unsubscribe(consumer_id, socket_path=None):
+    """
+    Unsubscribe a consumer. The gateway leaves the channel if it was the channel's last consumer.
+
+    :return: The consumer's final stats.
+    """
+    return request("unsubscribe", socket_path, consumer_id=consumer_id)
+
+
+def list_tunnels(socket_path=None):
+    """
+    :return: The gateway's PID and the stats of its tunnels: {"pid": ..., "tunnels": [...]}. The stats of a tunnel are
+    its channel (relay, relay_port, source and group), its local port (amt_port), its state ("connecting" or "joined"),
+    the relay address it is connected to, the packets and bytes received, the packets dropped (invalid), the number of
+    reconnects, the seconds since the tunnel was opened and since its last packet was received (None if none has been),
+    and the stats of its consumers (consumers).
+    """
+    return request("list", socket_path)
+
+
+def free_udp_port():
+    """
+    :return: A UDP port on the loopback interface that is free (at the time of the call), for a consumer to listen on.
+    """
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
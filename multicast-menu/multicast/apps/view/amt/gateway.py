@@ -0,0 +1,428 @@
+"""
+A single-process AMT gateway that serves many channels to many consumers.
+
+Each channel, a (source, group) pair received through an AMT relay, has exactly one AMT membership (one tunnel) in the
+gateway, however many consumers it has: the UDP payloads of the channel's multicast data are decapsulated once and
+distributed in-process to each of the channel's consumers (e.g., one that forwards them to a port on the loopback
+interface, where ffmpeg or VLC listens). The channel's membership is left when its last consumer unsubscribes. All
+channels are served by one asyncio event loop, and consumers are subscribed, unsubscribed and listed through the control
+API (see control.py), which the Celery tasks in apps/view/tasks.py call.
+
+The AMT messages are encoded and decoded by codec.py, and the control messages are sent on the tunnel's UDP socket (the
+one that receives the multicast data), so the gateway needs neither scapy nor raw sockets. Run it from this directory:
+
+    python3 gateway.py [--control-socket PATH]
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import secrets
+import signal
+import socket
+import time
+
+import codec
+import control
+from constants import (
+    AMT_MEM_QUERY,
+    AMT_MULT_DATA,
+    AMT_PORT,
+    AMT_RELAY_ADV,
+    DATA_TIMEOUT,
+    DEFAULT_RELAY,
+    DEFAULT_RELAY_IPS,
+    HANDSHAKE_TIMEOUT,
+    LOCAL_LOOPBACK,
+    MCAST_ANYCAST,
+    MEMBERSHIP_REFRESH,
+    RECONNECT_DELAY,
+)
+
+logger = logging.getLogger(__name__)
+
+
+class UDPConsumer:
+    """
+    A consumer that forwards the payloads of its channel to a port on the loopback interface.
+
+    Other consumers (e.g., ones that process the payloads in the gateway itself) only need the same attributes and
+    methods: consumer_id, deliver() and stats().
+    """
+
+    def __init__(self, consumer_id, udp_port, output):
+        """
+        :param consumer_id: ID of the consumer.
+        :param udp_port: Port on the loopback interface to forward the payloads to.
+        :param output: Non-blocking UDP socket to forward the payloads from (shared by the consumers).
+        """
+        self.consumer_id = consumer_id
+        self.udp_port = udp_port
+        self.packets = 0
+        self.bytes = 0
+        self.dropped = 0
+        self._output = output
+        self._addr = (LOCAL_LOOPBACK, udp_port)
+
+    def deliver(self, payload):
+        """
+        :param payload: A UDP payload of the channel (a memoryview, only valid during the call).
+        """
+        try:
+            self._output.sendto(payload, self._addr)
+        except OSError:
+            # The socket's buffer is full (the consumer does not keep up), or nobody listens on the port.
+            self.dropped += 1
+            return
+        self.packets += 1
+        self.bytes += len(payload)
+
+    def stats(self):
+        return {
+            "consumer_id": self.consumer_id, "udp_port": self.udp_port, "packets": self.packets, "bytes": self.bytes,
+            "dropped": self.dropped,
+        }
+
+
+class Tunnel(asyncio.DatagramProtocol):
+    """
+    The AMT tunnel of a channel: the handshake with the relay (discovery, request, membership update), the distribution
+    of the multicast data to the channel's consumers, the periodic refresh of the membership, and reconnecting (to the
+    next of the relay's addresses) if the data stops.
+    """
+
+    def __init__(self, relay, source, group, relay_port=AMT_PORT):
+        """
+        :param relay: Host name or IP address of the relay (DEFAULT_RELAY stands for DEFAULT_RELAY_IPS).
+        :param source: Source of the channel (IPv4).
+        :param group: Group of the channel (IPv4).
+        :param relay_port: AMT port of the relay.
+        """
+        self.relay = relay
+        self.source = source
+        self.group = group
+        self.relay_port = relay_port
+        self.amt_port = None
+        self.consumers = dict()
+        self.state = "connecting"
+        self.packets = 0
+        self.bytes = 0
+        self.dropped = 0
+        self.reconnects = 0
+        self._name = f"({source}, {group}) from {relay}"
+        self._opened = time.monotonic()
+        self._last_packet = None
+        self._relay_addr = None
+        self._nonce = None
+        self._report = codec.igmpv3_report(group, source)
+        # The message type that the handshake waits for, and the future that receives it.
+        self._expected = None
+        self._waiter = None
+        self._transport = None
+        self._task = None
+
+    @property
+    def key(self):
+        return self.relay, self.relay_port, self.source, self.group
+
+    def stats(self):
+        now = time.monotonic()
+        return dict(
+            relay=self.relay,
+            relay_port=self.relay_port,
+            source=self.source,
+            group=self.group,
+            amt_port=self.amt_port,
+            state=self.state,
+            relay_addr=self._relay_addr[0] if self._relay_addr else None,
+            packets=self.packets,
+            bytes=self.bytes,
+            dropped=self.dropped,
+            reconnects=self.reconnects,
+            uptime=round(now - self._opened, 3),
+            idle=round(now - self._last_packet, 3) if self._last_packet is not None else None,
+            consumers=[consumer.stats() for consumer in self.consumers.values()],
+        )
+
+    async def start(self):
+        """
+        Bind the tunnel's UDP socket (to an ephemeral port) and start connecting to the relay.
+        """
+        loop = asyncio.get_running_loop()
+        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+        s.bind(("", 0))
+        self.amt_port = s.getsockname()[1]
+        self._transport, _ = await loop.create_datagram_endpoint(lambda: self, sock=s)
+        self._task = loop.create_task(self._run())
+
+    def close(self):
+        if self._task is not None:
+            self._task.cancel()
+        if self._transport is not None:
+            self._transport.close()
+        self.state = "closed"
+
+    def datagram_received(self, data, addr):
+        if data and data[0] == AMT_MULT_DATA:
+            try:
+                payload = codec.multicast_data_payload(data)
+            except codec.AMTDecodeError:
+                self.dropped += 1
+                return
+            self.packets += 1
+            self.bytes += len(payload)
+            self._last_packet = time.monotonic()
+            for consumer in self.consumers.values():
+                consumer.deliver(payload)
+            return
+        try:
+            msg = codec.decode(data)
+        except codec.AMTDecodeError as e:
+            logger.debug(f"Tunnel {self._name}: dropped invalid AMT message from {addr}: {e}")
+            self.dropped += 1
+            return
+        if getattr(msg, "nonce", None) != self._nonce:
+            logger.debug(f"Tunnel {self._name}: dropped AMT message with a stale nonce from {addr}")
+            return
+        if self._waiter is not None and data[0] == self._expected and not self._waiter.done():
+            self._waiter.set_result(msg)
+        elif data[0] == AMT_MEM_QUERY and self.state == "joined":
+            # The answer to a refresh of the membership.
+            self._send_update(msg.response_mac)
+
+    def error_received(self, exc):
+        logger.debug(f"Tunnel {self._name}: {exc}")
+
+    async def _relay_ips(self):
+        if self.relay == DEFAULT_RELAY:
+            return DEFAULT_RELAY_IPS
+        infos = await asyncio.get_running_loop().getaddrinfo(
+            self.relay, self.relay_port, family=socket.AF_INET, type=socket.SOCK_DGRAM
+        )
+        return list(dict.fromkeys(info[4][0] for info in infos))
+
+    async def _run(self):
+        attempt = 0
+        while True:
+            try:
+                relay_ips = await self._relay_ips()
+                await self._connect(relay_ips[attempt % len(relay_ips)])
+                await self._forward()
+            except asyncio.TimeoutError:
+                logger.warning(f"Tunnel {self._name}: the relay did not answer.")
+            except OSError as e:
+                logger.warning(f"Tunnel {self._name}: {e}")
+            except Exception:
+                logger.exception(f"Tunnel {self._name}: unexpected error")
+            self.state = "connecting"
+            self.reconnects += 1
+            attempt += 1
+            await asyncio.sleep(RECONNECT_DELAY)
+
+    async def _exchange(self, msg, addr, expected):
+        """
+        Send a handshake message and wait for the relay's answer (of the expected type, and with the tunnel's nonce).
+        """
+        self._expected = expected
+        self._waiter = asyncio.get_running_loop().create_future()
+        try:
+            self._transport.sendto(msg, addr)
+            return await asyncio.wait_for(self._waiter, HANDSHAKE_TIMEOUT)
+        finally:
+            self._waiter = None
+
+    async def _connect(self, relay_ip):
+        self._nonce = secrets.token_bytes(4)
+        addr = (relay_ip, self.relay_port)
+        logger.info(f"Tunnel {self._name}: sending AMT relay discovery to {relay_ip}")
+        advertisement = await self._exchange(codec.encode_discovery(self._nonce), addr, AMT_RELAY_ADV)
+        # The relay may advertise another address to send the requests to (an IPv4 one, as the tunnel's socket is IPv4).
+        if ":" not in advertisement.relay_addr and advertisement.relay_addr != MCAST_ANYCAST:
+            addr = (advertisement.relay_addr, self.relay_port)
+        query = await self._exchange(codec.encode_request(self._nonce), addr, AMT_MEM_QUERY)
+        self._relay_addr = addr
+        self._send_update(query.response_mac)
+        self.state = "joined"
+        logger.info(f"Tunnel {self._name}: joined through {addr[0]}")
+
+    def _send_update(self, response_mac):
+        msg = codec.encode_membership_update(response_mac, self._nonce, self._report)
+        self._transport.sendto(msg, self._relay_addr)
+
+    async def _forward(self):
+        """
+        Refresh the membership every MEMBERSHIP_REFRESH seconds (the relay answers the request with a query, which
+        datagram_received() answers), until no data has been received for DATA_TIMEOUT seconds.
+        """
+        joined = time.monotonic()
+        next_refresh = joined + MEMBERSHIP_REFRESH
+        while True:
+            now = time.monotonic()
+            last_data = max(joined, self._last_packet or joined)
+            if now - last_data >= DATA_TIMEOUT:
+                logger.warning(f"Tunnel {self._name}: no data for {DATA_TIMEOUT} seconds, reconnecting.")
+                return
+            if now >= next_refresh:
+                self._transport.sendto(codec.encode_request(self._nonce), self._relay_addr)
+                next_refresh = now + MEMBERSHIP_REFRESH
+            await asyncio.sleep(min(next_refresh, last_data + DATA_TIMEOUT) - now)
+
+
+class Gateway:
+    """
+    The tunnels (one per channel) and the consumers of the gateway, and the server of the control API.
+    """
+
+    def __init__(self):
+        # The tunnels by channel (see Tunnel.key), and the consumers by ID.
+        self.tunnels = dict()
+        self.consumers = dict()
+        # The tunnel of each consumer.
+        self._tunnel_of = dict()
+        self._output = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+        self._output.setblocking(False)
+        self._lock = asyncio.Lock()
+
+    async def subscribe(self, consumer, relay, source, group, relay_port=AMT_PORT):
+        """
+        Subscribe a consumer to a channel, opening the channel's tunnel if it has none yet. A consumer with the same ID
+        replaces the one that is already subscribed (which is unsubscribed first if it is subscribed to another
+        channel, without closing the tunnel of this one).
+
+        :return: The stats of the channel's tunnel.
+        """
+        async with self._lock:
+            for addr in (source, group):
+                socket.inet_aton(addr)
+            key = (relay, relay_port, source, group)
+            previous = self._tunnel_of.get(consumer.consumer_id)
+            if previous is not None and previous.key != key:
+                self.unsubscribe(consumer.consumer_id)
+            tunnel = self.tunnels.get(key)
+            if tunnel is None:
+                tunnel = Tunnel(relay, source, group, relay_port)
+                await tunnel.start()
+                self.tunnels[key] = tunnel
+                logger.info(f"Opened the tunnel of ({source}, {group}) from {relay}")
+            tunnel.consumers[consumer.consumer_id] = consumer
+            self.consumers[consumer.consumer_id] = consumer
+            self._tunnel_of[consumer.consumer_id] = tunnel
+            logger.info(f"Subscribed {consumer.consumer_id} to ({source}, {group}) from {relay} "
+                        f"({len(tunnel.consumers)} consumers)")
+            return tunnel.stats()
+
+    async def subscribe_udp(self, consumer_id, relay, source, group, udp_port, relay_port=AMT_PORT):
+        """
+        Subscribe a consumer that forwards the channel's payloads to udp_port on the loopback interface. Subscribing a
+        consumer that is already subscribed with the same parameters has no effect.
+
+        :return: The stats of the consumer, and of its channel's tunnel (tunnel).
+
+        :raise ValueError: If udp_port is not a port number.
+        """
+        if not isinstance(udp_port, int) or isinstance(udp_port, bool) or not 0 < udp_port < 65536:
+            raise ValueError(f"invalid port {udp_port!r}")
+        consumer = self.consumers.get(consumer_id)
+        tunnel = self._tunnel_of.get(consumer_id)
+        if consumer is None or tunnel.key != (relay, relay_port, source, group) \
+                or getattr(consumer, "udp_port", None) != udp_port:
+            for other in self.consumers.values():
+                if other.consumer_id != consumer_id and getattr(other, "udp_port", None) == udp_port:
+                    raise ValueError(f"port {udp_port} is already used by consumer {other.consumer_id}")
+            consumer = UDPConsumer(consumer_id, udp_port, self._output)
+            await self.subscribe(consumer, relay, source, group, relay_port)
+            tunnel = self._tunnel_of[consumer_id]
+        return dict(consumer.stats(), tunnel=tunnel.stats())
+
+    def unsubscribe(self, consumer_id):
+        """
+        Unsubscribe a consumer from its channel, and close the channel's tunnel if it was the last consumer.
+
+        :return: The final stats of the consumer.
+        """
+        consumer = self.consumers.pop(consumer_id, None)
+        if consumer is None:
+            raise ValueError(f"no consumer {consumer_id}")
+        tunnel = self._tunnel_of.pop(consumer_id)
+        del tunnel.consumers[consumer_id]
+        logger.info(f"Unsubscribed {consumer_id} ({len(tunnel.consumers)} consumers left)")
+        if not tunnel.consumers:
+            tunnel.close()
+            del self.tunnels[tunnel.key]
+            logger.info(f"Closed the tunnel of ({tunnel.source}, {tunnel.group}) from {tunnel.relay}")
+        return consumer.stats()
+
+    def close_all(self):
+        for consumer_id in list(self.consumers):
+            self.unsubscribe(consumer_id)
+
+    async def _handle(self, req):
+        if not isinstance(req, dict):
+            raise ValueError("the request must be a JSON object")
+        op = req.pop("op", None)
+        if op == "subscribe":
+            return dict(await self.subscribe_udp(**req), pid=os.getpid())
+        if op == "unsubscribe":
+            return self.unsubscribe(req["consumer_id"])
+        if op == "list":
+            return {"pid": os.getpid(), "tunnels": [tunnel.stats() for tunnel in self.tunnels.values()]}
+        raise ValueError(f"unknown operation {op!r}")
+
+    async def _serve_client(self, reader, writer):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                try:
+                    answer = {"ok": True, "result": await self._handle(json.loads(line))}
+                except (ValueError, KeyError, TypeError, OSError) as e:
+                    answer = {"ok": False, "error": f"{type(e).__name__}: {e}"}
+                writer.write(json.dumps(answer).encode() + b"\n")
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, socket_path):
+        """
+        Serve the control API on a Unix socket until the process is terminated (SIGTERM or SIGINT).
+        """
+        if os.path.exists(socket_path):
+            try:
+                with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+                    s.connect(socket_path)
+            except OSError:
+                # Left behind by a gateway that did not shut down cleanly.
+                os.unlink(socket_path)
+            else:
+                raise SystemExit(f"Another gateway is serving {socket_path}")
+        server = await asyncio.start_unix_server(self._serve_client, socket_path)
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(sig, stop.set)
+        logger.info(f"AMT gateway (PID {os.getpid()}) serving the control API on {socket_path}")
+        try:
+            await stop.wait()
+        finally:
+            server.close()
+            self.close_all()
+            os.unlink(socket_path)
+            logger.info("AMT gateway stopped")
+
+
+async def main(socket_path):
+    await Gateway().serve(socket_path)
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="AMT gateway that serves many channels to many consumers in one process.")
+    ap.add_argument("--control-socket", default=control.SOCKET_PATH,
+                    help="Unix socket to serve the control API on. Default: %(default)s")
+    ap.add_argument("--log-level", default="INFO", help="Default: %(default)s")
+    args = ap.parse_args()
+    logging.basicConfig(level=args.log_level, format="%(asctime)s - %(levelname)s - %(message)s")
+    asyncio.run(main(args.control_socket))
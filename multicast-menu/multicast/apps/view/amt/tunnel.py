@@ -2,21 +2,21 @@ import socket
 import struct
 import sys
 import logging
-from scapy.all import send, IP, UDP, Packet
-from scapy.contrib.igmpv3 import IGMPv3, IGMPv3gr, IGMPv3mr
 import secrets
 from datetime import datetime
 import time
 import psutil
 import random
 
-from constants import DEFAULT_MTU, LOCAL_LOOPBACK, MCAST_ALLHOSTS, MCAST_ANYCAST
-from models import (
-    AMT_Discovery,
-    AMT_Relay_Request,
-    AMT_Membership_Query,
-    AMT_Membership_Update,
-    AMT_Multicast_Data,
+import codec
+from codec import AMTDecodeError, multicast_data_payload
+from constants import (
+    AMT_MEM_QUERY,
+    AMT_PORT,
+    DEFAULT_MTU,
+    DEFAULT_RELAY,
+    DEFAULT_RELAY_IPS,
+    LOCAL_LOOPBACK,
 )
 
 # Set up logging
@@ -33,11 +33,6 @@ console_handler = logging.StreamHandler()
 console_handler.setLevel(logging.INFO)
 logger.addHandler(console_handler)
 
-# Define the default relay and its IP addresses
-DEFAULT_RELAY = "amt-relay.m2icast.net"
-DEFAULT_RELAY_IPS = ["162.250.137.254", "162.250.136.101", "164.113.199.110"]
-
-
 def setup_socket(amt_port):
     s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
     s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
@@ -47,45 +42,30 @@ def setup_socket(amt_port):
     return s
 
 
-def send_amt_discovery(ip_layer, udp_layer, nonce):
-    amt_layer = AMT_Discovery()
-    amt_layer.setfieldval("nonce", nonce)
-    discovery_packet = ip_layer / udp_layer / amt_layer
-    send(discovery_packet)
-    logger.info(
-        f"Sent AMT relay discovery to {ip_layer.dst}:2268 with nonce {nonce.hex()}"
-    )
+# The AMT messages are sent on the socket that receives the multicast data (s), from the port the relay answers to, so
+# no raw socket (and no root privilege) is needed and NAT keeps one mapping for both directions.
 
 
-def send_amt_request(ip_layer, udp_layer, nonce):
-    amt_layer = AMT_Relay_Request()
-    amt_layer.setfieldval("nonce", nonce)
-    request_packet = ip_layer / udp_layer / amt_layer
-    send(request_packet)
+def send_amt_discovery(s, relay_addr, nonce):
+    s.sendto(codec.encode_discovery(nonce), relay_addr)
     logger.info(
-        f"Sent AMT relay request to {ip_layer.dst}:2268 with nonce {nonce.hex()}"
+        f"Sent AMT relay discovery to {relay_addr[0]}:{relay_addr[1]} with nonce {nonce.hex()}"
     )
 
 
-def send_membership_update(ip_layer, udp_layer, nonce, response_mac, multicast, source):
-    amt_layer = AMT_Membership_Update()
-    amt_layer.setfieldval("nonce", nonce)
-    amt_layer.setfieldval("response_mac", response_mac)
-
-    options_pkt = Packet(b"\x00")
-    ip_layer2 = IP(src=MCAST_ANYCAST, dst=MCAST_ALLHOSTS, options=[options_pkt])
-
-    igmp_layer = IGMPv3()
-    igmp_layer.type = 34
+def send_amt_request(s, relay_addr, nonce):
+    s.sendto(codec.encode_request(nonce), relay_addr)
+    logger.info(
+        f"Sent AMT relay request to {relay_addr[0]}:{relay_addr[1]} with nonce {nonce.hex()}"
+    )
 
-    igmp_layer2 = IGMPv3mr(records=[IGMPv3gr(maddr=multicast, srcaddrs=[source])])
 
-    membership_update_packet = (
-        ip_layer / udp_layer / amt_layer / ip_layer2 / igmp_layer / igmp_layer2
-    )
-    send(membership_update_packet)
+def send_membership_update(s, relay_addr, nonce, response_mac, multicast, source):
+    report = codec.igmpv3_report(multicast, source)
+    s.sendto(codec.encode_membership_update(response_mac, nonce, report), relay_addr)
     logger.info(
-        f"Sent AMT multicast membership update to {ip_layer.dst}:2268 for group {multicast} from source {source}"
+        f"Sent AMT multicast membership update to {relay_addr[0]}:{relay_addr[1]} "
+        f"for group {multicast} from source {source}"
     )
 
 
@@ -111,43 +91,44 @@ def setup_amt_tunnel(relay, amt_port, multicast, source):
     logger.info(f"Socket set up on port {amt_port}")
 
     relay_ip = get_relay_ip(relay)
-    ip_layer = IP(dst=relay_ip)
-    udp_layer = UDP(sport=amt_port, dport=2268)
+    relay_addr = (relay_ip, AMT_PORT)
     nonce = secrets.token_bytes(4)
 
     logger.debug(f"Sending AMT discovery to relay {relay_ip}")
-    send_amt_discovery(ip_layer, udp_layer, nonce)
+    send_amt_discovery(s, relay_addr, nonce)
 
     try:
         data, addr = s.recvfrom(8192)
         logger.info(f"Received {len(data)} bytes from relay {addr}")
     except socket.timeout:
         logger.error("Timeout: Did not receive any response from the relay")
+        s.close()
         return False, None, None, None, None
     except Exception as e:
         logger.error(f"Failed to receive data from relay: {e}")
+        s.close()
         return False, None, None, None, None
 
     logger.debug(f"Sending AMT request to relay {relay_ip}")
-    send_amt_request(ip_layer, udp_layer, nonce)
+    send_amt_request(s, relay_addr, nonce)
 
     try:
         data, addr = s.recvfrom(DEFAULT_MTU)
-        membership_query = AMT_Membership_Query(data)
-        response_mac = membership_query.response_mac
+        response_mac = codec.decode(data).response_mac
         logger.info(
-            f"Received AMT multicast membership query from {addr} with response MAC {response_mac.hex() if isinstance(response_mac, bytes) else response_mac}"
+            f"Received AMT multicast membership query from {addr} with response MAC {response_mac.hex()}"
         )
     except Exception as e:
         logger.error(f"Failed to receive or process membership query: {e}")
+        s.close()
         return False, None, None, None, None
 
     req = struct.pack("=4sl", socket.inet_aton(multicast), socket.INADDR_ANY)
     s.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, req)
 
     logger.debug(f"Sending membership update to relay {relay_ip}")
-    send_membership_update(ip_layer, udp_layer, nonce, response_mac, multicast, source)
-    return True, s, ip_layer, udp_layer, nonce, response_mac
+    send_membership_update(s, relay_addr, nonce, response_mac, multicast, source)
+    return True, s, relay_addr, nonce, response_mac
 
 
 def main(relay, source, multicast, amt_port, udp_port):
@@ -156,6 +137,10 @@ def main(relay, source, multicast, amt_port, udp_port):
     packet_count = 0
     last_packet_time = time.time()
     local_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+    s = None
+    # Datagrams are received into this buffer, and their payloads forwarded from it without copying.
+    buf = bytearray(DEFAULT_MTU)
+    view = memoryview(buf)
     relay_index = 0
     max_reconnect_attempts = 5
     reconnect_delay = 5
@@ -165,7 +150,7 @@ def main(relay, source, multicast, amt_port, udp_port):
         while reconnect_attempts < max_reconnect_attempts:
             try:
                 current_relay = DEFAULT_RELAY_IPS[relay_index] if relay == DEFAULT_RELAY else relay
-                success, s, ip_layer, udp_layer, nonce, response_mac = setup_amt_tunnel(current_relay, amt_port, multicast, source)
+                success, s, relay_addr, nonce, response_mac = setup_amt_tunnel(current_relay, amt_port, multicast, source)
 
                 if not success:
                     logger.warning(f"Failed to set up AMT tunnel with relay {current_relay}. Trying next relay.")
@@ -178,10 +163,22 @@ def main(relay, source, multicast, amt_port, udp_port):
 
                 while True:
                     try:
-                        data, _ = s.recvfrom(DEFAULT_MTU)
-                        amt_packet = AMT_Multicast_Data(data)
-                        raw_udp = bytes(amt_packet[UDP].payload)
-                        local_socket.sendto(raw_udp, (LOCAL_LOOPBACK, udp_port))
+                        n = s.recv_into(buf)
+                        try:
+                            payload = multicast_data_payload(view[:n])
+                        except AMTDecodeError as err:
+                            if n and buf[0] == AMT_MEM_QUERY:
+                                # The relay queries the membership periodically, answer it to keep it alive.
+                                try:
+                                    response_mac = codec.decode(view[:n]).response_mac
+                                except AMTDecodeError as err:
+                                    logger.debug(f"Dropped invalid AMT membership query: {err}")
+                                    continue
+                                send_membership_update(s, relay_addr, nonce, response_mac, multicast, source)
+                            else:
+                                logger.debug(f"Dropped invalid AMT multicast data: {err}")
+                            continue
+                        local_socket.sendto(payload, (LOCAL_LOOPBACK, udp_port))
 
                         packet_count += 1
                         last_packet_time = time.time()
@@ -193,8 +190,8 @@ def main(relay, source, multicast, amt_port, udp_port):
                         if time.time() - last_packet_time > 30:
                             logger.warning("No data received for 30 seconds, sending heartbeat")
                             try:
-                                heartbeat_packet = ip_layer / udp_layer / AMT_Membership_Update()
-                                send(heartbeat_packet)
+                                # A request, which the relay answers with a query, which refreshes the membership.
+                                send_amt_request(s, relay_addr, nonce)
                             except Exception as e:
                                 logger.error(f"Failed to send heartbeat: {e}")
                                 raise  # Re-raise to trigger reconnection
@@ -0,0 +1,18 @@
+# Generated by Django 3.2.15 on 2026-10-18 10:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('view', '0016_tunnel_amt_gateway_pid'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='tunnel',
+            name='udp_port',
+            field=models.IntegerField(blank=True, null=True, unique=True),
+        ),
+    ]
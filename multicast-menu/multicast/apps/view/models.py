@@ -1,7 +1,9 @@
 from django.contrib.auth import get_user_model
 from django.contrib.auth.models import User
-from django.db import models, transaction
+from django.db import IntegrityError, models, transaction
 from django.db.models import F
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
 from django.utils import timezone
 
 from ...settings import TRENDING_STREAM_USAGE_WEIGHT, TRENDING_STREAM_MAX_SIZE, TRENDING_STREAM_INIT_SCORE
@@ -101,7 +103,9 @@ class Stream(models.Model):
 
     # Returns the URL address of the stream
     def get_url(self):
-        url = "amt://" + self.source + "@" + self.group
+        # IPv6 addresses are enclosed in brackets, so that the group cannot be confused with the port
+        source, group = (f"[{ip}]" if ":" in ip else ip for ip in (self.source, self.group))
+        url = "amt://" + source + "@" + group
         if self.udp_port:
             url = url + ":" + str(self.udp_port)
         return url
@@ -213,6 +217,11 @@ class TrendingStream(models.Model):
         return count + 1
 
 
+# The ports that the AMT gateway forwards the streams of the tunnels to, below the ephemeral port range (32768 and up on
+# Linux) that the gateway's tunnels and the previews take their ports from.
+TUNNEL_UDP_PORTS = range(4000, 32000)
+
+
 class Tunnel(models.Model):
     stream = models.OneToOneField(Stream, on_delete=models.CASCADE, related_name="tunnel")
     
@@ -221,18 +230,47 @@ class Tunnel(models.Model):
     amt_gateway_pid = models.IntegerField(blank=True, null=True)
     ffmpeg_up = models.BooleanField(default=False)
     ffmpeg_pid = models.IntegerField(blank=True, null=True)
+    udp_port = models.IntegerField(unique=True, blank=True, null=True)
     
     def __str__(self):
         return "Tunnel for {}".format(self.stream)
 
-    def get_amt_port_number(self):
-        return (self.id % 1000) + 2000
-
     def get_udp_port_number(self):
-        return (self.id % 1000) + 4000
+        """
+        Returns the tunnel's UDP port, allocating the lowest port of TUNNEL_UDP_PORTS that no other tunnel holds on
+        first use. The port is kept until the tunnel is deleted.
+        """
+        while self.udp_port is None:
+            used = set(Tunnel.objects.exclude(udp_port=None).values_list("udp_port", flat=True))
+            port = next((port for port in TUNNEL_UDP_PORTS if port not in used), None)
+            if port is None:
+                raise RuntimeError("All UDP ports for tunnels are in use")
+            try:
+                with transaction.atomic():
+                    # Only if the port has not been allocated meanwhile (e.g., by start_ffmpeg and open_tunnel, which
+                    # run concurrently)
+                    Tunnel.objects.filter(id=self.id, udp_port=None).update(udp_port=port)
+            except IntegrityError:
+                # Another tunnel took the port meanwhile, try the next one
+                continue
+            self.refresh_from_db(fields=["udp_port"])
+        return self.udp_port
 
     def get_filename(self):
         return "index{}-.m3u8".format(self.id)
 
     def ready_for_viewing(self):
         return self.amt_gateway_up and self.ffmpeg_up
+
+
+@receiver(post_delete, sender=Tunnel)
+def close_deleted_tunnel(sender, instance, **kwargs):
+    """
+    Unsubscribe a deleted tunnel (e.g., deleted with its stream) from the AMT gateway, which leaves the stream if no
+    other consumer is subscribed to it.
+    """
+    # Imported here, as the tasks import the models
+    from .tasks import close_tunnel
+
+    tunnel_id = instance.id
+    transaction.on_commit(lambda: close_tunnel.delay(tunnel_id))
@@ -9,8 +9,9 @@ from django.shortcuts import get_object_or_404
 from django.core.files.storage import default_storage
 from django.core.files.base import ContentFile
 
-from ...settings import MEDIA_ROOT, BASE_DIR
-from .amt.constants import LOCAL_LOOPBACK
+from ...settings import MEDIA_ROOT
+from .amt import control as amt_gateway
+from .amt.constants import DEFAULT_RELAY, LOCAL_LOOPBACK
 from .models import Stream, Tunnel
 from .util.stream_preview import snapshot_multicast_stream, resize_image
 import logging
@@ -28,8 +29,24 @@ def create_preview_for_stream(stream_id):
     stream = Stream.objects.get(id=stream_id)
 
     with tempfile.TemporaryDirectory() as temp_dir:
-        amt_relay = stream.amt_relay or "amt-relay.m2icast.net"
-        snapshot_multicast_stream(stream.get_url(), amt_relay, temp_dir)
+        amt_relay = stream.amt_relay or DEFAULT_RELAY
+        # Take the snapshots from the AMT gateway, which shares its membership of the channel with the stream's tunnel
+        # (if it has one), instead of letting VLC join the channel through the relay itself.
+        consumer_id = f"preview-{stream_id}"
+        udp_port = amt_gateway.free_udp_port()
+        try:
+            amt_gateway.subscribe(consumer_id, amt_relay, stream.source, stream.group, udp_port)
+        except amt_gateway.GatewayError as e:
+            logger.warning(f"Taking the snapshots of stream {stream_id} through {amt_relay}: {str(e)}")
+            snapshot_multicast_stream(stream.get_url(), amt_relay, temp_dir)
+        else:
+            try:
+                snapshot_multicast_stream(f"udp://@{LOCAL_LOOPBACK}:{udp_port}", amt_relay, temp_dir)
+            finally:
+                try:
+                    amt_gateway.unsubscribe(consumer_id)
+                except amt_gateway.GatewayError as e:
+                    logger.warning(f"Failed to unsubscribe {consumer_id}: {str(e)}")
 
         snapshots = os.listdir(temp_dir)
         if snapshots:
@@ -50,39 +67,50 @@ def create_preview_for_stream(stream_id):
 
 @shared_task
 def open_tunnel(tunnel_id):
+    """
+    Subscribes the tunnel to its stream in the AMT gateway daemon (amt/gateway.py), which forwards the stream to the
+    tunnel's UDP port. The gateway joins the stream only once, however many consumers are subscribed to it.
+    """
     tunnel = get_object_or_404(Tunnel, id=tunnel_id)
 
-    relay = tunnel.stream.amt_relay or "amt-relay.m2icast.net"
-    command = [
-        "pipenv", "run", "python3",
-        os.path.join(BASE_DIR, "apps", "view", "amt", "tunnel.py"),
-        relay,
-        tunnel.stream.source,
-        tunnel.stream.group,
-        str(tunnel.get_amt_port_number()),
-        str(tunnel.get_udp_port_number())
-    ]
-
-    log_file_path = os.path.join(BASE_DIR, "logs", "tunnels", f"tunnel_{tunnel_id}_{int(time.time())}.log")
-    os.makedirs(os.path.dirname(log_file_path), exist_ok=True)
-
+    relay = tunnel.stream.amt_relay or DEFAULT_RELAY
     try:
-        with open(log_file_path, "a") as log_file:
-            proc = subprocess.Popen(command, stdout=log_file, stderr=subprocess.STDOUT)
-
-        tunnel.amt_gateway_pid = proc.pid
-        tunnel.log_file_path = log_file_path
-        tunnel.amt_gateway_up = True
-        tunnel.save()
-
-        return f"Tunnel opened for {tunnel_id} with PID {proc.pid}"
-    except subprocess.SubprocessError as e:
-        with open(log_file_path, "a") as log_file:
-            log_file.write(f"Failed to open tunnel for {tunnel_id}: {str(e)}\n")
+        result = amt_gateway.subscribe(
+            f"tunnel-{tunnel_id}",
+            relay,
+            tunnel.stream.source,
+            tunnel.stream.group,
+            tunnel.get_udp_port_number(),
+        )
+    except amt_gateway.GatewayError as e:
+        logger.error(f"Failed to open tunnel {tunnel_id}: {str(e)}")
         tunnel.amt_gateway_up = False
         tunnel.save()
         raise
 
+    tunnel.amt_gateway_pid = result["pid"]
+    tunnel.amt_gateway_up = True
+    tunnel.save()
+
+    return f"Tunnel opened for {tunnel_id} in the AMT gateway with PID {result['pid']}"
+
+
+@shared_task
+def close_tunnel(tunnel_id):
+    """
+    Unsubscribes the tunnel in the AMT gateway daemon, which leaves the stream if no other consumer is subscribed to it.
+    """
+    try:
+        stats = amt_gateway.unsubscribe(f"tunnel-{tunnel_id}")
+    except amt_gateway.GatewayError as e:
+        logger.warning(f"Failed to close tunnel {tunnel_id}: {str(e)}")
+        stats = None
+    Tunnel.objects.filter(id=tunnel_id).update(amt_gateway_up=False, amt_gateway_pid=None)
+
+    if stats is None:
+        return f"Tunnel {tunnel_id} could not be closed in the AMT gateway"
+    return f"Tunnel closed for {tunnel_id} after forwarding {stats['packets']} packets ({stats['bytes']} bytes)"
+
 
 @shared_task
 def start_ffmpeg(tunnel_id):
@@ -258,9 +258,7 @@ def open_file(request, stream_id):
 
     response = HttpResponse()
     response["Content-Disposition"] = 'attachment; filename="playlist.m3u"'
-    response.write("amt://{}@{}".format(stream.source, stream.group))
-    if stream.udp_port:
-        response.write(":{}".format(stream.udp_port))
+    response.write(stream.get_url())
 
     return response
 
@@ -169,6 +169,9 @@ TRENDING_STREAM_INIT_SCORE = 1.0
 TRENDING_STREAM_MAX_SIZE = 20
 TRENDING_STREAM_MAX_VISIBLE_SIZE = 10
 
+# Maximum number of streams per request to the bulk API endpoint (api/add/batch/)
+API_ADD_BATCH_MAX_SIZE = 500
+
 # Check for Heroku environment
 if "DATABASE_URL" in os.environ:
     DATABASES = {"default": dj_database_url.config()}
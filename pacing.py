@@ -0,0 +1,235 @@
+"""
+Pacing of the translated streams.
+
+Unicast sources behind lossy paths often deliver their packets in bursts, which the translator would otherwise re-emit
+as bursts to the multicast tree (where they cause drops at the downstream AMT relays). The Pacer holds back the packets
+of a burst in a bounded jitter buffer and releases them at the stream's bitrate, which is measured either from the
+packets' arrival (over windows of PACING_RATE_WINDOW_S seconds) or from the PCRs (Program Clock References) of the
+MPEG-TS packets they carry. Pacing is slightly faster than the measured bitrate (see PACING_HEADROOM), so the packets of
+a stream that is already smooth (up to a jitter of PACING_SLACK_S) are due on arrival and are sent right away, i.e.,
+without any added latency.
+"""
+import heapq
+import itertools
+import math
+
+import constants
+
+# Size of an MPEG-TS packet, its sync byte, and the size of the RTP header that may precede the MPEG-TS packets of a UDP
+# payload.
+_TS_PACKET_SIZE = 188
+_TS_SYNC_BYTE = 0x47
+_RTP_HEADER_SIZE = 12
+# Frequency of the PCR clock, and the period at which PCRs (33-bit base * 300 + 9-bit extension) wrap around.
+_PCR_HZ = 27000000
+_PCR_WRAP = (1 << 33) * 300
+# PCRs of a PID more than this many seconds apart (or going backwards) are considered a discontinuity rather than a rate
+# sample. MPEG-TS requires PCRs at least every 100 ms.
+_MAX_PCR_INTERVAL_S = 0.2
+
+
+def find_pcr(payload):
+    """
+    Find the first PCR in a UDP payload of MPEG-TS packets (possibly preceded by an RTP header).
+
+    :param payload: The UDP payload (bytes-like).
+
+    :return: A (PID, PCR in 27 MHz ticks) tuple, or None if the payload does not carry a PCR (or MPEG-TS at all).
+    """
+    n = len(payload)
+    start = 0
+    if n < _TS_PACKET_SIZE or payload[0] != _TS_SYNC_BYTE:
+        start = _RTP_HEADER_SIZE
+        if n < start + _TS_PACKET_SIZE or payload[start] != _TS_SYNC_BYTE:
+            return None
+    for off in range(start, n - _TS_PACKET_SIZE + 1, _TS_PACKET_SIZE):
+        if payload[off] != _TS_SYNC_BYTE:
+            return None
+        # An adaptation field that is long enough for a PCR, and has the PCR flag set.
+        if payload[off + 3] & 0x20 and payload[off + 4] >= 7 and payload[off + 5] & 0x10:
+            base = int.from_bytes(payload[off + 6:off + 10], 'big') << 1 | payload[off + 10] >> 7
+            ext = (payload[off + 10] & 0x01) << 8 | payload[off + 11]
+            return (payload[off + 1] & 0x1f) << 8 | payload[off + 2], base * 300 + ext
+    return None
+
+
+class FlowPacing:
+    """
+    The pacing state of a flow: its measured bitrate and the departure time of its next packet.
+    """
+    __slots__ = ('rate', 'next_departure', 'queued', '_window_start', '_window_bytes', '_pcr_pid', '_pcr',
+                 '_pcr_bytes')
+
+    def __init__(self, now):
+        """
+        Create a new FlowPacing. The flow is not paced until its bitrate has been measured.
+
+        :param now: time.monotonic() timestamp of the flow's first packet.
+        """
+        # Measured bitrate of the flow in bytes per second (None until measured).
+        self.rate = None
+        # Earliest time at which the flow's next packet may be sent.
+        self.next_departure = now
+        # Number of the flow's packets in the jitter buffer.
+        self.queued = 0
+        self._window_start = now
+        self._window_bytes = 0
+        # PID and value of the last PCR seen (None if none has been seen), and the bytes received since.
+        self._pcr_pid = None
+        self._pcr = None
+        self._pcr_bytes = 0
+
+    def schedule(self, payload, nbytes, now, use_pcr):
+        """
+        Update the flow's bitrate with a packet and determine when the packet is due.
+
+        :param payload: The packet's payload.
+        :param nbytes: The packet's payload size.
+        :param now: time.monotonic() timestamp of the packet's arrival.
+        :param use_pcr: If True, measure the bitrate from the PCRs in the payloads (if there are any).
+
+        :return: The packet's departure time (which may be in the past).
+        """
+        self._window_bytes += nbytes
+        if use_pcr:
+            self._measure_pcr(payload, nbytes)
+        if now - self._window_start >= constants.PACING_RATE_WINDOW_S:
+            if self._pcr is None:
+                self._update_rate(self._window_bytes / (now - self._window_start))
+            self._window_start = now
+            self._window_bytes = 0
+        if self.rate is None:
+            return now
+        # A flow that has fallen behind its schedule (e.g., because of a late packet) may catch up by up to
+        # PACING_SLACK_S, s.t. the jitter of a smooth flow does not get its packets held back.
+        departure = self.next_departure
+        if departure < now - constants.PACING_SLACK_S:
+            departure = now - constants.PACING_SLACK_S
+        self.next_departure = departure + nbytes / (self.rate * constants.PACING_HEADROOM)
+        return departure
+
+    def _measure_pcr(self, payload, nbytes):
+        """
+        Update the flow's bitrate from the bytes received between two PCRs of the same PID.
+
+        :param payload: The packet's payload.
+        :param nbytes: The packet's payload size.
+
+        :return: None.
+        """
+        self._pcr_bytes += nbytes
+        found = find_pcr(payload)
+        if found is None:
+            return
+        pid, pcr = found
+        if pid == self._pcr_pid:
+            elapsed_s = (pcr - self._pcr) % _PCR_WRAP / _PCR_HZ
+            if 0 < elapsed_s <= _MAX_PCR_INTERVAL_S:
+                # The bytes of this packet were sent after the previous PCR's packet, up to (about) this PCR.
+                self._update_rate(self._pcr_bytes / elapsed_s)
+        elif self._pcr_pid is not None:
+            # Stick to the first PID that carries PCRs.
+            return
+        self._pcr_pid = pid
+        self._pcr = pcr
+        self._pcr_bytes = 0
+
+    def _update_rate(self, sample):
+        if self.rate is None:
+            self.rate = sample
+        else:
+            self.rate += (sample - self.rate) * constants.PACING_RATE_SMOOTHING
+
+
+class Pacer:
+    """
+    A jitter buffer that holds back the packets of paced flows until they are due, in departure order.
+
+    Flows are expected to have a pacing attribute (a FlowPacing, see flow_state()). The jitter buffer is bounded: no
+    packet is held back for longer than max_delay_s, and if more than max_packets packets are held back, the earliest
+    ones are released before they are due. The packets of a flow are always released in the order they were received.
+    """
+
+    def __init__(self, use_pcr=False, max_delay_s=constants.DEFAULT_PACING_MAX_DELAY_S,
+                 max_packets=constants.PACING_MAX_PACKETS):
+        """
+        Create a new Pacer.
+
+        :param use_pcr: If True, measure the bitrates of the flows from the PCRs of the MPEG-TS packets they carry
+        (flows without PCRs are measured from the packets' arrival).
+        :param max_delay_s: Maximum time a packet is held back.
+        :param max_packets: Maximum number of packets held back (across all flows).
+        """
+        if max_delay_s <= 0 or max_packets < 1:
+            raise ValueError(f'max_delay_s and max_packets must be positive, but were {max_delay_s} and {max_packets}')
+        self._use_pcr = use_pcr
+        self._max_delay_s = max_delay_s
+        self._max_packets = max_packets
+        # The held back packets as (departure time, sequence number, flow, payload) tuples. The sequence number breaks
+        # ties, s.t. packets that are due at the same time are released in the order they were received.
+        self._heap = []
+        self._seq = itertools.count()
+        # Time at which release() must be called next (infinity if no packets are held back).
+        self.next_departure = math.inf
+        # Number of packets that have been held back, and of those that have been released before they were due.
+        self.num_delayed = 0
+        self.num_released_early = 0
+
+    def __len__(self):
+        return len(self._heap)
+
+    @staticmethod
+    def flow_state(now):
+        """
+        :param now: time.monotonic() timestamp of a new flow's first packet.
+
+        :return: The pacing state for a new flow.
+        """
+        return FlowPacing(now)
+
+    def pace(self, flow, payload, nbytes, now):
+        """
+        Decide whether a packet is to be sent right away, or hold it back (copying its payload) until it is due.
+
+        :param flow: The packet's flow.
+        :param payload: The packet's payload (bytes-like).
+        :param nbytes: The packet's payload size.
+        :param now: time.monotonic() timestamp of the packet's arrival.
+
+        :return: True if the packet is to be sent right away, False if it has been held back.
+        """
+        state = flow.pacing
+        departure = state.schedule(payload, nbytes, now, self._use_pcr)
+        if departure <= now and not state.queued:
+            return True
+        if departure > now + self._max_delay_s:
+            # Burst beyond what the jitter buffer absorbs, let it through (faster than the measured bitrate).
+            departure = now + self._max_delay_s
+            state.next_departure = departure
+        state.queued += 1
+        heapq.heappush(self._heap, (departure, next(self._seq), flow, bytes(payload)))
+        self.num_delayed += 1
+        if len(self._heap) > self._max_packets:
+            self.next_departure = -math.inf
+        elif departure < self.next_departure:
+            self.next_departure = departure
+        return False
+
+    def release(self, now):
+        """
+        Take the packets that are due (and the earliest packets beyond max_packets) out of the jitter buffer.
+
+        :param now: Current time.monotonic() timestamp.
+
+        :return: A list of (flow, payload) tuples, in the order the packets are to be sent.
+        """
+        heap = self._heap
+        due = []
+        while heap and (heap[0][0] <= now or len(heap) > self._max_packets):
+            departure, _, flow, payload = heapq.heappop(heap)
+            if departure > now:
+                self.num_released_early += 1
+            flow.pacing.queued -= 1
+            due.append((flow, payload))
+        self.next_departure = heap[0][0] if heap else math.inf
+        return due
@@ -0,0 +1,266 @@
+"""
+Reading the UDP datagrams of packet captures, e.g., to replay captured traffic to the translator.
+
+Both the classic pcap format (microsecond and nanosecond timestamps, either byte order) and the pcapng format (as
+written by current versions of tcpdump and Wireshark) are supported, with the link types that captures of UDP traffic
+commonly have: Ethernet (with or without VLAN tags), raw IP, BSD loopback, and Linux cooked captures (v1 and v2). Other
+link types, non-UDP packets, IP fragments and packets that were truncated by the capture's snap length are skipped (and
+counted, see PcapReader.skipped).
+"""
+import socket
+import struct
+
+_PCAP_MAGIC_US = 0xa1b2c3d4
+_PCAP_MAGIC_NS = 0xa1b23c4d
+# Magic number, major and minor version, time zone offset, timestamp accuracy, snap length and link type.
+_PCAP_HEADER = '{}IHHiIII'
+# Timestamp (seconds and microseconds or nanoseconds), captured length and original length.
+_PCAP_RECORD = '{}IIII'
+
+_PCAPNG_SHB = 0x0a0d0d0a
+_PCAPNG_IDB = 0x00000001
+_PCAPNG_OPB = 0x00000002
+_PCAPNG_SPB = 0x00000003
+_PCAPNG_EPB = 0x00000006
+_PCAPNG_BYTE_ORDER_MAGIC = 0x1a2b3c4d
+# Option of an interface description block that gives the resolution of the interface's timestamps.
+_PCAPNG_IF_TSRESOL = 9
+
+_LINKTYPE_NULL = 0
+_LINKTYPE_ETHERNET = 1
+_LINKTYPE_RAW = 101
+_LINKTYPE_LOOP = 108
+_LINKTYPE_LINUX_SLL = 113
+_LINKTYPE_LINUX_SLL2 = 276
+# Link types that some platforms use instead of LINKTYPE_RAW.
+_LINKTYPES_RAW = {_LINKTYPE_RAW, 12, 14}
+
+_ETHERTYPE_IPV4 = 0x0800
+_ETHERTYPE_IPV6 = 0x86dd
+_ETHERTYPES_VLAN = {0x8100, 0x88a8, 0x9100}
+# Address families of the BSD loopback header that denote IPv6 (they differ between the BSDs).
+_LOOPBACK_AF_INET6 = {10, 24, 28, 30}
+
+_IPPROTO_UDP = 17
+# IPv6 extension headers that may precede the UDP header (the fragment header is not among them, fragments are
+# skipped).
+_IPV6_EXT_HEADERS = {0, 43, 60}
+_IPV6_FRAGMENT = 44
+
+
+class PcapError(Exception):
+    """
+    Raised if a file is not a packet capture, or is corrupt.
+    """
+    pass
+
+
+class PcapReader:
+    """
+    An iterator over the UDP datagrams of a packet capture file, in the order they were captured. Each datagram is a
+    (timestamp, source, destination, payload) tuple of the capture time (in seconds since the epoch), the source and the
+    destination (ip, port) tuples and the UDP payload (bytes).
+    """
+
+    def __init__(self, path):
+        """
+        Open a packet capture file.
+
+        :param path: Path of the pcap or pcapng file.
+
+        :raise PcapError: If the file is neither a pcap nor a pcapng file.
+        """
+        with open(path, 'rb') as f:
+            self._data = memoryview(f.read())
+        if len(self._data) < 4:
+            raise PcapError(f'{path} is not a packet capture.')
+        magic = int.from_bytes(self._data[:4], 'little')
+        if magic == _PCAPNG_SHB:
+            self._packets = self._read_pcapng()
+        elif magic in (_PCAP_MAGIC_US, _PCAP_MAGIC_NS) or int.from_bytes(self._data[:4], 'big') in (_PCAP_MAGIC_US,
+                                                                                                     _PCAP_MAGIC_NS):
+            self._packets = self._read_pcap()
+        else:
+            raise PcapError(f'{path} is not a packet capture.')
+        # Number of packets that were skipped (not UDP, fragments, truncated, or of an unsupported link type).
+        self.skipped = 0
+
+    def __iter__(self):
+        for timestamp, linktype, frame, truncated in self._packets:
+            datagram = None if truncated else _decode_frame(linktype, frame)
+            if datagram is None:
+                self.skipped += 1
+                continue
+            src, dst, payload = datagram
+            yield timestamp, src, dst, payload
+
+    def _read_pcap(self):
+        data = self._data
+        byte_order = '<' if int.from_bytes(data[:4], 'little') in (_PCAP_MAGIC_US, _PCAP_MAGIC_NS) else '>'
+        header = struct.Struct(_PCAP_HEADER.format(byte_order))
+        record = struct.Struct(_PCAP_RECORD.format(byte_order))
+        if len(data) < header.size:
+            raise PcapError('the capture is truncated.')
+        magic, _, _, _, _, _, linktype = header.unpack_from(data)
+        fraction = 1e-9 if magic == _PCAP_MAGIC_NS else 1e-6
+        off = header.size
+        while off + record.size <= len(data):
+            secs, frac, caplen, origlen = record.unpack_from(data, off)
+            off += record.size
+            if off + caplen > len(data):
+                raise PcapError('the capture is truncated.')
+            yield secs + frac * fraction, linktype, data[off:off + caplen], caplen < origlen
+            off += caplen
+
+    def _read_pcapng(self):
+        data = self._data
+        byte_order = '<'
+        # Link type and timestamp resolution (in seconds) of the interfaces of the current section.
+        interfaces = []
+        off = 0
+        while off + 12 <= len(data):
+            if int.from_bytes(data[off:off + 4], 'little') == _PCAPNG_SHB:
+                # Each section header has its own byte order.
+                bom = data[off + 8:off + 12]
+                if int.from_bytes(bom, 'little') == _PCAPNG_BYTE_ORDER_MAGIC:
+                    byte_order = '<'
+                elif int.from_bytes(bom, 'big') == _PCAPNG_BYTE_ORDER_MAGIC:
+                    byte_order = '>'
+                else:
+                    raise PcapError('the capture is corrupt (byte order magic).')
+                interfaces = []
+            block_type, block_len = struct.unpack_from(f'{byte_order}II', data, off)
+            if block_len < 12 or block_len % 4 or off + block_len > len(data):
+                raise PcapError('the capture is truncated or corrupt.')
+            body = data[off + 8:off + block_len - 4]
+            off += block_len
+            if block_type == _PCAPNG_IDB:
+                linktype, _, _ = struct.unpack_from(f'{byte_order}HHI', body)
+                interfaces.append((linktype, _ts_resolution(body[8:], byte_order)))
+            elif block_type == _PCAPNG_EPB or block_type == _PCAPNG_OPB:
+                if block_type == _PCAPNG_EPB:
+                    if_id, ts_high, ts_low, caplen, origlen = struct.unpack_from(f'{byte_order}IIIII', body)
+                else:
+                    if_id, _, ts_high, ts_low, caplen, origlen = struct.unpack_from(f'{byte_order}HHIIII', body)
+                if if_id >= len(interfaces):
+                    raise PcapError(f'the capture is corrupt (packet of unknown interface {if_id}).')
+                linktype, resolution = interfaces[if_id]
+                yield (ts_high << 32 | ts_low) * resolution, linktype, body[20:20 + caplen], caplen < origlen
+            elif block_type == _PCAPNG_SPB:
+                if not interfaces:
+                    raise PcapError('the capture is corrupt (packet of unknown interface 0).')
+                origlen, = struct.unpack_from(f'{byte_order}I', body)
+                frame = body[4:4 + origlen]
+                # Simple packet blocks have no timestamp.
+                yield 0.0, interfaces[0][0], frame, len(frame) < origlen
+            # Other blocks (statistics, name resolution, custom blocks, ...) are skipped.
+
+
+def _ts_resolution(options, byte_order):
+    """
+    :param options: The options of a pcapng interface description block.
+    :param byte_order: Byte order of the section ('<' or '>').
+
+    :return: The resolution (in seconds) of the interface's timestamps.
+    """
+    off = 0
+    while off + 4 <= len(options):
+        code, length = struct.unpack_from(f'{byte_order}HH', options, off)
+        if code == 0:
+            break
+        if code == _PCAPNG_IF_TSRESOL and length >= 1:
+            value = options[off + 4]
+            return 2.0 ** -(value & 0x7f) if value & 0x80 else 10.0 ** -value
+        off += 4 + (length + 3) // 4 * 4
+    return 1e-6
+
+
+def _decode_frame(linktype, frame):
+    """
+    Decode the UDP datagram that a captured frame carries.
+
+    :param linktype: The capture's link type.
+    :param frame: The captured frame (a memoryview).
+
+    :return: A (source, destination, payload) tuple, or None if the frame does not carry a (complete, unfragmented) UDP
+    datagram.
+    """
+    if linktype == _LINKTYPE_ETHERNET:
+        if len(frame) < 14:
+            return None
+        ethertype = int.from_bytes(frame[12:14], 'big')
+        off = 14
+        while ethertype in _ETHERTYPES_VLAN and len(frame) >= off + 4:
+            ethertype = int.from_bytes(frame[off + 2:off + 4], 'big')
+            off += 4
+    elif linktype in _LINKTYPES_RAW:
+        if not frame:
+            return None
+        ethertype = _ETHERTYPE_IPV4 if frame[0] >> 4 == 4 else _ETHERTYPE_IPV6
+        off = 0
+    elif linktype == _LINKTYPE_NULL or linktype == _LINKTYPE_LOOP:
+        if len(frame) < 4:
+            return None
+        # The address family is in the byte order of the capturing host (NULL), or in network byte order (LOOP).
+        family = int.from_bytes(frame[:4], 'big')
+        if family > 0xffff:
+            family = int.from_bytes(frame[:4], 'little')
+        ethertype = _ETHERTYPE_IPV6 if family in _LOOPBACK_AF_INET6 else _ETHERTYPE_IPV4
+        off = 4
+    elif linktype == _LINKTYPE_LINUX_SLL:
+        if len(frame) < 16:
+            return None
+        ethertype = int.from_bytes(frame[14:16], 'big')
+        off = 16
+    elif linktype == _LINKTYPE_LINUX_SLL2:
+        if len(frame) < 20:
+            return None
+        ethertype = int.from_bytes(frame[0:2], 'big')
+        off = 20
+    else:
+        return None
+    if ethertype == _ETHERTYPE_IPV4:
+        return _decode_ipv4(frame[off:])
+    if ethertype == _ETHERTYPE_IPV6:
+        return _decode_ipv6(frame[off:])
+    return None
+
+
+def _decode_ipv4(packet):
+    if len(packet) < 20 or packet[0] >> 4 != 4:
+        return None
+    header_len = (packet[0] & 0x0f) * 4
+    total_len = int.from_bytes(packet[2:4], 'big')
+    # More fragments flag, or a fragment offset.
+    if packet[9] != _IPPROTO_UDP or int.from_bytes(packet[6:8], 'big') & 0x3fff:
+        return None
+    src = socket.inet_ntop(socket.AF_INET, packet[12:16])
+    dst = socket.inet_ntop(socket.AF_INET, packet[16:20])
+    return _decode_udp(src, dst, packet[header_len:total_len])
+
+
+def _decode_ipv6(packet):
+    if len(packet) < 40 or packet[0] >> 4 != 6:
+        return None
+    next_header = packet[6]
+    end = 40 + int.from_bytes(packet[4:6], 'big')
+    off = 40
+    while next_header in _IPV6_EXT_HEADERS and off + 8 <= end:
+        next_header = packet[off]
+        off += (packet[off + 1] + 1) * 8
+    if next_header != _IPPROTO_UDP:
+        return None
+    src = socket.inet_ntop(socket.AF_INET6, packet[8:24])
+    dst = socket.inet_ntop(socket.AF_INET6, packet[24:40])
+    return _decode_udp(src, dst, packet[off:end])
+
+
+def _decode_udp(src, dst, segment):
+    if len(segment) < 8:
+        return None
+    length = int.from_bytes(segment[4:6], 'big')
+    if length < 8 or length > len(segment):
+        return None
+    sport = int.from_bytes(segment[0:2], 'big')
+    dport = int.from_bytes(segment[2:4], 'big')
+    return (src, sport), (dst, dport), bytes(segment[8:length])
@@ -0,0 +1,242 @@
+"""
+Crash-safe snapshots of the allocator's state, for warm restarts.
+
+A snapshot records which multicast address is allocated to which unicast client, and the Multicast Menu access codes of
+the published streams. Restoring it when the translator restarts lets the existing sources keep their multicast groups,
+and as their addresses are not newly allocated, their streams are not published on the Multicast Menu again.
+
+Snapshots are written to a temporary file that is synced to disk and then renamed over the previous snapshot, so a crash
+while writing a snapshot leaves the previous snapshot intact. The file format is compact and fixed-width per flow:
+
+- a header (see _HEADER) with a magic number, the format version, the address space (IPv4 or IPv6), the number of flows
+  and access codes, and the CRC32 of the body;
+- per flow: the IP version, address and port of the client and the index of its multicast address in the address space
+  (see _FLOW);
+- per access code: the index of the stream's multicast address (a 32-bit unsigned integer);
+- the access codes themselves, in the same order, separated by newlines.
+
+Clients of an IPv6 (or dual-stack) unicast socket are identified by (ip, port, flowinfo, scope_id) tuples, of which the
+flow info and the scope ID are not recorded (they're restored as 0). Snapshots of version 1 (IPv4 only) can still be
+restored.
+"""
+import ipaddress
+import logging
+import os
+import socket
+import struct
+import threading
+import time
+import zlib
+
+import constants
+
+logger = logging.getLogger(__name__)
+
+_MAGIC = b'U2MTSNAP'
+_VERSION = 2
+# Magic number and version (the start of the header of every version).
+_PREAMBLE = struct.Struct('!8sH')
+# Magic number, version, IP version, network address (IPv4 addresses are padded) and prefix length of the address space,
+# number of flows, number of access codes and CRC32 of the body.
+_HEADER = struct.Struct('!8sHB16sBIII')
+# IP version of the client (4, or 6 for the clients of an IPv6 socket), client IP, client port and index of the
+# multicast address.
+_FLOW = struct.Struct('!B16sHI')
+# The header and the flows of version 1 snapshots, which only had IPv4 address spaces and clients.
+_HEADER_V1 = struct.Struct('!8sHIBIII')
+_FLOW_V1 = struct.Struct('!4sHI')
+# Index of the multicast address of an access code.
+_CODE_IDX = struct.Struct('!I')
+
+
+class SnapshotError(Exception):
+    """
+    A snapshot is corrupt or does not match the translator's configuration.
+    """
+    pass
+
+
+def encode(addr_space, flows, access_codes):
+    """
+    Encode the allocator's state as a snapshot.
+
+    :param addr_space: The address space (an ipaddress.IPv4Network or ipaddress.IPv6Network) the indexes refer to.
+    :param flows: Iterable of (client address, index) tuples, i.e., the allocated multicast addresses by client, where
+    the client address is an (ip, port) tuple for IPv4 clients or an (ip, port, flowinfo, scope_id) tuple for the
+    clients of an IPv6 socket.
+    :param access_codes: Dict that maps indexes of multicast addresses to the access codes of their streams.
+
+    :return: The snapshot (bytes).
+    """
+    pack_flow = _FLOW.pack
+    inet_aton = socket.inet_aton
+    inet_pton = socket.inet_pton
+    af_inet6 = socket.AF_INET6
+    # Addresses shorter than 16 bytes are padded by pack_flow().
+    body = [pack_flow(4, inet_aton(client[0]), client[1], idx) if len(client) == 2 else
+            pack_flow(6, inet_pton(af_inet6, client[0].split('%')[0]), client[1], idx) for client, idx in flows]
+    num_flows = len(body)
+    body.extend(_CODE_IDX.pack(idx) for idx in access_codes)
+    body.append('\n'.join(access_codes.values()).encode())
+    body = b''.join(body)
+    header = _HEADER.pack(_MAGIC, _VERSION, addr_space.version, addr_space.network_address.packed,
+                          addr_space.prefixlen, num_flows, len(access_codes), zlib.crc32(body))
+    return header + body
+
+
+def decode(data):
+    """
+    Decode a snapshot.
+
+    :param data: The snapshot (bytes, as returned by encode()).
+
+    :return: An (address space, flows, access codes) tuple (see encode()), where flows is a list.
+    """
+    if len(data) < _PREAMBLE.size:
+        raise SnapshotError('the snapshot is truncated.')
+    magic, version = _PREAMBLE.unpack_from(data)
+    if magic != _MAGIC:
+        raise SnapshotError('the file is not a snapshot.')
+    if version not in (1, _VERSION):
+        raise SnapshotError(f'unsupported snapshot version {version}.')
+    header = _HEADER if version == _VERSION else _HEADER_V1
+    flow = _FLOW if version == _VERSION else _FLOW_V1
+    if len(data) < header.size:
+        raise SnapshotError('the snapshot is truncated.')
+    if version == _VERSION:
+        _, _, ip_version, network, prefixlen, num_flows, num_codes, crc = header.unpack_from(data)
+        if ip_version not in (4, 6):
+            raise SnapshotError(f'the snapshot is corrupt (IP version {ip_version}).')
+        network = network[:4] if ip_version == 4 else network
+    else:
+        _, _, network, prefixlen, num_flows, num_codes, crc = header.unpack_from(data)
+    body = memoryview(data)[header.size:]
+    if zlib.crc32(body) != crc:
+        raise SnapshotError('the snapshot is corrupt (checksum mismatch).')
+    flows_end = num_flows * flow.size
+    codes_start = flows_end + num_codes * _CODE_IDX.size
+    if len(body) < codes_start:
+        raise SnapshotError('the snapshot is truncated.')
+    inet_ntoa = socket.inet_ntoa
+    if version == _VERSION:
+        inet_ntop = socket.inet_ntop
+        af_inet6 = socket.AF_INET6
+        flows = [((inet_ntoa(ip[:4]), port) if client_version == 4 else (inet_ntop(af_inet6, ip), port, 0, 0), idx)
+                 for client_version, ip, port, idx in flow.iter_unpack(body[:flows_end])]
+    else:
+        flows = [((inet_ntoa(ip), port), idx) for ip, port, idx in flow.iter_unpack(body[:flows_end])]
+    code_idxs = [idx for idx, in _CODE_IDX.iter_unpack(body[flows_end:codes_start])]
+    codes = bytes(body[codes_start:]).decode().split('\n') if num_codes else []
+    if len(codes) != num_codes:
+        raise SnapshotError('the snapshot is corrupt (access codes do not match).')
+    access_codes = dict(zip(code_idxs, codes))
+    try:
+        addr_space = ipaddress.ip_network((network, prefixlen))
+    except ValueError as e:
+        raise SnapshotError(f'the snapshot is corrupt ({e}).')
+    return addr_space, flows, access_codes
+
+
+def write(path, data):
+    """
+    Atomically replace the snapshot at path.
+
+    :param path: Path of the snapshot file.
+    :param data: The snapshot (bytes).
+
+    :return: None.
+    """
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    # Persist the rename as well.
+    dir_fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
+
+
+def restore(allocator, path):
+    """
+    Restore an allocator's state from the snapshot at path, if there is one. A snapshot that cannot be restored is
+    logged and ignored (i.e., the translator starts cold).
+
+    :param allocator: The (empty) McastAddrAllocator, or a proxy to it.
+    :param path: Path of the snapshot file.
+
+    :return: The number of flows restored.
+    """
+    start = time.perf_counter()
+    try:
+        with open(path, 'rb') as f:
+            data = f.read()
+    except FileNotFoundError:
+        logger.info(f'No snapshot found at {path}, starting cold.', extra={'event': 'snapshot'})
+        return 0
+    try:
+        num_flows = allocator.restore(data)
+    except SnapshotError as e:
+        logger.warning(f'Ignoring the snapshot at {path}, starting cold: {e}', extra={'event': 'snapshot'})
+        return 0
+    logger.info(f'Restored {num_flows} flows from the snapshot at {path} in '
+                f'{(time.perf_counter() - start) * 1e3:.1f} ms.', extra={'event': 'snapshot'})
+    return num_flows
+
+
+class Snapshotter:
+    """
+    Periodically snapshots an allocator's state to a file from a background thread.
+    """
+
+    def __init__(self, allocator, path, interval_s=constants.SNAPSHOT_INTERVAL_S):
+        """
+        Create a new Snapshotter. No snapshots are taken until you call start().
+
+        :param allocator: The McastAddrAllocator, or a proxy to it.
+        :param path: Path of the snapshot file.
+        :param interval_s: Time between snapshots.
+        """
+        self._allocator = allocator
+        self._path = path
+        self._interval_s = interval_s
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='snapshotter', daemon=True)
+
+    def start(self):
+        """
+        Start taking snapshots.
+
+        :return: None.
+        """
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stop taking snapshots and take a final one.
+
+        :return: None.
+        """
+        if not self._thread.is_alive():
+            return
+        self._stop.set()
+        self._thread.join()
+        self.snapshot()
+
+    def snapshot(self):
+        """
+        Take a snapshot now. Failures are logged.
+
+        :return: None.
+        """
+        try:
+            write(self._path, self._allocator.snapshot())
+        except Exception as e:
+            logger.error(f'Failed to write a snapshot to {self._path}: {e}', extra={'event': 'snapshot'})
+
+    def _run(self):
+        while not self._stop.wait(self._interval_s):
+            self.snapshot()
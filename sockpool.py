@@ -0,0 +1,218 @@
+import collections
+import errno
+import logging
+import socket
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows.
+    resource = None
+
+# Number of file descriptors to leave for everything else (unicast socket, shared multicast socket, HTTP connections to
+# the Multicast Menu etc.) when deriving the socket budget from the file descriptor limit.
+_RESERVED_FDS = 64
+
+logger = logging.getLogger(__name__)
+
+
+def fd_budget(max_sockets):
+    """
+    Cap a socket budget to what the file descriptor limit (RLIMIT_NOFILE) of this process allows.
+
+    :param max_sockets: The desired socket budget.
+
+    :return: The socket budget.
+    """
+    if resource is None:
+        return max_sockets
+    soft_limit, _ = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft_limit == resource.RLIM_INFINITY:
+        return max_sockets
+    return max(0, min(max_sockets, soft_limit - _RESERVED_FDS))
+
+
+def set_mcast_sockopts(sckt, ttl=None, dscp=None, sndbuf=None):
+    """
+    Set the options of a socket that multicast is sent on (an AF_INET or an AF_INET6 socket).
+
+    :param sckt: The socket.
+    :param ttl: TTL (hop limit for IPv6) of the sent multicast packets (None to keep the default).
+    :param dscp: DSCP of the sent multicast packets (None to keep the default).
+    :param sndbuf: Size of the send buffer in bytes (None to keep the default).
+
+    :return: None.
+    """
+    ipv6 = sckt.family == socket.AF_INET6
+    if ttl is not None:
+        if ipv6:
+            sckt.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_MULTICAST_HOPS, ttl)
+        else:
+            sckt.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, ttl)
+    if dscp is not None:
+        # The DSCP occupies the 6 most significant bits of the (former) TOS byte, or of the IPv6 traffic class.
+        if ipv6:
+            sckt.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_TCLASS, dscp << 2)
+        else:
+            sckt.setsockopt(socket.IPPROTO_IP, socket.IP_TOS, dscp << 2)
+    if sndbuf is not None:
+        sckt.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, sndbuf)
+
+
+class FlowSocketPool:
+    """
+    Provides flows with their own UDP socket connected to their multicast group, within a budget of sockets (i.e., file
+    descriptors).
+
+    Sending on a connected socket saves the kernel a route lookup per packet and allows for per-flow socket options.
+    When the budget is exhausted, the socket of the least recently used flow is reclaimed for the new flow, and the old
+    flow falls back to the shared (unconnected) multicast socket. Recency is approximated with the CLOCK algorithm based
+    on each flow's last_seen timestamp, so the packet path does not have to do any bookkeeping for the pool.
+    """
+
+    def __init__(self, max_sockets, ttl=None, dscp=None, sndbuf=None, flow_sockopts=None, family=socket.AF_INET):
+        """
+        Create a new FlowSocketPool.
+
+        :param max_sockets: Maximum number of connected sockets (capped to what the file descriptor limit allows).
+        :param ttl: Default TTL of the translated packets.
+        :param dscp: Default DSCP of the translated packets.
+        :param sndbuf: Default send buffer size of the connected sockets.
+        :param flow_sockopts: Optional callable that takes a Flow and returns a dict with any of the keys 'ttl', 'dscp'
+        and 'sndbuf' to override the default socket options for that flow.
+        :param family: Address family of the multicast groups (socket.AF_INET or socket.AF_INET6).
+        """
+        self._max_sockets = fd_budget(max_sockets)
+        self._family = family
+        self._default_sockopts = {'ttl': ttl, 'dscp': dscp, 'sndbuf': sndbuf}
+        self._flow_sockopts = flow_sockopts
+        # The flows that currently own a socket, each with the time at which it was last checked by the CLOCK hand.
+        self._clock = collections.deque()
+
+    def __len__(self):
+        return len(self._clock)
+
+    def connect(self, flow, now):
+        """
+        Create a socket connected to the flow's multicast group and assign it to flow.sckt, reclaiming the socket of the
+        least recently used flow if the budget is exhausted. Leaves flow.sckt set to None if no socket can be created.
+
+        :param flow: The Flow.
+        :param now: Current time.monotonic() timestamp.
+
+        :return: None.
+        """
+        if self._max_sockets == 0:
+            return
+        if len(self._clock) >= self._max_sockets:
+            self._reclaim(now)
+        sockopts = self._sockopts(flow)
+        try:
+            sckt = socket.socket(self._family, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+        except OSError as e:
+            if e.errno not in (errno.EMFILE, errno.ENFILE):
+                raise
+            logger.warning('Out of file descriptors, %s will use the shared multicast socket', flow.client_addr,
+                           extra={'event': 'out_of_fds', 'client': flow.client_addr})
+            return
+        try:
+            set_mcast_sockopts(sckt, **sockopts)
+            sckt.connect(flow.dst_addr)
+        except OSError:
+            sckt.close()
+            raise
+        flow.sckt = sckt
+        self._clock.append((flow, now))
+
+    def reconnect(self, flow):
+        """
+        Connect the flow's socket (if any) to the flow's current dst_addr, e.g., because the flow has been moved to
+        another multicast group.
+
+        :param flow: The Flow.
+
+        :return: None.
+        """
+        if flow.sckt is not None:
+            flow.sckt.connect(flow.dst_addr)
+
+    def set_default_sockopts(self, ttl=None, dscp=None, sndbuf=None):
+        """
+        Change the default socket options. Sockets created from now on get the new options, existing sockets keep theirs
+        until apply_sockopts() is called for their flows.
+
+        :param ttl: New default TTL (None to leave it unchanged).
+        :param dscp: New default DSCP (None to leave it unchanged).
+        :param sndbuf: New default send buffer size (None to leave it unchanged).
+
+        :return: None.
+        """
+        for name, value in (('ttl', ttl), ('dscp', dscp), ('sndbuf', sndbuf)):
+            if value is not None:
+                self._default_sockopts[name] = value
+
+    def apply_sockopts(self, flow):
+        """
+        Set the current (default or per-flow) socket options on the flow's socket (if any).
+
+        :param flow: The Flow.
+
+        :return: None.
+        """
+        if flow.sckt is not None:
+            set_mcast_sockopts(flow.sckt, **self._sockopts(flow))
+
+    def _sockopts(self, flow):
+        sockopts = dict(self._default_sockopts)
+        if self._flow_sockopts is not None:
+            sockopts.update(self._flow_sockopts(flow))
+        return sockopts
+
+    def disconnect(self, flow):
+        """
+        Close the flow's socket (if any), e.g., because the flow has been evicted.
+
+        :param flow: The Flow.
+
+        :return: None.
+        """
+        if flow.sckt is None:
+            return
+        flow.sckt.close()
+        flow.sckt = None
+        # The flow's entry in _clock is dropped once the CLOCK hand reaches it.
+
+    def _reclaim(self, now):
+        """
+        Close the socket of the least recently used flow (approximately). A flow that has seen traffic since the CLOCK
+        hand last passed it gets a second chance.
+
+        :param now: Current time.monotonic() timestamp.
+
+        :return: None.
+        """
+        for _ in range(len(self._clock)):
+            flow, checked = self._clock.popleft()
+            if flow.sckt is None:
+                # Disconnected in the meantime.
+                return
+            if flow.last_seen <= checked:
+                break
+            self._clock.append((flow, now))
+        else:
+            # All flows have seen traffic recently, reclaim the socket of the flow the hand stopped at.
+            flow, _ = self._clock.popleft()
+        flow.sckt.close()
+        flow.sckt = None
+
+    def close(self):
+        """
+        Close all sockets.
+
+        :return: None.
+        """
+        while self._clock:
+            flow, _ = self._clock.popleft()
+            if flow.sckt is not None:
+                flow.sckt.close()
+                flow.sckt = None
@@ -1,17 +1,67 @@
 #!/usr/bin/python3
 import argparse
-import concurrent.futures as cf
+import collections
 import ipaddress
-import random
+import logging
+import math
+import multiprocessing as mp
+import select
 import signal
 import socket
 import threading
 import time
 
-import requests
-
+import config
 import constants
+import logsetup
+import metrics
+import mmsg
+import snapshot
 import utils
+from admission import AdmissionController
+from allocator import ALLOC_POLICIES, AllocatorManager, McastAddrAllocator
+from cluster import ClusterAllocator, LeaseKeeper
+from eviction import IdleTimerWheel
+from mcastmenu import MulticastMenuPublisher
+from pacing import Pacer
+from sockpool import FlowSocketPool, set_mcast_sockopts
+
+logger = logging.getLogger(__name__)
+
+
+class Flow:
+    """
+    A unicast flow that is being translated to multicast (i.e., an entry in a Translator's FIB).
+    """
+    __slots__ = ('client_addr', 'mcast_addr', 'dst_addr', 'sockaddr', 'last_seen', 'sckt', 'policer', 'pacing',
+                 'num_pkts', 'num_bytes')
+
+    def __init__(self, client_addr, mcast_addr, dst_addr, sockaddr, last_seen, sckt=None, policer=None, pacing=None):
+        """
+        Create a new Flow.
+
+        :param client_addr: The (ip, port) tuple identifying the unicast source of the flow.
+        :param mcast_addr: The multicast address (group) allocated for the flow.
+        :param dst_addr: The (ip, port) tuple to send the translated packets to, ready to be passed to sendto().
+        :param sockaddr: The mmsg.SockAddr for dst_addr (only needed by the batched datapath, None otherwise).
+        :param last_seen: time.monotonic() timestamp of the most recent packet of the flow.
+        :param sckt: The flow's own socket, connected to dst_addr (see FlowSocketPool). If None, the translated packets
+        are sent on the Translator's shared multicast socket.
+        :param policer: The admission.FlowPolicer that enforces the flow's packet and byte rate limits (None if the flow
+        is not rate-limited).
+        :param pacing: The pacing.FlowPacing state of the flow (None if the flow is not paced).
+        """
+        self.client_addr = client_addr
+        self.mcast_addr = mcast_addr
+        self.dst_addr = dst_addr
+        self.sockaddr = sockaddr
+        self.last_seen = last_seen
+        self.sckt = sckt
+        self.policer = policer
+        self.pacing = pacing
+        # Number of packets and bytes of the flow that have been forwarded.
+        self.num_pkts = 0
+        self.num_bytes = 0
 
 
 class Translator:
@@ -20,46 +70,202 @@ class Translator:
     """
 
     def __init__(self, ucast_srv_ip, ucast_srv_port, mcast_addr_space, mcast_port, read_buffer_size=1514,
-                 read_timeout_s=5.0, mcast_ttl=32):
+                 read_timeout_s=5.0, mcast_ttl=constants.DEFAULT_MULTICAST_TTL, batch_size=1, allocator=None,
+                 reuse_port=False, idle_timeout_s=None, mcastmenu_uid=None, mcastmenu_withdraw=False,
+                 mcastmenu_batch=False, mcastmenu_url=constants.DEFAULT_MULTICASTMENU_URL, alloc_policy='random',
+                 connected_sockets=False, max_connected_sockets=1024, mcast_dscp=None, mcast_sndbuf=None,
+                 flow_sockopts=None, metrics_port=None, metrics_addr='127.0.0.1', metrics_per_flow=False,
+                 snapshot_path=None, max_new_flows_per_s=None, max_flow_pps=None, max_flow_bytes_per_s=None,
+                 pacing=None, pacing_max_delay_s=constants.DEFAULT_PACING_MAX_DELAY_S, cluster_backend=None,
+                 cluster_node_id=None, cluster_lease_ttl_s=constants.DEFAULT_CLUSTER_LEASE_TTL_S):
         """
         Create a new Translator instance.
 
-        The created Translator instance will be configured to listen for unicast UDP on the IPv4 address and port you
+        The created Translator instance will be configured to listen for unicast UDP on the IP address and port you
         specify here. However, note that the Translator will not start listening for UDP packets until you call start().
 
-        :param ucast_srv_ip: IPv4 address to listen for unicast UDP on.
+        :param ucast_srv_ip: IPv4 or IPv6 address to listen for unicast UDP on. The unspecified IPv6 address (::)
+        listens for both IPv4 and IPv6 (dual-stack). The clients of an IPv6 socket are identified by (ip, port,
+        flowinfo, scope_id) tuples (with IPv4-mapped IPv6 addresses for IPv4 clients) rather than (ip, port) tuples.
         :param ucast_srv_port: Port to listen for unicast UDP on.
         :param mcast_addr_space: Address space to pick multicast groups (IP addresses) from. Each unicast stream will be
-        translated to a multicast group in this address space.
+        translated to a multicast group in this address space. Either an ipaddress.IPv4Network or, to translate to IPv6
+        SSM, an ipaddress.IPv6Network of at most 2^32 groups (e.g., ff3e::/96).
         :param mcast_port: Port number to use as the destination port when forwarding unicast flows as multicast flows.
-        :param read_buffer_size: Size of the receive buffer (when receiving unicast packets).
+        :param read_buffer_size: Size of the receive buffer (when receiving unicast packets). Unicast packets with a
+        larger payload are dropped (and counted).
         :param read_timeout_s: Timeout when reading from the unicast socket. A lower timeout will make a call to stop()
         more responsive, at the cost of more CPU cycles spent on busy waiting.
-        :param mcast_ttl: TTL to use for the translated packets (i.e., the forwarded multicast packets).
+        :param mcast_ttl: TTL (or hop limit) to use for the translated packets (i.e., the forwarded multicast packets).
+        :param batch_size: Maximum number of packets to receive (and forward) per system call. Values greater than 1
+        enable the batched datapath (based on recvmmsg and sendmmsg), which is only available on Linux. The Translator
+        falls back to receiving and forwarding one packet at a time if the batched datapath is unavailable.
+        :param allocator: The McastAddrAllocator (or a proxy for one) to allocate multicast addresses with. Pass a
+        shared allocator to make several Translators allocate from the same address space without conflicts. If None,
+        the Translator creates its own allocator for mcast_addr_space.
+        :param reuse_port: If True, set SO_REUSEPORT on the unicast socket such that several Translators (in different
+        processes) can listen on the same unicast port, with the kernel distributing the unicast flows across them.
+        :param idle_timeout_s: Evict a flow from the FIB (and free its multicast address) when no packets have been
+        received for it for this many seconds. Set to None to never evict flows.
+        :param mcastmenu_uid: Unique identifier of this translator for the Multicast Menu API. If set, streams are
+        published through the API (rather than by submitting the form), which also allows for withdrawing them later.
+        :param mcastmenu_withdraw: If True, withdraw a stream from the Multicast Menu when its flow is evicted. Requires
+        mcastmenu_uid.
+        :param mcastmenu_batch: If True, publish the streams of new flows in batches (every
+        constants.MULTICASTMENU_BATCH_INTERVAL_S seconds) using the bulk endpoint of the Multicast Menu API. Requires
+        mcastmenu_uid.
+        :param mcastmenu_url: Base URL of the Multicast Menu.
+        :param alloc_policy: Name of the policy (see allocator.ALLOC_POLICIES) that determines which multicast address
+        is allocated to a new unicast flow. Ignored if an allocator is provided.
+        :param connected_sockets: If True, send each flow's translated packets on a socket of its own that is connected
+        to the flow's multicast group, which saves a route lookup per packet. Flows fall back to the shared multicast
+        socket beyond max_connected_sockets.
+        :param max_connected_sockets: Maximum number of connected sockets (i.e., file descriptors) when
+        connected_sockets is True. When exceeded, the socket of the least recently used flow is reclaimed.
+        :param mcast_dscp: DSCP to use for the translated packets (None to keep the system default).
+        :param mcast_sndbuf: Size (in bytes) of the send buffer of the multicast socket(s) (None to keep the system
+        default).
+        :param flow_sockopts: Optional callable that takes a Flow and returns a dict with any of the keys 'ttl', 'dscp'
+        and 'sndbuf' to override mcast_ttl, mcast_dscp and mcast_sndbuf for that flow. Requires connected_sockets.
+        :param metrics_port: Port to serve metrics on (in the Prometheus text exposition format). Set to None to not
+        serve metrics.
+        :param metrics_addr: IP address to serve metrics on.
+        :param metrics_per_flow: If True, also report the packets and bytes forwarded per flow (one time series per
+        flow, which may be a lot).
+        :param snapshot_path: If set, restore the allocator's state from the snapshot at this path (if any) when
+        starting, and periodically snapshot it to this path (see the snapshot module). Flows restored from the snapshot
+        keep their multicast addresses and are not published on the Multicast Menu again. Ignored if an allocator is
+        provided (whoever provides the allocator is in charge of snapshotting it, see WorkerPool).
+        :param max_new_flows_per_s: If set, new flows are admitted at this rate at most (allowing for short bursts, see
+        constants.ADMISSION_BURST_S). The packets of denied flows are dropped, and a denied flow is admitted once the
+        rate permits (i.e., when one of its later packets arrives).
+        :param max_flow_pps: If set, the packets of a flow that exceed this many packets per second are dropped.
+        :param max_flow_bytes_per_s: If set, the packets of a flow that exceed this many payload bytes per second are
+        dropped.
+        :param pacing: If set, smooth out the bursts of the translated flows by sending their packets at their measured
+        bitrates (see the pacing module): 'rate' to measure the bitrates from the packets' arrival, or 'pcr' to measure
+        them from the PCRs of the MPEG-TS packets they carry.
+        :param pacing_max_delay_s: Maximum time a packet is held back for pacing.
+        :param cluster_backend: If set, the URL of a cluster backend (see cluster.open_backend()) through which this
+        Translator (a node) allocates multicast addresses without conflicts with the other nodes of a cluster (see the
+        cluster module). Ignored if an allocator is provided. Cannot be combined with snapshot_path.
+        :param cluster_node_id: ID of this node, unique within the cluster (defaults to the host name).
+        :param cluster_lease_ttl_s: Time after which the multicast addresses of this node are freed for the other nodes
+        if it fails to renew its lease (e.g., because it has died).
+
+        The address space, the socket options of the multicast socket(s) and the Multicast Menu settings can be changed
+        while the Translator is running (see reconfigure()).
         """
-        if isinstance(ucast_srv_ip, ipaddress.IPv4Address):
-            # The socket API expects IP addresses in string form, so convert to str if IPv4Address provided.
+        if isinstance(ucast_srv_ip, (ipaddress.IPv4Address, ipaddress.IPv6Address)):
+            # The socket API expects IP addresses in string form, so convert to str if an address object is provided.
             ucast_srv_ip = str(ucast_srv_ip)
         if not isinstance(ucast_srv_ip, str):
-            raise ValueError(f'ucast_srv_ip must be an ipaddress.IPv4Address or a str, but was a {type(ucast_srv_ip)}')
+            raise ValueError(f'ucast_srv_ip must be an ipaddress.IPv4Address, an ipaddress.IPv6Address or a str, but '
+                             f'was a {type(ucast_srv_ip)}')
         self._srv_ip = ucast_srv_ip
+        self._srv_family = socket.AF_INET6 if ipaddress.ip_address(ucast_srv_ip).version == 6 else socket.AF_INET
         self._srv_port = ucast_srv_port
-        if mcast_addr_space.prefixlen >= 31:
-            errmsg = f'The address space {str(mcast_addr_space)} only contains a network address and a broadcast ' \
-                     f'address, but no host addresses.'
-            raise ValueError(errmsg)
+        self._reuse_port = reuse_port
         self._addr_space = mcast_addr_space
+        self._mcast_family = socket.AF_INET6 if mcast_addr_space.version == 6 else socket.AF_INET
         # We'll use the same destination port number across all multicast groups.
         self._mcast_dst_port = mcast_port
         self._buffer_size = read_buffer_size
+        # Number of unicast packets dropped because their payload did not fit into the receive buffer, because we've run
+        # out of multicast addresses, because they could not be sent, because their (new) flows were denied admission
+        # and because their flows exceeded their rate limits, respectively. Only updated by the translation thread.
+        self._truncated_count = 0
+        self._no_addr_count = 0
+        self._send_error_count = 0
+        self._denied_count = 0
+        self._rate_limited_count = 0
+        # Enforces the admission rate of new flows and the rate limits of flows (None if nothing is limited), and the
+        # number of packets of new flows that have been denied since a new flow was last admitted.
+        self._admission = None
+        if max_new_flows_per_s is not None or max_flow_pps is not None or max_flow_bytes_per_s is not None:
+            self._admission = AdmissionController(max_new_flows_per_s, max_flow_pps, max_flow_bytes_per_s)
+        self._max_new_flows_per_s = max_new_flows_per_s
+        self._denied_run = 0
+        if pacing not in (None, 'rate', 'pcr'):
+            raise ValueError(f"pacing must be None, 'rate' or 'pcr', but was {pacing!r}")
+        # Holds back the packets of bursts until they are due (None if flows are not paced). Only accessed by the
+        # translation thread.
+        self._pacer = None
+        if pacing is not None:
+            self._pacer = Pacer(pacing == 'pcr', pacing_max_delay_s)
+        # Number of packets and bytes forwarded for flows that have since been evicted from the FIB (the counters of the
+        # flows in the FIB are kept by the flows themselves).
+        self._evicted_pkts = 0
+        self._evicted_bytes = 0
+        # Time taken to process a packet (or a batch of packets) in the translation loop, sampled s.t. the packet path
+        # is not slowed down.
+        self._loop_latency = metrics.Histogram(constants.METRICS_LOOP_LATENCY_BUCKETS_S)
+        self._metrics_port = metrics_port
+        self._metrics_addr = metrics_addr
+        self._metrics_per_flow = metrics_per_flow
+        self._metrics_server = None
         self._read_timeout_s = read_timeout_s
         self._mcast_ttl = mcast_ttl
+        self._mcast_dscp = mcast_dscp
+        self._mcast_sndbuf = mcast_sndbuf
+        if flow_sockopts is not None and not connected_sockets:
+            raise ValueError('Per-flow socket options require connected sockets.')
+        # Provides flows with connected sockets (None if all flows are sent on the shared multicast socket). Only
+        # accessed by the translation thread.
+        self._flow_sckts = None
+        if connected_sockets:
+            self._flow_sckts = FlowSocketPool(max_connected_sockets, mcast_ttl, mcast_dscp, mcast_sndbuf, flow_sockopts,
+                                              self._mcast_family)
+        if batch_size < 1:
+            raise ValueError(f'batch_size must be at least 1, but was {batch_size}')
+        if batch_size > 1 and not mmsg.is_available():
+            logger.warning(f'Batched I/O is not available on this platform, ignoring batch size {batch_size}')
+            batch_size = 1
+        self._batch_size = batch_size
+        # Allocates multicast groups to unicast clients. This is the authoritative record of allocations, which may be
+        # shared with other Translators.
+        # Snapshots the allocator's state for warm restarts (None if disabled or if the allocator is provided).
+        self._snapshotter = None
+        self._snapshot_path = snapshot_path
+        # Renews the lease of this node of a cluster (None if the allocator is not a ClusterAllocator of our own).
+        self._lease_keeper = None
+        # Whether the allocator is ours (rather than shared), i.e., whether we switch it to a new address space.
+        self._owns_allocator = allocator is None
+        if allocator is None and cluster_backend is not None:
+            if snapshot_path is not None:
+                raise ValueError('Snapshots cannot be combined with clustering (the cluster backend keeps the '
+                                 'allocations).')
+            allocator = ClusterAllocator(mcast_addr_space, alloc_policy, cluster_backend, cluster_node_id,
+                                         cluster_lease_ttl_s)
+            self._lease_keeper = LeaseKeeper(allocator, self._on_allocations_lost, cluster_lease_ttl_s)
+        elif allocator is None:
+            allocator = McastAddrAllocator(mcast_addr_space, alloc_policy)
+            if snapshot_path is not None:
+                self._snapshotter = snapshot.Snapshotter(allocator, snapshot_path)
+        self._allocator = allocator
         # The Translator's Forwarding Information Base: maps a src ip and src port to its respective multicast group.
+        # Only accessed by the translation thread, so that the packet path never needs to consult the allocator.
         self._fib = dict()
-        # Currently allocated multicast addresses (addresses that we are translating to for current clients).
-        self._allocated_mcast_addrs = set()
+        self._idle_timeout_s = idle_timeout_s
+        # Tracks when the flows in the FIB go idle (created in start(), None if flows are never evicted).
+        self._idle_timers = None
+        # The time.monotonic() timestamp at which allocations restored from a snapshot are freed if their clients have
+        # not been seen since (set in start(), None if flows are never evicted).
+        self._unclaimed_deadline = None
+        if mcastmenu_withdraw and mcastmenu_uid is None:
+            raise ValueError('Withdrawing streams from the Multicast Menu requires a Multicast Menu UID.')
+        self._mcastmenu_uid = mcastmenu_uid
+        self._mcastmenu_withdraw = mcastmenu_withdraw
         # For synchronizing access to properties that are used by multiple threads.
         self._lock = threading.Lock()
+        # New configurations (see reconfigure()) that are waiting to be applied by the translation thread, as
+        # (address space, socket options, dropped allocations, lost allocations) tuples, and a flag indicating that
+        # there are any (or that one is being applied). Both are protected by _lock.
+        self._reconfigs = collections.deque()
+        self._reconfig_pending = False
+        # The steps (a generator, see _apply_config()) of the configuration that is currently being applied. Only
+        # accessed by the translation thread.
+        self._reconfig_steps = None
         # Flag indicating if the translator has been started.
         self._started = threading.Event()
         # Flag indicating that termination of the translator has been initiated.
@@ -67,13 +273,18 @@ class Translator:
         # Flag indicating if termination of the translator has concluded.
         self._terminated = threading.Event()
         # Create a new thread that will read from the unicast socket and write to the multicast socket.
-        self._translation_thread = threading.Thread(target=self._translation_loop)
-        # Create a pool of worker threads that will handle submission of stream information to the Multicast Menu.
-        self._mcastmenu_threadpool = cf.ThreadPoolExecutor(max_workers=constants.MULTICASTMENU_THREADS,
-                                                           thread_name_prefix='multicastmenu_thread')
+        loop = self._batched_translation_loop if self._batch_size > 1 else self._translation_loop
+        self._translation_thread = threading.Thread(target=loop)
         # Determine the IP of the interface that multicast packets are sent out on (i.e., determine the source address
         # for outbound multicast).
-        self._mcast_src_ip = utils.get_ipv4(self._addr_space[1])
+        self._mcast_src_ip = utils.get_ip(self._addr_space[1])
+        # Publishes the streams of new flows on the Multicast Menu (and withdraws the streams of evicted flows) from a
+        # pool of worker threads.
+        batch_interval_s = constants.MULTICASTMENU_BATCH_INTERVAL_S if mcastmenu_batch else None
+        # The access codes of published streams are recorded by the allocator s.t. they survive a warm restart.
+        self._mcastmenu = MulticastMenuPublisher(self._mcast_src_ip, self._mcast_dst_port, mcastmenu_uid=mcastmenu_uid,
+                                                 url=mcastmenu_url, batch_interval_s=batch_interval_s,
+                                                 on_published=self._allocator.set_access_code)
 
     def start(self):
         """
@@ -92,9 +303,14 @@ class Translator:
             raise RuntimeError('Translator already started.')
         self._started.set()
         self._lock.release()
+        if self._idle_timeout_s is not None:
+            self._idle_timers = IdleTimerWheel(self._idle_timeout_s, constants.IDLE_EVICTION_TICK_S, time.monotonic())
         # Prepare the input (unicast) socket and the output (multicast) socket.
         self._init_srv_sckt()
         self._init_mcast_sckt()
+        self._restore_state()
+        self._start_metrics_server()
+        self._mcastmenu.start()
         # Start the translation loop in a separate, dedicated thread.
         self._translation_thread.start()
 
@@ -116,20 +332,245 @@ class Translator:
 
         :return: None.
         """
-        print('Termination initiated...')
+        logger.info('Termination initiated...')
         # Signal to the translation loop that it should terminate.
         self._termination_initiated.set()
         if blocking:
             # Wait until the translation loop has set the terminated flag to indicate that it has exited.
             self._terminated.wait(timeout=blocking_timeout_s)
 
+    def reconfigure(self, mcast_addr_space=None, mcast_ttl=None, mcast_dscp=None, mcast_sndbuf=None,
+                    mcastmenu_url=None, mcastmenu_uid=None):
+        """
+        Apply new settings to this Translator while it is running, without interrupting its flows. Can be called from
+        any thread. Settings that are None are left unchanged.
+
+        The Multicast Menu settings take effect with the next request to the Multicast Menu. The socket options and the
+        address space are applied by the translation thread in between translating packets, in steps of at most
+        constants.RECONFIG_FLOWS_PER_STEP flows (or constants.RECONFIG_MIGRATIONS_PER_STEP migrated flows), so
+        translation never pauses for longer than one such step. If no packets are being received, the translation
+        thread may only notice the new settings once the read timeout expires.
+
+        When switching to a new address space, flows whose multicast addresses are in the new address space keep them.
+        All other flows are migrated: they are allocated a new multicast address from the new address space (or evicted
+        if there are no free addresses left), their streams are published anew, and (if mcastmenu_withdraw is set)
+        their previous streams are withdrawn. If the allocator has been provided to __init__(), whoever provided it must
+        switch it to the new address space first (see McastAddrAllocator.set_addr_space()).
+
+        :param mcast_addr_space: New address space to pick multicast groups from.
+        :param mcast_ttl: New TTL of the translated packets.
+        :param mcast_dscp: New DSCP of the translated packets.
+        :param mcast_sndbuf: New size (in bytes) of the send buffer of the multicast socket(s).
+        :param mcastmenu_url: New base URL of the Multicast Menu.
+        :param mcastmenu_uid: New unique identifier of this translator for the Multicast Menu API.
+
+        :return: None.
+        """
+        dropped = []
+        if mcast_addr_space == self._addr_space:
+            mcast_addr_space = None
+        if mcast_addr_space is not None and mcast_addr_space.version != self._addr_space.version:
+            raise ValueError(f'Switching from IPv{self._addr_space.version} to IPv{mcast_addr_space.version} multicast '
+                             f'requires a restart.')
+        if mcast_addr_space is not None:
+            if self._owns_allocator:
+                dropped = self._allocator.set_addr_space(mcast_addr_space)
+            logger.info(f'Switching from address space {self._addr_space} to {mcast_addr_space}.',
+                        extra={'event': 'reload'})
+            self._addr_space = mcast_addr_space
+        if mcastmenu_url is not None or mcastmenu_uid is not None:
+            self._mcastmenu.reconfigure(url=mcastmenu_url, mcastmenu_uid=mcastmenu_uid)
+        if mcastmenu_uid is not None:
+            self._mcastmenu_uid = mcastmenu_uid
+        sockopts = dict()
+        for name, attr, value in (('ttl', '_mcast_ttl', mcast_ttl), ('dscp', '_mcast_dscp', mcast_dscp),
+                                  ('sndbuf', '_mcast_sndbuf', mcast_sndbuf)):
+            if value is not None and value != getattr(self, attr):
+                sockopts[name] = value
+                setattr(self, attr, value)
+        if sockopts or mcast_addr_space is not None:
+            self._queue_reconfig(mcast_addr_space, sockopts, dropped)
+
+    def _queue_reconfig(self, mcast_addr_space, sockopts, dropped, lost=()):
+        """
+        Have the translation thread apply a new configuration (see _apply_config()).
+
+        :return: None.
+        """
+        with self._lock:
+            self._reconfigs.append((mcast_addr_space, sockopts, dropped, lost))
+            self._reconfig_pending = True
+
+    def _on_allocations_lost(self, lost):
+        """
+        Have the translation thread evict the flows whose allocations the allocator has lost (see
+        cluster.ClusterAllocator.renew_lease()). Can be called from any thread.
+
+        :param lost: A list of (client address, multicast address) tuples of the lost allocations.
+
+        :return: None.
+        """
+        self._queue_reconfig(None, dict(), [], lost)
+
+    def _step_reconfig(self):
+        """
+        Take the next step of applying the pending new configurations. Only called by the translation thread.
+
+        :return: None.
+        """
+        if self._reconfig_steps is None:
+            with self._lock:
+                self._reconfig_steps = self._apply_config(*self._reconfigs.popleft())
+            # Don't wait for packets for long in between steps.
+            self._srv_sckt.settimeout(constants.RECONFIG_POLL_S)
+        try:
+            next(self._reconfig_steps)
+            return
+        except StopIteration:
+            pass
+        except Exception as e:
+            logger.error(f'Failed to apply the new configuration: {e}', extra={'event': 'reload'})
+        self._reconfig_steps = None
+        with self._lock:
+            if not self._reconfigs:
+                self._reconfig_pending = False
+                self._srv_sckt.settimeout(self._read_timeout_s)
+
+    def _apply_config(self, mcast_addr_space, sockopts, dropped, lost=()):
+        """
+        Apply new socket options and/or a new address space to the multicast socket(s) and the flows in the FIB, and
+        evict the flows of lost allocations. This is a generator that yields after each step s.t. packets can be
+        translated in between.
+
+        :param mcast_addr_space: The new address space (None if unchanged).
+        :param sockopts: Dict of the socket options to change (see sockpool.set_mcast_sockopts()).
+        :param dropped: The allocations the allocator has dropped when switching to the new address space (see
+        McastAddrAllocator.set_addr_space()).
+        :param lost: The allocations the allocator has lost (see _on_allocations_lost()).
+        """
+        step = constants.RECONFIG_FLOWS_PER_STEP
+        if lost:
+            yield from self._evict_lost(lost)
+        if sockopts:
+            set_mcast_sockopts(self._mcast_sckt, **sockopts)
+            if self._flow_sckts is not None:
+                self._flow_sckts.set_default_sockopts(**sockopts)
+                flows = list(self._fib.values())
+                for i in range(0, len(flows), step):
+                    yield
+                    for flow in flows[i:i + step]:
+                        self._flow_sckts.apply_sockopts(flow)
+            logger.info(f'Applied the new socket options ({", ".join(f"{k}={v}" for k, v in sockopts.items())}).',
+                        extra={'event': 'reload'})
+        if mcast_addr_space is None:
+            return
+        # The host addresses of the new address space.
+        first_addr = int(mcast_addr_space.network_address) + 1
+        last_addr = int(mcast_addr_space.broadcast_address) - 1
+        flows = list(self._fib.values())
+        outside = []
+        for i in range(0, len(flows), step):
+            yield
+            outside.extend(flow for flow in flows[i:i + step] if not first_addr <= int(flow.mcast_addr) <= last_addr)
+        step = constants.RECONFIG_MIGRATIONS_PER_STEP
+        for i in range(0, len(outside), step):
+            yield
+            now = time.monotonic()
+            for flow in outside[i:i + step]:
+                # The flow may have been evicted in the meantime.
+                if self._fib.get(flow.client_addr, None) is flow:
+                    self._migrate_flow(flow, now)
+        # Allocations restored from a snapshot whose clients have not been seen since are simply freed.
+        for client_addr, mcast_addr in dropped:
+            if client_addr in self._fib:
+                continue
+            logger.info('Multicast address (%s, %d) freed: it is outside the new address space.', mcast_addr,
+                        self._mcast_dst_port,
+                        extra={'event': 'flow_evicted', 'client': client_addr, 'group': mcast_addr})
+            if self._mcastmenu_withdraw:
+                self._mcastmenu.withdraw(mcast_addr)
+        logger.info(f'Switched to address space {mcast_addr_space}, {len(outside)} flows have been migrated.',
+                    extra={'event': 'reload'})
+
+    def _evict_lost(self, lost):
+        """
+        Evict the flows whose allocations have been lost, s.t. their packets are no longer sent to multicast addresses
+        that other nodes of the cluster may claim. A flow is allocated a new multicast address when its next packet
+        arrives. This is a generator that yields after each step.
+
+        :param lost: A list of (client address, multicast address) tuples of the lost allocations.
+        """
+        step = constants.RECONFIG_FLOWS_PER_STEP
+        num_evicted = 0
+        for i in range(0, len(lost), step):
+            yield
+            for client_addr, mcast_addr in lost[i:i + step]:
+                flow = self._fib.get(client_addr, None)
+                # The flow may have been evicted (and allocated a new multicast address) in the meantime.
+                if flow is None or flow.mcast_addr != mcast_addr:
+                    continue
+                del self._fib[client_addr]
+                self._evicted_pkts += flow.num_pkts
+                self._evicted_bytes += flow.num_bytes
+                if self._flow_sckts is not None:
+                    self._flow_sckts.disconnect(flow)
+                num_evicted += 1
+                logger.info('Multicast address (%s, %d) lost: the lease of this node has expired.', mcast_addr,
+                            self._mcast_dst_port,
+                            extra={'event': 'flow_evicted', 'client': client_addr, 'group': mcast_addr})
+                if self._mcastmenu_withdraw:
+                    self._withdraw_stream(flow)
+        logger.warning(f'Evicted {num_evicted} flows whose multicast addresses have been lost.',
+                       extra={'event': 'cluster'})
+
+    def _migrate_flow(self, flow, now):
+        """
+        Move a flow whose multicast address is outside the address space to a newly allocated multicast address (or
+        evict it if we've run out of addresses), and move its stream on the Multicast Menu accordingly.
+
+        :param flow: The Flow.
+        :param now: Current time.monotonic() timestamp.
+
+        :return: None.
+        """
+        prev_mcast_addr = flow.mcast_addr
+        mcast_addr, new = self._allocator.alloc(flow.client_addr)
+        if mcast_addr == prev_mcast_addr:
+            return
+        if mcast_addr is None:
+            del self._fib[flow.client_addr]
+            self._evicted_pkts += flow.num_pkts
+            self._evicted_bytes += flow.num_bytes
+            if self._flow_sckts is not None:
+                self._flow_sckts.disconnect(flow)
+            logger.warning('Run out of multicast addresses, cannot move %s out of %s.', flow.client_addr,
+                           prev_mcast_addr, extra={'event': 'out_of_addresses', 'client': flow.client_addr})
+        else:
+            flow.mcast_addr = mcast_addr
+            flow.dst_addr = (str(mcast_addr), self._mcast_dst_port)
+            if self._batch_size > 1:
+                flow.sockaddr = mmsg.SockAddr(flow.dst_addr)
+            if self._flow_sckts is not None:
+                self._flow_sckts.reconnect(flow)
+            logger.info('Multicast address of %s moved from %s to %s.', flow.client_addr, prev_mcast_addr, mcast_addr,
+                        extra={'event': 'flow_migrated', 'client': flow.client_addr, 'group': mcast_addr})
+            if new:
+                self._publish_stream(flow)
+        if self._mcastmenu_withdraw:
+            self._mcastmenu.withdraw(prev_mcast_addr)
+
     def _init_srv_sckt(self):
         """
         Prepare the unicast server socket (the socket that will receive unicast UDP from unicast-only clients).
 
         :return: None
         """
-        sckt = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sckt = socket.socket(self._srv_family, socket.SOCK_DGRAM)
+        if self._srv_family == socket.AF_INET6:
+            # Also accept IPv4 (as IPv4-mapped IPv6 addresses) when listening on the unspecified address.
+            sckt.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_V6ONLY, 0)
+        if self._reuse_port:
+            sckt.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         sckt.bind((self._srv_ip, self._srv_port))
         sckt.settimeout(self._read_timeout_s)
         self._srv_sckt = sckt
@@ -141,10 +582,90 @@ class Translator:
 
         :return: None
         """
-        sckt = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
-        sckt.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, self._mcast_ttl)
+        sckt = socket.socket(self._mcast_family, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+        set_mcast_sockopts(sckt, self._mcast_ttl, self._mcast_dscp, self._mcast_sndbuf)
         self._mcast_sckt = sckt
 
+    def _start_metrics_server(self):
+        """
+        Start serving metrics (if enabled).
+
+        :return: None
+        """
+        if self._metrics_port is None:
+            return
+        self._metrics_server = metrics.MetricsServer(self._metrics_addr, self._metrics_port, self._collect_metrics)
+        self._metrics_server.start()
+        logger.info(f'Serving metrics on http://{self._metrics_addr}:{self._metrics_port}/metrics')
+
+    def _restore_state(self):
+        """
+        Restore the allocator's state from the snapshot and start taking snapshots (if we're in charge of that), join
+        the cluster (if any), and take over the access codes of the streams that were published before a warm restart.
+
+        :return: None.
+        """
+        if self._snapshotter is not None:
+            snapshot.restore(self._allocator, self._snapshot_path)
+            self._snapshotter.start()
+        if self._lease_keeper is not None:
+            self._lease_keeper.start()
+        if self._mcastmenu_uid is not None:
+            self._mcastmenu.restore_access_codes(self._allocator.access_codes())
+        if self._idle_timeout_s is not None:
+            self._unclaimed_deadline = time.monotonic() + self._idle_timeout_s
+
+    def _collect_metrics(self):
+        """
+        Collect the Translator's metrics. Called by the metrics server's threads, concurrently with the translation
+        thread (which is fine as the counters are only read here).
+
+        :return: The metric families (see metrics.render()).
+        """
+        flows = list(self._fib.values())
+        fwd_pkts = self._evicted_pkts + sum(flow.num_pkts for flow in flows)
+        fwd_bytes = self._evicted_bytes + sum(flow.num_bytes for flow in flows)
+        drops = {'truncated': self._truncated_count, 'no_address': self._no_addr_count,
+                 'send_error': self._send_error_count, 'admission_denied': self._denied_count,
+                 'rate_limited': self._rate_limited_count}
+        allocated, capacity = self._allocator.occupancy()
+        families = [
+            ('u2mt_packets_received', 'counter', 'Unicast packets received.',
+             [('_total', {}, fwd_pkts + sum(drops.values()) - drops['send_error'])]),
+            ('u2mt_packets_sent', 'counter', 'Multicast packets sent.',
+             [('_total', {}, fwd_pkts - drops['send_error'])]),
+            ('u2mt_bytes_forwarded', 'counter', 'Payload bytes of the unicast packets forwarded as multicast.',
+             [('_total', {}, fwd_bytes)]),
+            ('u2mt_packets_dropped', 'counter', 'Unicast packets that were not forwarded, by reason.',
+             [('_total', {'reason': reason}, count) for reason, count in drops.items()]),
+            ('u2mt_fib_flows', 'gauge', 'Flows in the forwarding table.', [('', {}, len(flows))]),
+            ('u2mt_allocator_allocated_addresses', 'gauge', 'Multicast addresses allocated.', [('', {}, allocated)]),
+            ('u2mt_allocator_capacity_addresses', 'gauge', 'Multicast addresses available for allocation in total.',
+             [('', {}, capacity)]),
+            ('u2mt_loop_latency_seconds', 'histogram', 'Time to process a packet (or a batch of packets), sampled.',
+             self._loop_latency.samples()),
+        ]
+        if self._pacer is not None:
+            families.append(('u2mt_pacing_delayed_packets', 'counter', 'Packets held back for pacing.',
+                             [('_total', {}, self._pacer.num_delayed)]))
+            families.append(('u2mt_pacing_released_early_packets', 'counter',
+                             'Packets held back for pacing that were sent before they were due (jitter buffer full).',
+                             [('_total', {}, self._pacer.num_released_early)]))
+            families.append(('u2mt_pacing_queued_packets', 'gauge', 'Packets currently held back for pacing.',
+                             [('', {}, len(self._pacer))]))
+        families.extend(self._mcastmenu.collect_metrics())
+        if self._metrics_per_flow:
+            families.append(('u2mt_flow_packets_forwarded', 'counter', 'Packets forwarded per flow.',
+                             [('_total', self._flow_labels(flow), flow.num_pkts) for flow in flows]))
+            families.append(('u2mt_flow_bytes_forwarded', 'counter', 'Payload bytes forwarded per flow.',
+                             [('_total', self._flow_labels(flow), flow.num_bytes) for flow in flows]))
+        return families
+
+    @staticmethod
+    def _flow_labels(flow):
+        ip, port = flow.client_addr[:2]
+        return {'source': f'[{ip}]:{port}' if ':' in ip else f'{ip}:{port}', 'group': str(flow.mcast_addr)}
+
     def _clean_up(self):
         """
         Perform clean up at termination time (close sockets etc.).
@@ -152,9 +673,20 @@ class Translator:
         :return: None
         """
         # TODO free all resources.
+        if self._truncated_count:
+            logger.warning(f'{self._truncated_count} unicast packets were dropped as they exceeded the read buffer '
+                           f'size ({self._buffer_size} bytes).')
+        if self._metrics_server is not None:
+            self._metrics_server.stop()
         self._srv_sckt.close()
         self._mcast_sckt.close()
-        self._mcastmenu_threadpool.shutdown(wait=True, cancel_futures=True)
+        if self._flow_sckts is not None:
+            self._flow_sckts.close()
+        if self._snapshotter is not None:
+            self._snapshotter.stop()
+        if self._lease_keeper is not None:
+            self._lease_keeper.stop()
+        self._mcastmenu.stop()
 
     def _translation_loop(self):
         """
@@ -162,147 +694,543 @@ class Translator:
 
         :return: None.
         """
+        # Receive into a preallocated buffer (rather than having recvfrom() allocate a new bytes object per packet). The
+        # payload is forwarded before the next packet is received, so a single buffer suffices.
+        buf = bytearray(self._buffer_size)
+        buf_mv = memoryview(buf)
+        bufs = [buf]
+        # Only every so many packets' processing time is recorded (see _loop_latency).
+        latency_countdown = constants.METRICS_LOOP_LATENCY_SAMPLE_INTERVAL
+        # The current timeout of the unicast socket, which is shortened while packets are held back for pacing.
+        srv_timeout_s = self._read_timeout_s
         try:
             while not self._termination_initiated.is_set():
+                if self._pacer is not None:
+                    timeout_s = self._read_timeout_s
+                    if self._pacer.next_departure < math.inf:
+                        timeout_s = constants.PACING_TICK_S
+                    if timeout_s != srv_timeout_s:
+                        self._srv_sckt.settimeout(timeout_s)
+                        srv_timeout_s = timeout_s
                 try:
-                    payload, src_addr = self._srv_sckt.recvfrom(self._buffer_size)
-                    # Look up the multicast address allocated for this client, if any.
-                    mcast_addr = self._fib.get(src_addr, None)
-                    if mcast_addr is None:
-                        # No multicast address currently allocated for this client. Allocate one.
-                        mcast_addr = self._alloc_mcast_addr(src_addr)
-                        if mcast_addr is not None:
-                            # Publish the new stream on the Multicast Menu if we successfully allocated a multicast
-                            # address. We'll let a worker thread handle the communication with the multicast menu
-                            # s.t. the I/O does not block translation of any ongoing streams (i.e., it is important we
-                            # do not block the thread that runs the translation loop).
-                            desc = f'Translated stream originating from {src_addr[0]}'
-                            self._mcastmenu_threadpool.submit(self._add_to_multicast_menu, mcast_addr,
-                                                              constants.MULTICASTMENU_EMAIL, desc)
-                    if mcast_addr is not None:
-                        # Forward the payload to the multicast address allocated for this client.
-                        self._mcast_sckt.sendto(payload, (str(mcast_addr), self._mcast_dst_port))
+                    nbytes, _, msg_flags, src_addr = self._srv_sckt.recvmsg_into(bufs)
+                    now = time.monotonic()
+                    if msg_flags & socket.MSG_TRUNC:
+                        # The payload did not fit into the buffer, so forwarding it would deliver a mangled payload.
+                        self._drop_truncated(src_addr)
                     else:
-                        # mcast_addr will be None if we've run out of addresses.
-                        # TODO silently discard the packet or communicate this to the client?
-                        print(f'WARNING: run out of multicast addresses, cannot serve {src_addr}')
+                        # Look up the flow (and thus the multicast address allocated) for this client, if any.
+                        flow = self._fib.get(src_addr, None)
+                        if flow is None:
+                            # No multicast address currently allocated for this client. Allocate one. flow will be None
+                            # if the new flow has been denied admission or we've run out of addresses.
+                            flow = self._handle_new_flow(src_addr, now)
+                        if flow is not None:
+                            flow.last_seen = now
+                            if flow.policer is None or flow.policer.admit(nbytes, now):
+                                flow.num_pkts += 1
+                                flow.num_bytes += nbytes
+                                # Forward the payload (a slice of the receive buffer, i.e., without copying it) to the
+                                # multicast address allocated for this client, unless it is held back for pacing.
+                                payload = buf_mv[:nbytes]
+                                if flow.pacing is None or self._pacer.pace(flow, payload, nbytes, now):
+                                    try:
+                                        if flow.sckt is not None:
+                                            flow.sckt.send(payload)
+                                        else:
+                                            self._mcast_sckt.sendto(payload, flow.dst_addr)
+                                    except OSError:
+                                        # E.g., the payload exceeds the path MTU. Drop it rather than terminate.
+                                        self._send_error_count += 1
+                            else:
+                                self._drop_rate_limited(flow)
+                    latency_countdown -= 1
+                    if latency_countdown == 0:
+                        self._loop_latency.observe(time.monotonic() - now)
+                        latency_countdown = constants.METRICS_LOOP_LATENCY_SAMPLE_INTERVAL
+                    if self._pacer is not None and now >= self._pacer.next_departure:
+                        self._release_paced(now)
+                    if self._idle_timers is not None and now >= self._idle_timers.next_tick_time:
+                        self._evict_idle_flows(now)
+                    if self._reconfig_pending:
+                        self._step_reconfig()
                 except socket.timeout:
                     # No data available to read during this iteration.
-                    print('read timeout: nothing to be translated this iteration')
+                    logger.debug('read timeout: nothing to be translated this iteration',
+                                 extra={'event': 'read_timeout'})
+                    if self._pacer is not None:
+                        self._release_paced(time.monotonic())
+                    if self._idle_timers is not None:
+                        self._evict_idle_flows(time.monotonic())
+                    if self._reconfig_pending:
+                        self._step_reconfig()
         finally:
             # Free all resources (close all sockets etc.)
             self._clean_up()
             # Signal that we have terminated the translation loop.
             self._terminated.set()
 
-    def _alloc_mcast_addr(self, client_addr):
+    def _batched_translation_loop(self):
+        """
+        Batched variant of _translation_loop(). Receives up to _batch_size packets from the unicast socket per recvmmsg
+        call (into preallocated buffers) and forwards each such burst with a single sendmmsg call, without copying the
+        payloads.
+
+        :return: None.
+        """
+        receiver = mmsg.BatchReceiver(self._batch_size, self._buffer_size, self._srv_family)
+        sender = mmsg.BatchSender(self._batch_size, self._mcast_family)
+        srv_fd = self._srv_sckt.fileno()
+        mcast_fd = self._mcast_sckt.fileno()
+        # The unicast socket is in non-blocking mode (as it has a timeout), so wait for it to become readable instead.
+        poller = select.poll()
+        poller.register(srv_fd, select.POLLIN)
+        read_timeout_ms = self._read_timeout_s * 1000
+        reconfig_poll_ms = constants.RECONFIG_POLL_S * 1000
         try:
-            self._lock.acquire()
-            assert client_addr not in self._fib, f'A multicast address ({self._fib[client_addr]}) has already been ' \
-                                                 f'allocated for this client address ({client_addr}).'
-            # Check if we've already used up all addresses in the address space (-2 is to exclude the network address
-            # and the broadcast address).
-            # TODO: only allow use of up to X% of the available addresses (to reduce address selection workload below)?
-            if len(self._allocated_mcast_addrs) == self._addr_space.num_addresses - 2:
-                # All addresses in the address space are currently in use by other clients.
-                return None
-            # Randomly generate an index that will be used to pick an address in the address space at random:
-            # - use min index = 1 to exclude the network address from consideration;
-            # - use max index = self._addr_space.num_addresses - 2 to exclude the broadcast address from consideration.
-            min_idx = 1
-            max_idx = self._addr_space.num_addresses - 2
-            addr_idx = random.randint(min_idx, max_idx)
-            attempts = 1
-            max_attempts = 10
-            # If the address we picked is already in use, allow up to max_attempts attempts at picking a new address at
-            # random. If we did not cap the number of attempts, we could (theoretically) end up looping for a very long
-            # time ("indefinitely") if the address space is very large and only has a single usable address left.
-            while self._addr_space[addr_idx] in self._allocated_mcast_addrs and attempts < max_attempts:
-                addr_idx = random.randint(min_idx, max_idx)
-                attempts += 1
-            # If we were unsuccessful at picking an address at random (within the allowed number of attempts), we
-            # instead try addresses linearly, starting from the last address we picked at random that was already in
-            # use. As a result, the address selection is not truly (pseudo) random as any address that is an immediate
-            # neighbor of any (continuous block of) address(es) that is (are) already in use has a greater chance of
-            # being selected. However, this "imbalance" is acceptable for our purposes.
-            while self._addr_space[addr_idx] in self._allocated_mcast_addrs:
-                addr_idx += 1
-                addr_idx = min_idx if addr_idx > max_idx else addr_idx
-            # Add information about the newly allocated address to the FIB and set of multicast addresses in use.
-            mcast_addr = self._addr_space[addr_idx]
-            assert mcast_addr not in self._allocated_mcast_addrs, f'picked a multicast address ({mcast_addr}) that ' \
-                                                                  f'was already allocated'
-            self._fib[client_addr] = mcast_addr
-            self._allocated_mcast_addrs.add(mcast_addr)
-            print(f'Multicast address ({mcast_addr}, {self._mcast_dst_port}) allocated for {client_addr}.')
-            return mcast_addr
+            while not self._termination_initiated.is_set():
+                timeout_ms = reconfig_poll_ms if self._reconfig_pending else read_timeout_ms
+                if self._pacer is not None and self._pacer.next_departure < math.inf:
+                    # Wake up when the next packet that is held back for pacing is due.
+                    timeout_ms = min(timeout_ms, max(0.0, (self._pacer.next_departure - time.monotonic()) * 1000))
+                if not poller.poll(timeout_ms):
+                    # No data available to read during this iteration.
+                    logger.debug('read timeout: nothing to be translated this iteration',
+                                 extra={'event': 'read_timeout'})
+                    if self._pacer is not None:
+                        self._release_paced(time.monotonic())
+                    if self._idle_timers is not None:
+                        self._evict_idle_flows(time.monotonic())
+                    if self._reconfig_pending:
+                        self._step_reconfig()
+                    continue
+                # All packets in a batch are considered to have been received at the same time.
+                now = time.monotonic()
+                for i in range(receiver.recv(srv_fd)):
+                    src_addr = receiver.src_addr(i)
+                    if receiver.flags[i] & socket.MSG_TRUNC:
+                        self._drop_truncated(src_addr)
+                        continue
+                    flow = self._fib.get(src_addr, None)
+                    if flow is None:
+                        flow = self._handle_new_flow(src_addr, now)
+                        if flow is None:
+                            continue
+                    nbytes = receiver.lengths[i]
+                    flow.last_seen = now
+                    if flow.policer is not None and not flow.policer.admit(nbytes, now):
+                        self._drop_rate_limited(flow)
+                        continue
+                    flow.num_pkts += 1
+                    flow.num_bytes += nbytes
+                    if flow.pacing is not None and not self._pacer.pace(flow, receiver.payload(i), nbytes, now):
+                        continue
+                    if flow.sckt is not None:
+                        # Connected sockets cannot share a sendmmsg call, so the packet is sent right away.
+                        try:
+                            flow.sckt.send(receiver.payload(i))
+                        except OSError:
+                            self._send_error_count += 1
+                        continue
+                    sender.queue(receiver.slot_addrs[i], nbytes, flow.sockaddr.address)
+                self._send_error_count += sender.flush(mcast_fd)
+                if self._pacer is not None and now >= self._pacer.next_departure:
+                    self._release_paced(now)
+                # The processing time of each batch is recorded (rather than sampled as by _translation_loop()).
+                self._loop_latency.observe(time.monotonic() - now)
+                if self._idle_timers is not None and now >= self._idle_timers.next_tick_time:
+                    self._evict_idle_flows(now)
+                if self._reconfig_pending:
+                    self._step_reconfig()
         finally:
-            self._lock.release()
+            # Free all resources (close all sockets etc.)
+            self._clean_up()
+            # Signal that we have terminated the translation loop.
+            self._terminated.set()
 
-    def _add_to_multicast_menu(self, mcast_dst_ip, email, description):
+    def _drop_truncated(self, src_addr):
         """
-        Publish information about a new stream (that is now being translated) on the Multicast Menu by submitting the
-        form at constants.MULTICASTMENU_ADD_URL.
+        Account for a unicast packet that is dropped because its payload exceeded the read buffer size.
 
-        :param mcast_dst_ip: The multicast destination IP (multicast group) used for the new stream.
-        :param email: Contact email (currently a required field on the form, to be removed)
-        :param description: A description of the stream.
+        :param src_addr: The (ip, port) tuple identifying the unicast source of the packet.
 
-        :return: None
+        :return: None.
+        """
+        self._truncated_count += 1
+        logger.warning('Dropped a unicast packet from %s that exceeds the read buffer size (%d bytes).', src_addr,
+                       self._buffer_size, extra={'event': 'packet_truncated', 'client': src_addr})
+
+    def _release_paced(self, now):
+        """
+        Send the packets that are held back for pacing and have become due.
+
+        :param now: Current time.monotonic() timestamp.
+
+        :return: None.
+        """
+        for flow, payload in self._pacer.release(now):
+            try:
+                if flow.sckt is not None:
+                    flow.sckt.send(payload)
+                else:
+                    self._mcast_sckt.sendto(payload, flow.dst_addr)
+            except OSError:
+                # E.g., the send buffer is full (the asyncio engine's sockets are non-blocking).
+                self._send_error_count += 1
+
+    def _drop_rate_limited(self, flow):
+        """
+        Account for a unicast packet that is dropped because its flow exceeded its rate limits.
+
+        :param flow: The Flow.
+
+        :return: None.
+        """
+        self._rate_limited_count += 1
+        if flow.policer.num_dropped == 1:
+            # Only the first drop of each flow is logged, as a flow that exceeds its rate limits usually keeps doing so.
+            logger.warning('%s exceeds its rate limits, dropping its packets over quota.', flow.client_addr,
+                           extra={'event': 'rate_limited', 'client': flow.client_addr})
+
+    def _admit_new_flow(self, src_addr, now):
         """
-        errmsg = f'Attempt to add amt://{self._mcast_src_ip}@{mcast_dst_ip}:{self._mcast_dst_port} to the Multicast ' \
-                 f'Menu failed (email={email}; description={description}): '
+        Decide whether a new unicast flow is admitted, and account for the packet if it is denied.
+
+        :param src_addr: The (ip, port) tuple identifying the unicast source of the new flow.
+        :param now: time.monotonic() timestamp of the packet.
+
+        :return: True if the flow is admitted.
+        """
+        if self._admission.admit_new_flow(now):
+            if self._denied_run:
+                logger.info('Admitting new flows again, %d packets of new flows have been denied.', self._denied_run,
+                            extra={'event': 'flow_denied'})
+                self._denied_run = 0
+            return True
+        self._denied_count += 1
+        self._denied_run += 1
+        if self._denied_run == 1:
+            # The packets of denied flows are not logged individually, as they may well be a flood.
+            logger.warning('New flows exceed the admission rate (%s per second), denying new flows such as %s.',
+                           self._max_new_flows_per_s, src_addr, extra={'event': 'flow_denied', 'client': src_addr})
+        return False
+
+    def _handle_new_flow(self, src_addr, now):
+        """
+        Admit a new unicast flow, allocate a multicast address for it and publish the new stream on the Multicast Menu.
+
+        :param src_addr: The (ip, port) tuple identifying the unicast source of the new flow.
+        :param now: time.monotonic() timestamp of the flow's first packet.
+
+        :return: The new Flow, or None if the flow has been denied admission or we've run out of addresses (in which
+        case the packet is to be dropped, which has been accounted for).
+        """
+        if self._admission is not None and not self._admit_new_flow(src_addr, now):
+            return None
+        flow, new = self._alloc_mcast_addr(src_addr, now)
+        if flow is None:
+            # TODO silently discard the packet or communicate this to the client?
+            self._no_addr_count += 1
+            logger.warning('Run out of multicast addresses, cannot serve %s', src_addr,
+                           extra={'event': 'out_of_addresses', 'client': src_addr})
+            return None
+        if new:
+            # Publish the new stream on the Multicast Menu if we successfully allocated a multicast address (unless it
+            # has been published already by another Translator that shares our allocator).
+            self._publish_stream(flow)
+        return flow
+
+    def _publish_stream(self, flow):
+        """
+        Publish the stream of a new flow on the Multicast Menu in the background.
+
+        :param flow: The new Flow.
+
+        :return: None.
+        """
+        # The publisher's worker threads handle the communication with the multicast menu s.t. the I/O does not block
+        # translation of any ongoing streams (i.e., it is important we do not block the thread that runs the translation
+        # loop).
+        self._mcastmenu.publish(flow.mcast_addr, f'Translated stream originating from {flow.client_addr[0]}')
+
+    def _withdraw_stream(self, flow):
+        """
+        Withdraw the stream of an evicted flow from the Multicast Menu in the background.
+
+        :param flow: The evicted Flow.
+
+        :return: None.
+        """
+        self._mcastmenu.withdraw(flow.mcast_addr)
+
+    def _alloc_mcast_addr(self, client_addr, now):
+        """
+        Allocate a multicast address for a unicast client and add a Flow for it to the FIB.
+
+        :param client_addr: The (ip, port) tuple identifying the unicast client.
+        :param now: time.monotonic() timestamp of the client's first packet.
+
+        :return: A (Flow, newly allocated) tuple. Newly allocated is False if the allocator already had an address on
+        record for client_addr (e.g., because another Translator sharing the allocator served the client before). The
+        Flow is None if we've run out of addresses.
+        """
+        assert client_addr not in self._fib, f'A multicast address ({self._fib[client_addr].mcast_addr}) has ' \
+                                             f'already been allocated for this client address ({client_addr}).'
+        mcast_addr, new = self._allocator.alloc(client_addr)
+        if mcast_addr is None:
+            return None, False
+        # Prepare the destination in the form(s) the datapath needs it in once, rather than for every packet.
+        dst_addr = (str(mcast_addr), self._mcast_dst_port)
+        sockaddr = mmsg.SockAddr(dst_addr) if self._batch_size > 1 else None
+        policer = self._admission.policer(now) if self._admission is not None else None
+        pacing = self._pacer.flow_state(now) if self._pacer is not None else None
+        flow = Flow(client_addr, mcast_addr, dst_addr, sockaddr, now, policer=policer, pacing=pacing)
+        self._fib[client_addr] = flow
+        if self._flow_sckts is not None:
+            self._flow_sckts.connect(flow, now)
+        if self._idle_timers is not None:
+            self._idle_timers.add(flow)
+        if new:
+            logger.info('Multicast address (%s, %d) allocated for %s.', mcast_addr, self._mcast_dst_port, client_addr,
+                        extra={'event': 'flow_allocated', 'client': client_addr, 'group': mcast_addr})
+        return flow, new
+
+    def _evict_idle_flows(self, now):
+        """
+        Evict all flows that have been idle for longer than the idle timeout from the FIB, free their multicast
+        addresses and (if enabled) withdraw their streams from the Multicast Menu.
+
+        :param now: Current time.monotonic() timestamp.
+
+        :return: A list of the evicted Flows.
+        """
+        if self._unclaimed_deadline is not None and now >= self._unclaimed_deadline:
+            self._unclaimed_deadline = None
+            self._expire_unclaimed()
+        evicted = []
+        for flow in self._idle_timers.expire(now):
+            if self._fib.get(flow.client_addr, None) is not flow:
+                continue
+            del self._fib[flow.client_addr]
+            self._evicted_pkts += flow.num_pkts
+            self._evicted_bytes += flow.num_bytes
+            if self._flow_sckts is not None:
+                self._flow_sckts.disconnect(flow)
+            self._allocator.free(flow.client_addr)
+            evicted.append(flow)
+            logger.info('Multicast address (%s, %d) freed: %s has been idle for more than %s seconds.', flow.mcast_addr,
+                        self._mcast_dst_port, flow.client_addr, self._idle_timeout_s,
+                        extra={'event': 'flow_evicted', 'client': flow.client_addr, 'group': flow.mcast_addr})
+            if self._mcastmenu_withdraw:
+                self._withdraw_stream(flow)
+        return evicted
+
+    def _expire_unclaimed(self):
+        """
+        Free the multicast addresses restored from a snapshot whose clients have not been seen for an idle timeout
+        since (if several Translators share the allocator, the first one to get here frees all of them).
+
+        :return: None.
+        """
+        for client_addr, mcast_addr in self._allocator.expire_unclaimed():
+            logger.info('Multicast address (%s, %d) freed: %s has not been seen since the restart.', mcast_addr,
+                        self._mcast_dst_port, client_addr,
+                        extra={'event': 'flow_evicted', 'client': client_addr, 'group': mcast_addr})
+            if self._mcastmenu_withdraw:
+                self._mcastmenu.withdraw(mcast_addr)
+
+
+def _ignore_termination_signals():
+    """
+    Ignore SIGINT and SIGTERM (and SIGHUP) in a child process, leaving it to the parent process to coordinate
+    termination (and configuration reloads).
+
+    :return: None.
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    if hasattr(signal, 'SIGHUP'):
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+
+
+def _run_worker(translator_kwargs, allocator, reconfigs, log_config):
+    """
+    Entry point of a WorkerPool's worker process: run a Translator, applying the new settings received on reconfigs,
+    until None is received.
+
+    :param translator_kwargs: Keyword arguments for the Translator.
+    :param allocator: Proxy for the McastAddrAllocator shared by all workers.
+    :param reconfigs: A multiprocessing.Queue of keyword arguments for Translator.reconfigure() or lists of lost
+    allocations (see Translator._on_allocations_lost()), or None to signal that the worker should terminate.
+    :param log_config: Keyword arguments for logsetup.setup() (None to leave logging as is).
+
+    :return: None.
+    """
+    _ignore_termination_signals()
+    if log_config is not None:
+        # The parent's log writer thread does not exist in this process.
+        logsetup.setup(**log_config)
+    t = Translator(allocator=allocator, reuse_port=True, **translator_kwargs)
+    t.start()
+    for settings in iter(reconfigs.get, None):
+        if isinstance(settings, list):
+            t._on_allocations_lost(settings)
+            continue
         try:
-            # To create an entry for the stream in the Multicast Menu, we're going to programmatically submit the form
-            # at constants.MULTICASTMENU_ADD_URL since there is currently no API for the Multicast Menu. However, we
-            # cannot simply do a single, one-shot POST request to that URL as the Multicast Menu uses Django's CSRF
-            # protection. To get around this, we must first establish a session with the Multicast Menu and send a GET
-            # request to the form's webpage to get our hands on a CSRF protection token.
-            sess = requests.session()
-            resp_get = sess.get(constants.MULTICASTMENU_ADD_URL)
-            if resp_get.status_code != 200:
-                errmsg += f'GET resulted in status code {resp_get.status_code}. Response body:\n{resp_get.text}'
-                print(errmsg)
-                return
-            csrftoken = sess.cookies.get('csrftoken')
-            if csrftoken is None:
-                errmsg += 'no csrftoken found in session.'
-                print(errmsg)
-                return
-            # We can now submit the form using a POST request. In doing so, we must provide the CSRF protection token
-            # alongside the other form parameters (the form has a hidden input tag that contains the CSRF protection
-            # token) and as a cookie (but the requests module takes care of this part automatically because we're using
-            # a session). Also note that we must set the Referer header field (to the same URL we're submitting the form
-            # to) as otherwise we'll get rejected by the server.
-            form_params = {'csrfmiddlewaretoken': csrftoken, 'source': self._mcast_src_ip, 'group': str(mcast_dst_ip),
-                           'udp_port': str(self._mcast_dst_port), 'email': email, 'description': str(description),
-                           'Add': 'Add'}
-            header_fields = {'Referer': constants.MULTICASTMENU_ADD_URL}
-            resp_post = sess.post(constants.MULTICASTMENU_ADD_URL, data=form_params, headers=header_fields)
-            if resp_post.status_code != 200:
-                errmsg += f'POST resulted in status code {resp_post.status_code}. Response body:\n{resp_post.text}'
-                print(errmsg)
-                return
-            msg = f'Added amt://{self._mcast_src_ip}@{mcast_dst_ip}:{self._mcast_dst_port} to the Multicast Menu ' \
-                  f'(email={email}; description={description}).'
-            print(msg)
-        except Exception as e:
-            errmsg += f'encountered a {type(e)} with message "{e}".'
-            print(errmsg)
+            t.reconfigure(**settings)
+        except ValueError as e:
+            logger.error(f'Failed to apply the new configuration: {e}', extra={'event': 'reload'})
+    t.terminate(blocking=True)
+    logsetup.shutdown()
+
+
+class WorkerPool:
+    """
+    Runs a Translator in each of several worker processes to spread translation across CPU cores.
+
+    All Translators listen on the same unicast port (SO_REUSEPORT), and the kernel distributes the unicast flows across
+    them by hashing each packet's 4-tuple, so all packets of a flow are handled by the same worker. The workers share a
+    single McastAddrAllocator that is served by a coordinator process (see AllocatorManager), so two workers never hand
+    out the same multicast group. If a snapshot path is given, the pool (rather than the workers) restores and
+    snapshots the shared allocator's state. Likewise, if a cluster backend is given, the shared allocator is a
+    ClusterAllocator whose lease the pool renews (i.e., the pool is a single node of the cluster). New settings (see
+    reconfigure()) are passed on to every worker.
+    """
+
+    def __init__(self, num_workers, **translator_kwargs):
+        """
+        Create a new WorkerPool. The worker processes are not started until you call start().
+
+        :param num_workers: Number of worker processes (i.e., Translators).
+        :param translator_kwargs: Keyword arguments for each worker's Translator (see Translator.__init__()).
+        """
+        if num_workers < 1:
+            raise ValueError(f'num_workers must be at least 1, but was {num_workers}')
+        self._num_workers = num_workers
+        self._snapshot_path = translator_kwargs.pop('snapshot_path', None)
+        self._cluster_backend = translator_kwargs.pop('cluster_backend', None)
+        self._cluster_node_id = translator_kwargs.pop('cluster_node_id', None)
+        self._cluster_lease_ttl_s = translator_kwargs.pop('cluster_lease_ttl_s', constants.DEFAULT_CLUSTER_LEASE_TTL_S)
+        if self._cluster_backend is not None and self._snapshot_path is not None:
+            raise ValueError('Snapshots cannot be combined with clustering (the cluster backend keeps the '
+                             'allocations).')
+        self._translator_kwargs = translator_kwargs
+        self._manager = AllocatorManager()
+        self._allocator = None
+        self._snapshotter = None
+        self._lease_keeper = None
+        # A queue per worker for passing new settings to it (or None to signal that it should terminate).
+        self._reconfigs = []
+        self._workers = []
+
+    def start(self):
+        """
+        Start the coordinator process and the worker processes.
+
+        :return: None.
+        """
+        self._manager.start(initializer=_ignore_termination_signals)
+        mcast_addr_space = self._translator_kwargs['mcast_addr_space']
+        alloc_policy = self._translator_kwargs.get('alloc_policy', 'random')
+        if self._cluster_backend is not None:
+            allocator = self._manager.ClusterAllocator(mcast_addr_space, alloc_policy, self._cluster_backend,
+                                                       self._cluster_node_id, self._cluster_lease_ttl_s)
+            self._lease_keeper = LeaseKeeper(allocator, self._on_allocations_lost, self._cluster_lease_ttl_s)
+            self._lease_keeper.start()
+        else:
+            allocator = self._manager.McastAddrAllocator(mcast_addr_space, alloc_policy)
+        self._allocator = allocator
+        if self._snapshot_path is not None:
+            snapshot.restore(allocator, self._snapshot_path)
+            self._snapshotter = snapshot.Snapshotter(allocator, self._snapshot_path)
+            self._snapshotter.start()
+        for i in range(self._num_workers):
+            translator_kwargs = dict(self._translator_kwargs)
+            if translator_kwargs.get('metrics_port') is not None:
+                # Each worker serves its own metrics, on consecutive ports.
+                translator_kwargs['metrics_port'] += i
+            if translator_kwargs.get('max_new_flows_per_s') is not None:
+                # The kernel spreads the new flows evenly across the workers, and so is the admission rate.
+                translator_kwargs['max_new_flows_per_s'] /= self._num_workers
+            reconfigs = mp.Queue()
+            p = mp.Process(target=_run_worker, name=f'translator_worker_{i}',
+                           args=(translator_kwargs, allocator, reconfigs, logsetup.config()))
+            p.start()
+            self._reconfigs.append(reconfigs)
+            self._workers.append(p)
+
+    def reconfigure(self, **settings):
+        """
+        Apply new settings to all workers (see Translator.reconfigure()). A new address space is applied to the shared
+        allocator first, after which each worker migrates its own flows.
+
+        :param settings: Keyword arguments for Translator.reconfigure().
+
+        :return: None.
+        """
+        mcast_addr_space = settings.get('mcast_addr_space', None)
+        if mcast_addr_space is not None and mcast_addr_space != self._translator_kwargs['mcast_addr_space']:
+            dropped = self._allocator.set_addr_space(mcast_addr_space)
+            self._translator_kwargs['mcast_addr_space'] = mcast_addr_space
+            logger.info(f'Switched the allocator to address space {mcast_addr_space}, {len(dropped)} allocations are '
+                        f'outside of it.', extra={'event': 'reload'})
+        for reconfigs in self._reconfigs:
+            reconfigs.put(settings)
+
+    def _on_allocations_lost(self, lost):
+        """
+        Have every worker evict its flows whose allocations the shared ClusterAllocator has lost. Called from the
+        LeaseKeeper's thread.
+
+        :param lost: A list of (client address, multicast address) tuples of the lost allocations.
 
-    # TODO add functionality that evicts addresses from the FIB when they've been inactive for a while.
+        :return: None.
+        """
+        for reconfigs in self._reconfigs:
+            reconfigs.put(lost)
+
+    def terminate(self, blocking=False, blocking_timeout_s=None):
+        """
+        Terminate all workers, and the coordinator process once all workers have terminated.
+
+        :param blocking: If set to True, block until termination has concluded or the blocking_timeout_s (if any)
+        expires, whichever occurs first.
+        :param blocking_timeout_s: Maximum time (in seconds, or fractions thereof) to wait for termination. Set to None
+        to wait indefinitely. Only considered when blocking=True.
+
+        :return: None.
+        """
+        for reconfigs in self._reconfigs:
+            reconfigs.put(None)
+        if blocking:
+            deadline = None if blocking_timeout_s is None else time.monotonic() + blocking_timeout_s
+            for p in self._workers:
+                p.join(timeout=None if deadline is None else max(0.0, deadline - time.monotonic()))
+            if not any(p.is_alive() for p in self._workers):
+                if self._snapshotter is not None:
+                    self._snapshotter.stop()
+                if self._lease_keeper is not None:
+                    self._lease_keeper.stop()
+                self._manager.shutdown()
 
 
 class GracefulKiller:
     kill_now = False
+    reload_now = False
 
     def __init__(self):
         signal.signal(signal.SIGINT, self.exit_gracefully)
         signal.signal(signal.SIGTERM, self.exit_gracefully)
+        if hasattr(signal, 'SIGHUP'):
+            # Not available on Windows.
+            signal.signal(signal.SIGHUP, self.reload)
 
-    def exit_gracefully(self):
+    def exit_gracefully(self, signum, frame):
         self.kill_now = True
 
+    def reload(self, signum, frame):
+        self.reload_now = True
+
 
 if __name__ == '__main__':
     desc = 'Start a unicast-to-multicast translation service on this machine.'
@@ -311,9 +1239,9 @@ if __name__ == '__main__':
     ucast_nif_ip_argname = 'unicast-nif-ip'
     h = 'IP address of the network interface to listen for unicast on. The default value is what was determined to ' \
         'be the primary network interface of this machine (i.e., the network interface that has a default route). ' \
-        'Note that this address may not be a public address if this machine is behind NAT or a VPN. ' \
-        'Default: %(default)s'
-    ap.add_argument(f'--{ucast_nif_ip_argname}', type=ipaddress.IPv4Address, default=utils.get_ipv4(), help=h)
+        'Note that this address may not be a public address if this machine is behind NAT or a VPN. Use :: to listen ' \
+        'for both IPv4 and IPv6 on all network interfaces. Default: %(default)s'
+    ap.add_argument(f'--{ucast_nif_ip_argname}', type=ipaddress.ip_address, default=utils.get_ipv4(), help=h)
 
     ucast_port_argname = 'unicast-port'
     h = 'Port number to listen for unicast on. Default: %(default)d'
@@ -321,30 +1249,260 @@ if __name__ == '__main__':
 
     mcast_addr_space_argname = 'multicast-addr-space'
     h = 'Address space to (randomly) pick destination multicast addresses (groups) from for the translated unicast ' \
-        'flows. Default: %(default)s'
-    ap.add_argument(f'--{mcast_addr_space_argname}', type=ipaddress.IPv4Network,
+        'flows: an IPv4 address space, or an IPv6 SSM address space of at most 2^32 groups (e.g., ff3e::/96) to ' \
+        'translate to IPv6 multicast. Default: %(default)s'
+    ap.add_argument(f'--{mcast_addr_space_argname}', type=ipaddress.ip_network,
                     default=constants.DEFAULT_MULTICAST_ADDR_SPACE, help=h)
 
+    alloc_policy_argname = 'alloc-policy'
+    h = 'Policy for picking the multicast address (group) for a new unicast flow from the address space: pick an ' \
+        'address at random, pick addresses in ascending order, or hash the source\'s IP address and port into the ' \
+        'address space (s.t. a source gets the same address after an eviction, after a restart, and on other ' \
+        'translators with the same address space, as long as that address is free). Default: %(default)s'
+    ap.add_argument(f'--{alloc_policy_argname}', choices=list(ALLOC_POLICIES), default=constants.DEFAULT_ALLOC_POLICY,
+                    help=h)
+
     mcast_port_argnmame = 'multicast-port'
     h = 'Port number to use as the destination port when forwarding unicast flows as multicast flows. The same port ' \
         'number will be used for all translated flows. Thus, a translated flow is identified solely by its assigned ' \
         'multicast IP address (group). Default: %(default)d'
     ap.add_argument(f'--{mcast_port_argnmame}', type=int, default=constants.DEFAULT_MULTICAST_PORT, help=h)
 
+    batch_size_argname = 'batch-size'
+    h = 'Maximum number of packets to receive and forward per system call. Values greater than 1 enable the batched ' \
+        'datapath (Linux only). Default: %(default)d'
+    ap.add_argument(f'--{batch_size_argname}', type=int, default=constants.DEFAULT_BATCH_SIZE, help=h)
+
+    read_buffer_size_argname = 'read-buffer-size'
+    h = 'Size (in bytes) of the buffer(s) that unicast packets are received into. Unicast packets with a larger ' \
+        'payload are dropped. Default: %(default)d'
+    ap.add_argument(f'--{read_buffer_size_argname}', type=int, default=constants.DEFAULT_READ_BUFFER_SIZE, help=h)
+
+    workers_argname = 'workers'
+    h = 'Number of worker processes to spread translation across. All workers listen on the unicast port (using ' \
+        'SO_REUSEPORT) and share a single multicast address allocator. Default: %(default)d'
+    ap.add_argument(f'--{workers_argname}', type=int, default=constants.DEFAULT_WORKERS, help=h)
+
+    engine_argname = 'engine'
+    h = 'Translation engine: a dedicated translation thread, or an asyncio event loop (which stops instantly and ' \
+        'publishes streams on the Multicast Menu asynchronously; requires a single worker). Default: %(default)s'
+    ap.add_argument(f'--{engine_argname}', choices=['thread', 'asyncio'], default=constants.DEFAULT_ENGINE, help=h)
+
+    uvloop_argname = 'uvloop'
+    h = f'Run the asyncio event loop on uvloop (if installed). Requires --{engine_argname} asyncio.'
+    ap.add_argument(f'--{uvloop_argname}', action='store_true', help=h)
+
+    mcast_ttl_argname = 'multicast-ttl'
+    h = 'TTL (hop limit for IPv6) of the translated multicast packets. Default: %(default)d'
+    ap.add_argument(f'--{mcast_ttl_argname}', type=int, default=constants.DEFAULT_MULTICAST_TTL, help=h)
+
+    idle_timeout_argname = 'idle-timeout'
+    h = 'Number of seconds after which a unicast flow that has not sent any packets is considered inactive, in which ' \
+        'case its multicast address is freed (a flow that resumes afterwards is treated as a new flow). Set to 0 to ' \
+        'never free multicast addresses. Default: %(default)s'
+    ap.add_argument(f'--{idle_timeout_argname}', type=float, default=constants.DEFAULT_IDLE_TIMEOUT_S, help=h)
+
+    mcast_dscp_argname = 'multicast-dscp'
+    h = 'DSCP (0-63) to mark the translated multicast packets with. Default: system default'
+    ap.add_argument(f'--{mcast_dscp_argname}', type=int, default=None, help=h)
+
+    mcast_sndbuf_argname = 'multicast-sndbuf'
+    h = 'Size (in bytes) of the send buffer of the multicast socket(s). Default: system default'
+    ap.add_argument(f'--{mcast_sndbuf_argname}', type=int, default=None, help=h)
+
+    connected_sockets_argname = 'connected-sockets'
+    h = 'Send each translated flow on a socket of its own that is connected to the flow\'s multicast group, which ' \
+        'saves the kernel a route lookup per packet (at the cost of one file descriptor per flow).'
+    ap.add_argument(f'--{connected_sockets_argname}', action='store_true', help=h)
+
+    max_connected_sockets_argname = 'max-connected-sockets'
+    h = f'Maximum number of connected sockets when --{connected_sockets_argname} is set (also capped by the file ' \
+        'descriptor limit). Beyond that, the least recently used flows are sent on the shared multicast socket. ' \
+        'Default: %(default)d'
+    ap.add_argument(f'--{max_connected_sockets_argname}', type=int, default=constants.DEFAULT_MAX_CONNECTED_SOCKETS,
+                    help=h)
+
+    max_new_flow_rate_argname = 'max-new-flow-rate'
+    h = 'Maximum number of new unicast flows admitted per second (allowing for bursts). The packets of new flows ' \
+        'beyond that rate are dropped, which keeps a flood of (spoofed) sources from exhausting the multicast ' \
+        'address space. Default: no limit'
+    ap.add_argument(f'--{max_new_flow_rate_argname}', type=float, default=None, help=h)
+
+    max_flow_pps_argname = 'max-flow-pps'
+    h = 'Maximum packets per second of a unicast flow (allowing for bursts). Packets beyond that rate are dropped. ' \
+        'Default: no limit'
+    ap.add_argument(f'--{max_flow_pps_argname}', type=float, default=None, help=h)
+
+    max_flow_byte_rate_argname = 'max-flow-byte-rate'
+    h = 'Maximum payload bytes per second of a unicast flow (allowing for bursts). Packets beyond that rate are ' \
+        'dropped. Default: no limit'
+    ap.add_argument(f'--{max_flow_byte_rate_argname}', type=float, default=None, help=h)
+
+    pacing_argname = 'pacing'
+    h = 'Smooth out the bursts of the translated flows by sending their packets at their measured bitrates, which ' \
+        'are measured from the packets\' arrival (rate) or from the PCRs of the MPEG-TS packets they carry (pcr). ' \
+        'Flows that are already smooth are not delayed. Default: %(default)s'
+    ap.add_argument(f'--{pacing_argname}', choices=['off', 'rate', 'pcr'], default='off', help=h)
+
+    pacing_max_delay_argname = 'pacing-max-delay'
+    h = f'Maximum number of seconds a packet is held back by --{pacing_argname}. Default: %(default)s'
+    ap.add_argument(f'--{pacing_max_delay_argname}', type=float, default=constants.DEFAULT_PACING_MAX_DELAY_S,
+                    help=h)
+
+    metrics_port_argname = 'metrics-port'
+    h = 'Port to serve metrics on (in the Prometheus text exposition format). With several workers, each worker ' \
+        'serves its metrics on a port of its own, starting at this port. Default: metrics are not served'
+    ap.add_argument(f'--{metrics_port_argname}', type=int, default=None, help=h)
+
+    metrics_addr_argname = 'metrics-addr'
+    h = 'IP address to serve metrics on. Default: %(default)s'
+    ap.add_argument(f'--{metrics_addr_argname}', default=constants.DEFAULT_METRICS_ADDR, help=h)
+
+    metrics_per_flow_argname = 'metrics-per-flow'
+    h = 'Also report the packets and bytes forwarded per flow (one time series per flow).'
+    ap.add_argument(f'--{metrics_per_flow_argname}', action='store_true', help=h)
+
+    log_format_argname = 'log-format'
+    h = 'Format of the log messages: plain text, or one JSON object per line (e.g., for the journal). ' \
+        'Default: %(default)s'
+    ap.add_argument(f'--{log_format_argname}', choices=['text', 'json'], default=constants.DEFAULT_LOG_FORMAT, help=h)
+
+    log_level_argname = 'log-level'
+    h = 'Minimum level of the log messages. Default: %(default)s'
+    ap.add_argument(f'--{log_level_argname}', choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'],
+                    default=constants.DEFAULT_LOG_LEVEL, help=h)
+
+    mcastmenu_url_argname = 'multicastmenu-url'
+    h = 'Base URL of the Multicast Menu to publish the translated streams on. Default: %(default)s'
+    ap.add_argument(f'--{mcastmenu_url_argname}', default=constants.DEFAULT_MULTICASTMENU_URL, help=h)
+
+    mcastmenu_uid_argname = 'multicastmenu-uid'
+    h = 'Unique identifier of this translator for the Multicast Menu API. If set, translated streams are published ' \
+        'through the API rather than by submitting the form. Default: %(default)s'
+    ap.add_argument(f'--{mcastmenu_uid_argname}', default=None, help=h)
+
+    mcastmenu_withdraw_argname = 'multicastmenu-withdraw'
+    h = 'Withdraw a translated stream from the Multicast Menu when its multicast address is freed. Requires ' \
+        f'--{mcastmenu_uid_argname}.'
+    ap.add_argument(f'--{mcastmenu_withdraw_argname}', action='store_true', help=h)
+
+    mcastmenu_batch_argname = 'multicastmenu-batch'
+    h = 'Publish the streams of new flows in batches (one request every few hundred milliseconds) using the bulk ' \
+        f'endpoint of the Multicast Menu API. Requires --{mcastmenu_uid_argname}.'
+    ap.add_argument(f'--{mcastmenu_batch_argname}', action='store_true', help=h)
+
+    snapshot_file_argname = 'snapshot-file'
+    h = 'File to periodically snapshot the multicast address allocations to, and to restore them from when starting ' \
+        '(warm restart): existing unicast flows keep their multicast addresses, and their streams are not published ' \
+        'on the Multicast Menu again. Default: %(default)s'
+    ap.add_argument(f'--{snapshot_file_argname}', default=None, help=h)
+
+    cluster_backend_argname = 'cluster-backend'
+    h = 'Run as a node of a cluster of translators that allocate multicast addresses from the same address space ' \
+        'without conflicts, by claiming them in a shared backend: memory:// (in-process, for testing), ' \
+        'sqlite:///path/to/file.db (nodes on the same host) or redis://host:port/db (requires the redis package). ' \
+        'The backend is only consulted for new and evicted flows, never per packet. Cannot be combined with ' \
+        f'--{snapshot_file_argname}. Default: %(default)s'
+    ap.add_argument(f'--{cluster_backend_argname}', default=None, help=h)
+
+    cluster_node_id_argname = 'cluster-node-id'
+    h = 'ID of this node, unique within the cluster (defaults to the host name). Default: %(default)s'
+    ap.add_argument(f'--{cluster_node_id_argname}', default=None, help=h)
+
+    cluster_lease_ttl_argname = 'cluster-lease-ttl'
+    h = 'Time (in seconds) after which the multicast addresses of a node that has died (i.e., that fails to renew ' \
+        'its lease) are freed for the other nodes. A node that fails to renew its lease stops forwarding to its ' \
+        'multicast addresses after half this time. Default: %(default)s'
+    ap.add_argument(f'--{cluster_lease_ttl_argname}', type=float, default=constants.DEFAULT_CLUSTER_LEASE_TTL_S, help=h)
+
+    config_argname = 'config'
+    h = 'JSON file with settings that can be changed while the translator is running (the keys are the names of the ' \
+        f'command line options, e.g., {", ".join(config.RELOADABLE)}). The settings in the file take precedence over ' \
+        'the command line options, and the file is read again (and its settings applied without interrupting the ' \
+        'translated flows) when the translator receives SIGHUP. Default: %(default)s'
+    ap.add_argument(f'--{config_argname}', default=None, help=h)
+
     args = ap.parse_args()
     ucast_ip = getattr(args, utils.argname_to_attr(ucast_nif_ip_argname))
     ucast_port = getattr(args, utils.argname_to_attr(ucast_port_argname))
     mcast_addr_space = getattr(args, utils.argname_to_attr(mcast_addr_space_argname))
+    alloc_policy = getattr(args, utils.argname_to_attr(alloc_policy_argname))
     mcast_port = getattr(args, utils.argname_to_attr(mcast_port_argnmame))
+    batch_size = getattr(args, utils.argname_to_attr(batch_size_argname))
+    read_buffer_size = getattr(args, utils.argname_to_attr(read_buffer_size_argname))
+    workers = getattr(args, utils.argname_to_attr(workers_argname))
+    engine = getattr(args, utils.argname_to_attr(engine_argname))
+    use_uvloop = getattr(args, utils.argname_to_attr(uvloop_argname))
+    if engine == 'asyncio' and workers > 1:
+        ap.error(f'--{engine_argname} asyncio requires a single worker.')
+    if use_uvloop and engine != 'asyncio':
+        ap.error(f'--{uvloop_argname} requires --{engine_argname} asyncio.')
+    mcast_ttl = getattr(args, utils.argname_to_attr(mcast_ttl_argname))
+    idle_timeout_s = getattr(args, utils.argname_to_attr(idle_timeout_argname)) or None
+    mcast_dscp = getattr(args, utils.argname_to_attr(mcast_dscp_argname))
+    mcast_sndbuf = getattr(args, utils.argname_to_attr(mcast_sndbuf_argname))
+    connected_sockets = getattr(args, utils.argname_to_attr(connected_sockets_argname))
+    max_connected_sockets = getattr(args, utils.argname_to_attr(max_connected_sockets_argname))
+    max_new_flows_per_s = getattr(args, utils.argname_to_attr(max_new_flow_rate_argname))
+    max_flow_pps = getattr(args, utils.argname_to_attr(max_flow_pps_argname))
+    max_flow_bytes_per_s = getattr(args, utils.argname_to_attr(max_flow_byte_rate_argname))
+    pacing = getattr(args, utils.argname_to_attr(pacing_argname))
+    pacing = None if pacing == 'off' else pacing
+    pacing_max_delay_s = getattr(args, utils.argname_to_attr(pacing_max_delay_argname))
+    metrics_port = getattr(args, utils.argname_to_attr(metrics_port_argname))
+    metrics_addr = getattr(args, utils.argname_to_attr(metrics_addr_argname))
+    metrics_per_flow = getattr(args, utils.argname_to_attr(metrics_per_flow_argname))
+    log_format = getattr(args, utils.argname_to_attr(log_format_argname))
+    log_level = getattr(args, utils.argname_to_attr(log_level_argname))
+    mcastmenu_url = getattr(args, utils.argname_to_attr(mcastmenu_url_argname))
+    mcastmenu_uid = getattr(args, utils.argname_to_attr(mcastmenu_uid_argname))
+    mcastmenu_withdraw = getattr(args, utils.argname_to_attr(mcastmenu_withdraw_argname))
+    mcastmenu_batch = getattr(args, utils.argname_to_attr(mcastmenu_batch_argname))
+    snapshot_path = getattr(args, utils.argname_to_attr(snapshot_file_argname))
+    cluster_backend = getattr(args, utils.argname_to_attr(cluster_backend_argname))
+    cluster_node_id = getattr(args, utils.argname_to_attr(cluster_node_id_argname))
+    cluster_lease_ttl_s = getattr(args, utils.argname_to_attr(cluster_lease_ttl_argname))
+    if cluster_backend is not None and snapshot_path is not None:
+        ap.error(f'--{cluster_backend_argname} cannot be combined with --{snapshot_file_argname}.')
+    if cluster_lease_ttl_s <= 0:
+        ap.error(f'--{cluster_lease_ttl_argname} must be positive.')
+    config_path = getattr(args, utils.argname_to_attr(config_argname))
 
-    # Fire up the translator.
-    t = Translator(ucast_srv_ip=ucast_ip, ucast_srv_port=ucast_port, mcast_addr_space=mcast_addr_space,
-                   mcast_port=mcast_port)
-    t.start()
+    logsetup.setup(log_format, log_level)
 
-    # Keep the translator alive until an interrupt or termination signal is received.
-    print('Press CTRL+C to stop the translator.')
-    killer = GracefulKiller()
-    while not killer.kill_now:
-        time.sleep(2)
-    t.terminate(blocking=True)
+    # Fire up the translator (or a pool of translators, one per worker process).
+    translator_kwargs = dict(ucast_srv_ip=ucast_ip, ucast_srv_port=ucast_port, mcast_addr_space=mcast_addr_space,
+                             mcast_port=mcast_port, read_buffer_size=read_buffer_size, batch_size=batch_size,
+                             mcast_ttl=mcast_ttl, idle_timeout_s=idle_timeout_s, mcastmenu_uid=mcastmenu_uid,
+                             mcastmenu_withdraw=mcastmenu_withdraw, mcastmenu_batch=mcastmenu_batch,
+                             mcastmenu_url=mcastmenu_url,
+                             alloc_policy=alloc_policy, mcast_dscp=mcast_dscp, mcast_sndbuf=mcast_sndbuf,
+                             connected_sockets=connected_sockets, max_connected_sockets=max_connected_sockets,
+                             metrics_port=metrics_port, metrics_addr=metrics_addr, metrics_per_flow=metrics_per_flow,
+                             snapshot_path=snapshot_path, max_new_flows_per_s=max_new_flows_per_s,
+                             max_flow_pps=max_flow_pps, max_flow_bytes_per_s=max_flow_bytes_per_s, pacing=pacing,
+                             pacing_max_delay_s=pacing_max_delay_s, cluster_backend=cluster_backend,
+                             cluster_node_id=cluster_node_id, cluster_lease_ttl_s=cluster_lease_ttl_s)
+    if config_path is not None:
+        try:
+            translator_kwargs.update(config.load(config_path))
+        except (OSError, ValueError) as e:
+            ap.error(f'Failed to load the config file: {e}')
+    if engine == 'asyncio':
+        # Imported here as the asyncio engine builds on this module.
+        import asyncengine
+        asyncengine.run(translator_kwargs, use_uvloop, config_path)
+    else:
+        t = WorkerPool(workers, **translator_kwargs) if workers > 1 else Translator(**translator_kwargs)
+        t.start()
+
+        # Keep the translator alive until an interrupt or termination signal is received.
+        logger.info('Press CTRL+C to stop the translator.')
+        killer = GracefulKiller()
+        while not killer.kill_now:
+            time.sleep(2)
+            if killer.reload_now:
+                killer.reload_now = False
+                config.reload(t, config_path)
+        t.terminate(blocking=True)
+    logsetup.shutdown()
@@ -40,3 +40,40 @@ def get_ipv4(dst_ip=ipaddress.IPv4Address('8.8.8.8')):
     finally:
         s.close()
     return ipaddress.IPv4Address(ip)
+
+
+def get_ipv6(dst_ip=ipaddress.IPv6Address('2001:4860:4860::8888')):
+    """
+    Get the IPv6 address of the network interface on this machine that packets destined for the provided destination IP
+    address dst_ip will be sent out on (the IPv6 counterpart of get_ipv4()).
+
+    :param dst_ip: A destination IPv6 address. Used to specify that the returned IP address should be the IP address of
+    the network interface that routes packets to this destination.
+
+    :return: The IPv6 address of the network interface on this machine that routes packets to dst_ip.
+    """
+    s = socket.socket(socket.AF_INET6, socket.SOCK_DGRAM)
+    if isinstance(dst_ip, ipaddress.IPv6Address):
+        dst_ip = str(dst_ip)
+    if not isinstance(dst_ip, str):
+        raise ValueError(f'dst_ip must be an ipaddress.IPv6Address or a str, but was a {type(dst_ip)}')
+    try:
+        s.connect((dst_ip, 53))
+        ip = s.getsockname()[0]
+    except Exception:
+        ip = '::1'
+    finally:
+        s.close()
+    return ipaddress.IPv6Address(ip.split('%')[0])
+
+
+def get_ip(dst_ip):
+    """
+    Get the IP address (of the same version as dst_ip) of the network interface on this machine that packets destined
+    for dst_ip will be sent out on (see get_ipv4() and get_ipv6()).
+
+    :param dst_ip: A destination ipaddress.IPv4Address or ipaddress.IPv6Address.
+
+    :return: The IP address of the network interface on this machine that routes packets to dst_ip.
+    """
+    return get_ipv6(dst_ip) if dst_ip.version == 6 else get_ipv4(dst_ip)